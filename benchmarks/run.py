@@ -0,0 +1,265 @@
+"""
+Offline benchmark suite of ROILoc.
+
+Synthetic phantoms are built by deforming the bundled MNI template and
+CerebrA atlas with known affines (see `roiloc.phantom`). The main steps of
+ROILoc are timed on them, and the ROIs located by `RoiLocator` are checked
+against the ground truth given by the deformed atlas.
+
+Results are written as JSON. Phantoms are drawn from fixed seeds, so that
+results of different runs (e.g. before and after a change) are comparable:
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+
+import ants
+import numpy as np
+
+from roiloc import __version__
+from roiloc.location import (apply_margin, coords_overlap, crop, get_coords,
+                             get_labels_bbox)
+from roiloc.locator import RoiLocator
+from roiloc.phantom import make_phantom
+from roiloc.registration import get_roi
+from roiloc.roiloc import main, parse_args
+from roiloc.template import get_mni_name, get_roi_indices
+
+SIDES = ["right", "left"]
+
+
+def timeit(func, repeat: int) -> dict:
+    """Time `repeat` calls of `func`."""
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+
+    return {
+        "seconds": seconds,
+        "min": min(seconds),
+        "median": statistics.median(seconds),
+    }
+
+
+def metadata(args: argparse.Namespace) -> dict:
+    return {
+        "roiloc": __version__,
+        "ants": ants.__version__,
+        "numpy": np.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "template": get_mni_name(args.contrast, False),
+        "config": {
+            k: v
+            for k, v in vars(args).items()
+            if k not in ["output", "compare"]
+        },
+    }
+
+
+def bench_import(repeat: int) -> dict:
+    """Time the import of the CLI in fresh interpreters."""
+    code = ("import time; start = time.perf_counter(); import roiloc.roiloc; "
+            "print(time.perf_counter() - start)")
+    seconds = [
+        float(
+            subprocess.run([sys.executable, "-c", code],
+                           capture_output=True,
+                           text=True,
+                           check=True).stdout) for _ in range(repeat)
+    ]
+
+    return {
+        "seconds": seconds,
+        "min": min(seconds),
+        "median": statistics.median(seconds),
+    }
+
+
+def bench_steps(phantom, rois_idx: dict, margin: list, repeat: int) -> dict:
+    """Time the atlas-space steps on a phantom's ground-truth atlas."""
+    atlas = phantom.atlas
+    labels = [int(i) for idx in rois_idx.values() for i in idx]
+    label = labels[0]
+    mask = (atlas.numpy() == label).astype("uint32")
+
+    coords = get_coords(mask, margin=margin)
+
+    return {
+        "get_coords":
+            timeit(lambda: get_coords(mask, margin=margin), repeat),
+        "get_labels_bbox":
+            timeit(lambda: get_labels_bbox(atlas.numpy(), labels), repeat),
+        "get_roi":
+            timeit(lambda: get_roi(atlas, label, save=False), repeat),
+        "crop":
+            timeit(
+                lambda: crop(phantom.image, coords, log_coords=False, ri=True),
+                repeat),
+    }
+
+
+def bench_locator(phantoms: list, args: argparse.Namespace) -> tuple:
+    """Time `RoiLocator.fit` and check its ROIs against the ground truth."""
+    locator = RoiLocator(args.contrast,
+                         args.roi,
+                         transform_type=args.transform,
+                         margin=[0, 0, 0])
+
+    seconds, accuracy = [], {}
+    for seed, phantom in enumerate(phantoms):
+        start = time.perf_counter()
+        locator.fit(phantom.image)
+        seconds.append(time.perf_counter() - start)
+
+        truth = phantom.labels_bbox(
+            [int(i) for idx in locator._rois_idx.values() for i in idx])
+        for roi, idx in locator._rois_idx.items():
+            for i, side in enumerate(SIDES):
+                reference = apply_margin(truth[int(idx[i])],
+                                         phantom.image.shape,
+                                         margin=[0, 0, 0],
+                                         offset=[0, 0, 0])
+                accuracy[f"{seed}/{roi}/{side}"] = coords_overlap(
+                    reference, locator.coords[roi][side])
+
+    return {
+        "seconds": seconds,
+        "min": min(seconds),
+        "median": statistics.median(seconds),
+    }, accuracy
+
+
+def bench_cli(phantoms: list, args: argparse.Namespace) -> dict:
+    """Time the CLI on phantoms written to disk, once."""
+    with tempfile.TemporaryDirectory() as root:
+        for i, phantom in enumerate(phantoms):
+            subject = Path(root) / f"sub-{i:02d}"
+            subject.mkdir()
+            ants.image_write(phantom.image, str(subject / "t1.nii.gz"))
+
+        cli_args = parse_args([
+            "-p", root, "-i", "*/t1.nii.gz", "-c", args.contrast, "-t",
+            args.transform, "-r", *args.roi
+        ])
+
+        with redirect_stdout(StringIO()):
+            return timeit(lambda: main(cli_args), 1)
+
+
+def compare(results: dict, previous: dict):
+    """Print the speedup of each benchmark against a previous run."""
+    print(f"{'benchmark':<24}{'before':>12}{'after':>12}{'speedup':>10}")
+    for name, result in results["timings"].items():
+        if name not in previous.get("timings", {}):
+            continue
+        before = previous["timings"][name]["median"]
+        print(f"{name:<24}{before:>12.4f}{result['median']:>12.4f}"
+              f"{before / result['median']:>9.2f}x")
+
+
+def run(args: argparse.Namespace) -> dict:
+    rois_idx = {roi: get_roi_indices(roi) for roi in args.roi}
+
+    start = time.perf_counter()
+    phantoms = [
+        make_phantom(args.contrast,
+                     shape=args.shape,
+                     spacing=args.spacing,
+                     seed=seed) for seed in range(args.subjects)
+    ]
+    phantom_seconds = time.perf_counter() - start
+
+    timings = {"import": bench_import(args.repeat)}
+    timings.update(bench_steps(phantoms[0], rois_idx, [8, 8, 8], args.repeat))
+    timings["RoiLocator.fit"], accuracy = bench_locator(phantoms, args)
+    timings["main"] = bench_cli(phantoms, args)
+
+    errors = [a["max_error"] for a in accuracy.values()]
+    return {
+        "metadata": metadata(args),
+        "phantom": {
+            "shape": list(phantoms[0].image.shape),
+            "spacing": list(phantoms[0].image.spacing),
+            "seconds": phantom_seconds,
+        },
+        "timings": timings,
+        "accuracy": {
+            "rois": accuracy,
+            "min_iou": min(a["iou"] for a in accuracy.values()),
+            "max_error": max(errors),
+            "passed": max(errors) <= args.max_error,
+        },
+    }
+
+
+def get_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-o", "--output", type=str, default="bench.json")
+    parser.add_argument("--compare",
+                        type=str,
+                        default=None,
+                        help="JSON results of a previous run")
+    parser.add_argument("-c", "--contrast", type=str, default="t1")
+    parser.add_argument("-r", "--roi", nargs="+", default=["Hippocampus"])
+    parser.add_argument("-t", "--transform", type=str, default="AffineFast")
+    parser.add_argument("--subjects",
+                        type=int,
+                        default=3,
+                        help="Number of phantoms")
+    parser.add_argument("--shape",
+                        nargs=3,
+                        type=int,
+                        default=None,
+                        help="Shape of the phantoms")
+    parser.add_argument("--spacing",
+                        nargs=3,
+                        type=float,
+                        default=None,
+                        help="Spacing of the phantoms in mm")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--max-error",
+        type=int,
+        default=4,
+        help="Maximum error in voxels of the located ROIs' boundaries")
+
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = get_args()
+    results = run(args)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    accuracy = results["accuracy"]
+    print(f"Min IoU: {accuracy['min_iou']:.3f}, "
+          f"max error: {accuracy['max_error']} voxels")
+    if not accuracy["passed"]:
+        print(f"Located ROIs are more than {args.max_error} voxels away "
+              "from the ground truth")
+        sys.exit(1)
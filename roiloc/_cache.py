@@ -1,9 +1,49 @@
 import logging
+import os
+import sys
 import tempfile
-from shutil import rmtree
+import threading
+from functools import wraps
+from shutil import disk_usage, rmtree
+from typing import Optional
 
 log = logging.getLogger(__name__)
 
+SCRATCH_ENV = "ROILOC_SCRATCH_DIR"
+RAM_SCRATCH_DIR = "/dev/shm"
+# Free space required to use the RAM-backed scratch area by default, large
+# enough for the displacement fields of several concurrent SyN registrations
+RAM_SCRATCH_MIN_FREE = 1024**3
+
+PIXELTYPE_SIZES = {
+    "unsigned char": 1,
+    "unsigned int": 4,
+    "float": 4,
+    "double": 8,
+}
+
+
+def scratch_dir() -> Optional[str]:
+    """Get the directory where ANTs writes its temporary files.
+
+    It is `$ROILOC_SCRATCH_DIR` if set, else the RAM-backed `/dev/shm` if
+    it is writable with enough free space, so that transforms do not go
+    through a (possibly network-mounted or read-only) disk.
+
+    Returns:
+        Optional[str]: Scratch directory, or None for the default
+            temporary directory
+    """
+    if os.environ.get(SCRATCH_ENV):
+        return os.environ[SCRATCH_ENV]
+
+    if os.path.isdir(RAM_SCRATCH_DIR) and os.access(RAM_SCRATCH_DIR,
+                                                    os.W_OK):
+        if disk_usage(RAM_SCRATCH_DIR).free >= RAM_SCRATCH_MIN_FREE:
+            return RAM_SCRATCH_DIR
+
+    return None
+
 
 def handle_cache(func):
     """Decorator to handle cache
@@ -11,10 +51,11 @@ def handle_cache(func):
     It fixes https://github.com/ANTsX/ANTsPy/issues/117
     """
 
+    @wraps(func)
     def cache(*args, **kwargs):
         """Cache wrapper"""
 
-        cache_dir = tempfile.mkdtemp() + "/"
+        cache_dir = tempfile.mkdtemp(dir=scratch_dir()) + "/"
         log.debug(f"Cache dir: {cache_dir}")
         kwargs["outprefix"] = cache_dir
 
@@ -24,3 +65,113 @@ def handle_cache(func):
             rmtree(cache_dir)
 
     return cache
+
+
+def nbytes(obj) -> int:
+    """Approximate memory footprint of a cached object.
+
+    Args:
+        obj: ANTsImage, DataFrame, numpy array or any python object.
+
+    Returns:
+        int: Size in bytes
+    """
+    if hasattr(obj, "memory_usage"):
+        # pandas' DataFrame
+        return int(obj.memory_usage(deep=True).sum())
+    if hasattr(obj, "nbytes"):
+        return int(obj.nbytes)
+    if hasattr(obj, "pixeltype") and hasattr(obj, "shape"):
+        # ANTsImage, without copying the voxels to numpy
+        itemsize = PIXELTYPE_SIZES.get(obj.pixeltype, 4)
+        components = getattr(obj, "components", 1)
+        size = components * itemsize
+        for s in obj.shape:
+            size *= s
+        return size
+    if isinstance(obj, (tuple, list)):
+        return sum(nbytes(o) for o in obj)
+
+    return sys.getsizeof(obj)
+
+
+class MemoryCache:
+    """Process-wide, keyed, in-memory cache.
+
+    Cached objects are shared between all callers, so they must be
+    considered read-only: clone them before any in-place modification.
+
+    Exemples:
+        >>> cache = MemoryCache()
+        >>> cache.get(("mni", "t1", False, "LPI"), lambda: load(...))
+        >>> cache.invalidate("mni")
+    """
+
+    def __init__(self):
+        self._items = {}
+        self._sizes = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, loader):
+        """Get an object from the cache, loading it on a miss.
+
+        Args:
+            key (tuple): Key of the object, its first element being its kind.
+            loader (Callable): Function called without argument to load
+                the object.
+
+        Returns:
+            Cached object
+        """
+        with self._lock:
+            if key in self._items:
+                self.hits += 1
+                return self._items[key]
+
+            self.misses += 1
+            obj = loader()
+            self._items[key] = obj
+            self._sizes[key] = nbytes(obj)
+            log.debug(f"Cached {key} ({self._sizes[key]} bytes)")
+
+            return obj
+
+    def invalidate(self, *prefix):
+        """Drop cached objects.
+
+        Args:
+            *prefix: Drop only keys starting with these elements,
+                e.g. `invalidate("mni", "t1")`. Drop everything if empty.
+        """
+        with self._lock:
+            for key in list(self._items):
+                if key[:len(prefix)] == prefix:
+                    del self._items[key]
+                    del self._sizes[key]
+
+    @property
+    def nbytes(self) -> int:
+        """Total size of the cached objects in bytes."""
+        return sum(self._sizes.values())
+
+    def info(self) -> dict:
+        """Get cache statistics.
+
+        Returns:
+            dict: Number of hits, misses, total size and size per key
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "nbytes": self.nbytes,
+                "entries": dict(self._sizes),
+            }
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
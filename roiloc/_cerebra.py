@@ -0,0 +1,62 @@
+"""
+CerebrA label lookup, precompiled from `MNI/cerebra/CerebrA_LabelDetails.csv`.
+
+Locating ROIs only needs the right and left labels of each region, which
+are read from here instead of parsing the CSV with pandas. The full table
+is still available through `template.get_label_table`.
+"""
+
+# Right & left labels of each region, by label name
+CEREBRA_LABELS = {
+    "Caudal Anterior Cingulate": (30, 81),
+    "Caudal Middle Frontal": (42, 93),
+    "Cuneus": (43, 94),
+    "Entorhinal": (36, 87),
+    "Fusiform": (24, 75),
+    "Inferior Parietal": (10, 61),
+    "Inferior temporal": (3, 54),
+    "Isthmus Cingulate": (33, 84),
+    "Lateral Occipital": (34, 85),
+    "Lateral Orbitofrontal": (7, 58),
+    "Lingual": (12, 63),
+    "Medial Orbitofrontal": (15, 66),
+    "Middle Temporal": (28, 79),
+    "Parahippocampal": (18, 69),
+    "Paracentral": (16, 67),
+    "Pars Opercularis": (32, 83),
+    "Pars Orbitalis": (44, 95),
+    "Pars Triangularis": (22, 73),
+    "Pericalcarine": (6, 57),
+    "Postcentral": (13, 64),
+    "Posterior Cingulate": (47, 98),
+    "Precentral": (35, 86),
+    "Precuneus": (31, 82),
+    "Rostral Anterior Cingulate": (8, 59),
+    "Rostral Middle Frontal": (1, 52),
+    "Superior Frontal": (38, 89),
+    "Superior Parietal": (9, 60),
+    "Superior Temporal": (45, 96),
+    "Supramarginal": (51, 102),
+    "Transverse Temporal": (14, 65),
+    "Insula": (23, 74),
+    "Brainstem": (11, 62),
+    "Third Ventricle": (29, 80),
+    "Fourth Ventricle": (37, 88),
+    "Optic Chiasm": (17, 68),
+    "Lateral Ventricle": (41, 92),
+    "Inferior Lateral Ventricle": (5, 56),
+    "Cerebellum Gray Matter": (46, 97),
+    "Cerebellum White Matter": (39, 90),
+    "Thalamus": (40, 91),
+    "Caudate": (49, 100),
+    "Putamen": (21, 72),
+    "Pallidum": (27, 78),
+    "Hippocampus": (48, 99),
+    "Amygdala": (19, 70),
+    "Accumbens Area": (4, 55),
+    "Ventral Diencephalon": (26, 77),
+    "Basal Forebrain": (25, 76),
+    "Vermal lobules I-V": (50, 101),
+    "Vermal lobules VI-VII": (2, 53),
+    "Vermal lobules VIII-X": (20, 71),
+}
@@ -0,0 +1,36 @@
+"""
+Lazy imports of heavy dependencies.
+
+Importing ANTs takes seconds (it imports pandas, scipy, matplotlib, ...),
+which `roiloc -h` or `from roiloc.location import get_coords` should not
+pay. Modules import `ants` from here, and it is only loaded on first use.
+"""
+
+import importlib.util
+import sys
+from types import ModuleType
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Import a module, only executing it on first attribute access.
+
+    Args:
+        name (str): Name of the module, e.g. "ants".
+
+    Returns:
+        ModuleType: Module, loaded when first used
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    return module
+
+
+ants = lazy_import("ants")
@@ -0,0 +1,498 @@
+"""
+Batch API: locate ROIs in many images with shared state.
+
+Crops resampled on a fixed grid can be assembled in a `CropStack`, a
+preallocated array of shape (N, X, Y, Z), or a memory-mapped `.npy` file
+that training data loaders read without copies.
+"""
+
+from __future__ import annotations
+
+import csv
+from pathlib import Path
+from typing import (TYPE_CHECKING, Iterable, Iterator, NamedTuple, Optional,
+                    Union)
+
+import numpy as np
+
+from ._lazy import ants
+from .coords import COORDS_COLUMNS
+from .location import crop
+from .locator import RoiLocator
+from .profiling import Profiler
+from .reader import LazyImage
+from .registry import get_template_entry, register_template
+from .scheduler import _run, run_parallel
+
+if TYPE_CHECKING:
+    from ants.core import ANTsImage
+
+SIDES = ["right", "left"]
+
+
+class LocatorResult(NamedTuple):
+    """Result of fitting a subject.
+
+    Attributes:
+        subject: Identifier of the subject (path or position in the batch).
+        coords (dict): Coordinates of the ROIs, as in `RoiLocator.coords`.
+        transforms (Optional[dict]): Forward and inverse transforms, only
+            kept if the locator has a transform store.
+        error (str): Formatted traceback if the subject failed.
+    """
+    subject: Union[str, int]
+    coords: Optional[dict]
+    transforms: Optional[dict] = None
+    error: str = ""
+
+    @property
+    def ok(self) -> bool:
+        return not self.error
+
+
+class ResultStore:
+    """Compact store of the coordinates and transforms of many subjects.
+
+    Coordinates are kept in a single int32 array of shape
+    (n_subjects, n_rois, 2, 6), sides being ordered as right, left.
+
+    Args:
+        rois (list): ROIs of the locator.
+    """
+
+    def __init__(self, rois: list):
+        self.rois = list(rois)
+        self._index = {}
+        self._coords = np.zeros((16, len(self.rois), 2, 6), dtype=np.int32)
+        self._transforms = []
+
+    def add(self,
+            subject: Union[str, int],
+            coords: dict,
+            transforms: Optional[dict] = None):
+        """Store the results of a subject.
+
+        Args:
+            subject (Union[str, int]): Identifier of the subject.
+            coords (dict): Coordinates of each side of each ROI.
+            transforms (Optional[dict], optional): Forward and inverse
+                transforms. Defaults to None.
+        """
+        if subject in self._index:
+            row = self._index[subject]
+            self._transforms[row] = transforms
+        else:
+            row = len(self._index)
+            if row == len(self._coords):
+                self._coords = np.concatenate(
+                    [self._coords, np.zeros_like(self._coords)])
+            self._index[subject] = row
+            self._transforms.append(transforms)
+
+        for r, roi in enumerate(self.rois):
+            for s, side in enumerate(SIDES):
+                self._coords[row, r, s] = coords[roi][side]
+
+    def coords(self, subject: Union[str, int]) -> dict:
+        """Get the coordinates of a subject.
+
+        Args:
+            subject (Union[str, int]): Identifier of the subject.
+
+        Returns:
+            dict: Coordinates of each side of each ROI
+        """
+        row = self._index[subject]
+        return {
+            roi: {
+                side: self._coords[row, r, s].tolist()
+                for s, side in enumerate(SIDES)
+            } for r, roi in enumerate(self.rois)
+        }
+
+    def transforms(self, subject: Union[str, int]) -> Optional[dict]:
+        """Get the stored transforms of a subject, if any."""
+        return self._transforms[self._index[subject]]
+
+    @property
+    def subjects(self) -> list:
+        """Identifiers of the stored subjects."""
+        return list(self._index)
+
+    @property
+    def array(self) -> np.ndarray:
+        """Coordinates of all subjects, in insertion order."""
+        return self._coords[:len(self._index)]
+
+    def __contains__(self, subject) -> bool:
+        return subject in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+class CropStack:
+    """Crops of a fixed shape, stacked in a preallocated array.
+
+    With a `path`, the array is a memory-mapped `.npy` file, and the subject,
+    ROI, side and coordinates of each crop are written to a CSV table with
+    the same name. Slots not filled (e.g. empty crops) stay zero.
+
+    Args:
+        size (int): Number of crops.
+        shape (tuple): Shape of each crop.
+        path (Optional[str], optional): Path of the `.npy` file. Defaults to
+            None, stacking crops in memory.
+        dtype (str, optional): Data type of the stack. Defaults to
+            "float32".
+
+    Attributes:
+        array (np.ndarray): Stack, of shape (size, *shape).
+        rows (list): Subject, ROI, side and coordinates of each crop.
+
+    Exemples:
+        >>> with CropStack(len(paths) * 2, (64, 64, 64), "crops.npy") as stack:
+        ...     for path in paths:
+        ...         right, left = locator.transform(image, grid=grid)
+        ...         stack.append(right, subject=path, roi="Hippocampus",
+        ...                      side="right")
+        ...         ...
+        >>> crops = np.load("crops.npy", mmap_mode="r")
+    """
+
+    def __init__(self,
+                 size: int,
+                 shape: tuple,
+                 path: Optional[str] = None,
+                 dtype: str = "float32"):
+        self.shape = tuple(shape)
+        self.path = Path(path).expanduser() if path else None
+        self.rows = []
+
+        if self.path is None:
+            self.array = np.zeros((size, *self.shape), dtype=dtype)
+        else:
+            self.array = np.lib.format.open_memmap(self.path,
+                                                   mode="w+",
+                                                   dtype=dtype,
+                                                   shape=(size, *self.shape))
+
+    def append(self,
+               image: ANTsImage,
+               subject: Union[str, int] = "",
+               roi: str = "",
+               side: str = "",
+               coords: Optional[list] = None) -> int:
+        """Copy a crop in the next slot of the stack.
+
+        Args:
+            image (ANTsImage): Crop, of the shape of the stack.
+            subject (Union[str, int], optional): Identifier of the subject.
+            roi (str, optional): Name of the ROI.
+            side (str, optional): "right" or "left".
+            coords (Optional[list], optional): Coordinates of the ROI.
+
+        Returns:
+            int: Index of the crop in the stack
+        """
+        index = len(self.rows)
+        assert index < len(self.array), f"The stack is full ({len(self.array)} crops)."
+        assert tuple(
+            image.shape
+        ) == self.shape, f"Crop of shape {list(image.shape)} instead of {list(self.shape)}."
+
+        self.array[index] = image.numpy()
+        self.rows.append({
+            "index": index,
+            "subject": str(subject),
+            "roi": roi,
+            "side": side,
+            **dict(zip(COORDS_COLUMNS, coords or [""] * 6)),
+        })
+
+        return index
+
+    def close(self):
+        """Flush a memory-mapped stack, and write its table."""
+        if self.path is None:
+            return
+
+        self.array.flush()
+        with open(self.path.with_suffix(".csv"), "w", newline="") as f:
+            writer = csv.DictWriter(
+                f,
+                fieldnames=["index", "subject", "roi", "side", *COORDS_COLUMNS])
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _batch_items(images: Union[dict, Iterable]) -> Iterator[tuple]:
+    """Yield (subject, image or path) pairs from a batch."""
+    if isinstance(images, dict):
+        yield from images.items()
+        return
+
+    for i, image in enumerate(images):
+        if isinstance(image, (str, Path)):
+            yield str(image), image
+        else:
+            yield i, image
+
+
+def _read(image: Union[ANTsImage, str, Path]) -> ANTsImage:
+    if isinstance(image, ants.ANTsImage):
+        return image
+
+    return ants.image_read(str(image), pixeltype="float", reorient="LPI")
+
+
+def _fit_subject(item: tuple, params: dict) -> dict:
+    """Fit a fresh locator to a subject, in a worker."""
+    subject, image = item
+    params = dict(params)
+    profiler = Profiler(enabled=params.pop("profile", False))
+
+    # Spawned workers only know the bundled templates, not the ones
+    # registered in the parent
+    register_template(**params.pop("template_entry")._asdict())
+
+    locator = RoiLocator(**params, profiler=profiler)
+    with profiler.stage("read"):
+        image = _read(image)
+    locator.fit(image)
+
+    for record in profiler.records:
+        record["subject"] = str(subject)
+
+    # ANTsTransform cannot be sent back from workers, only stored paths are
+    return {
+        "coords": locator.coords,
+        "profile": profiler.records,
+        "transforms": {
+            "fwdtransforms": locator._fwdtransforms,
+            "invtransforms": locator._invtransforms,
+        } if locator.transform_store is not None and not locator.in_memory
+        else None,
+    }
+
+
+class BatchRoiLocator(RoiLocator):
+    """Locate ROIs in many images, registering them concurrently.
+
+    Per-subject results are kept in a `ResultStore` instead of the
+    single-subject attributes of `RoiLocator`. Templates are loaded once
+    per worker process, their registry entry being passed to the workers so
+    that templates registered with `register_template` can be used.
+
+    Args:
+        contrast (str): Contrast to use for registration.
+        roi (Union[str, list]): ROI or list of ROIs to locate.
+        jobs (int, optional): Number of concurrent registrations, each one
+            in its own process. Defaults to 1, fitting in this process.
+        threads (Optional[int], optional): ITK threads per job. Defaults to
+            None, splitting the available cores between jobs.
+        **kwargs: Other arguments of `RoiLocator`.
+
+    Attributes:
+        results (ResultStore): Coordinates and transforms of fitted subjects.
+        errors (dict): Tracebacks of the subjects that failed.
+
+    Exemples:
+        >>> from roiloc.batch import BatchRoiLocator
+        >>> locator = BatchRoiLocator("t1", "hippocampus", jobs=4)
+        >>> for result in locator.fit_many(paths):
+        ...     print(result.subject, result.coords)
+        >>> for subject, (right, left) in locator.transform_many(paths):
+        ...     ...
+    """
+
+    def __init__(self,
+                 contrast: str,
+                 roi: Union[str, list],
+                 jobs: int = 1,
+                 threads: Optional[int] = None,
+                 **kwargs):
+        super().__init__(contrast, roi, **kwargs)
+
+        self.jobs = jobs
+        self.threads = threads
+        # Workers always locate a list of ROIs, results being formatted back
+        # as `RoiLocator.coords` when queried. They record their stages in
+        # their own profiler, gathered into this one.
+        kwargs.pop("profiler", None)
+        self._params = dict(contrast=contrast,
+                            roi=self.rois,
+                            profile=self.profiler.enabled,
+                            template_entry=get_template_entry(self.template),
+                            **kwargs)
+
+        self.results = ResultStore(self.rois)
+        self.errors = {}
+
+    def _format(self, coords: dict) -> dict:
+        return coords if self._multi else coords[self.rois[0]]
+
+    def _check_fitted(self, subjects: Iterable):
+        """Raise a ValueError listing the subjects not fitted."""
+        missing = [s for s in subjects if s not in self.results]
+        if missing:
+            raise ValueError(
+                f"Subjects not fitted, or whose fit failed: {missing}")
+
+    def fit_many(
+            self, images: Union[dict, Iterable]) -> Iterator[LocatorResult]:
+        """Fit the ROIs to many images, yielding results as they complete.
+
+        Args:
+            images (Union[dict, Iterable]): Images (ANTsImage) or paths.
+                Subjects are identified by their path, by their position
+                otherwise, or by their key if a dictionary is given.
+
+        Yields:
+            LocatorResult: Results, in completion order.
+        """
+        if self.jobs > 1:
+            results = run_parallel(_fit_subject,
+                                   _batch_items(images),
+                                   jobs=self.jobs,
+                                   threads=self.threads,
+                                   params=self._params)
+        else:
+            results = (_run(_fit_subject, item, {"params": self._params})
+                       for item in _batch_items(images))
+
+        for result in results:
+            subject = result.item[0]
+            if not result.ok:
+                self.errors[subject] = result.error
+                yield LocatorResult(subject, None, error=result.error)
+                continue
+
+            self.errors.pop(subject, None)
+            self.profiler.extend(result.value["profile"])
+            self.results.add(subject, result.value["coords"],
+                             result.value["transforms"])
+            yield LocatorResult(subject,
+                                self._format(result.value["coords"]),
+                                result.value["transforms"])
+
+    def transform_many(self,
+                       images: Union[dict, Iterable],
+                       grid: Optional[dict] = None) -> Iterator[tuple]:
+        """Crop many fitted images, one at a time.
+
+        Paths are read lazily, uncompressed NIfTI files only being read
+        in the cropped regions.
+
+        Args:
+            images (Union[dict, Iterable]): Images (ANTsImage) or paths,
+                identified as in `fit_many`.
+            grid (Optional[dict], optional): Fixed grid of the crops, see
+                `RoiLocator.transform`. Defaults to None.
+
+        Yields:
+            tuple: Subject and its crops, as returned by `transform`.
+
+        Raises:
+            ValueError: If a subject was not fitted, or its fit failed,
+                before any subject is cropped.
+        """
+        items = list(_batch_items(images))
+        self._check_fitted(subject for subject, _ in items)
+
+        for subject, image in items:
+            if not isinstance(image, ants.ANTsImage):
+                image = LazyImage(Path(image))
+
+            crops = {
+                roi: [
+                    crop(image,
+                         coords[side],
+                         log_coords=False,
+                         ri=True,
+                         grid=grid) for side in SIDES
+                ] for roi, coords in self.results.coords(subject).items()
+            }
+
+            yield subject, self._format(crops)
+
+    def stack_many(self,
+                   images: Union[dict, Iterable],
+                   grid: dict,
+                   path: Optional[str] = None) -> CropStack:
+        """Crop many fitted images on a fixed grid, into a single stack.
+
+        Crops are ordered by subject, ROI and side (right, left).
+
+        Args:
+            images (Union[dict, Iterable]): Images (ANTsImage) or paths of
+                fitted subjects, identified as in `fit_many`.
+            grid (dict): Fixed grid of the crops, see `RoiLocator.transform`.
+            path (Optional[str], optional): Path of a memory-mapped `.npy`
+                stack. Defaults to None, stacking crops in memory.
+
+        Returns:
+            CropStack: Stack of the crops
+
+        Raises:
+            ValueError: If a subject was not fitted, or its fit failed,
+                before the stack is created.
+        """
+        images = dict(_batch_items(images))
+        self._check_fitted(images)
+        stack = CropStack(len(images) * len(self.rois) * len(SIDES),
+                          grid["shape"], path)
+        with stack:
+            for subject, crops in self.transform_many(images, grid=grid):
+                coords = self.results.coords(subject)
+                crops = crops if self._multi else {self.rois[0]: crops}
+                for roi, sides in crops.items():
+                    for side, cropped in zip(SIDES, sides):
+                        stack.append(cropped,
+                                     subject=subject,
+                                     roi=roi,
+                                     side=side,
+                                     coords=coords[roi][side])
+
+        return stack
+
+    def fit_transform_many(
+            self, images: Union[dict, Iterable]) -> Iterator[tuple]:
+        """Fit and crop many images, yielding crops as subjects complete.
+
+        Args:
+            images (Union[dict, Iterable]): Images (ANTsImage) or paths.
+
+        Yields:
+            tuple: Subject and its crops, as returned by `transform`.
+        """
+        images = dict(_batch_items(images))
+        for result in self.fit_many(images):
+            if result.ok:
+                yield from self.transform_many(
+                    {result.subject: images[result.subject]})
+
+    def get_coords(self, subject: Union[str, int, None] = None) -> dict:
+        """Get the coordinates of a fitted subject.
+
+        Args:
+            subject (Union[str, int, None], optional): Identifier of the
+                subject. Defaults to None, returning the coordinates of
+                the last `fit`.
+
+        Returns:
+            dict: Coordinates, as in `RoiLocator.coords`.
+        """
+        if subject is None:
+            return super().get_coords()
+
+        return self._format(self.results.coords(subject))
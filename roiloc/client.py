@@ -0,0 +1,96 @@
+"""
+Entry point of the `roiloc` CLI, and thin client of `roiloc serve`.
+
+This module only imports the standard library: when a daemon is running,
+commands are sent to it without paying the import cost of ANTs or the
+loading of templates.
+"""
+
+import json
+import os
+import socket
+import sys
+import tempfile
+from typing import Optional
+
+SOCKET_ENV = "ROILOC_SOCKET"
+NO_DAEMON_ENV = "ROILOC_NO_DAEMON"
+
+
+def socket_path() -> str:
+    """Get the path of the daemon's Unix socket.
+
+    It is `$ROILOC_SOCKET` if set, else `roiloc-<uid>.sock` in
+    `$XDG_RUNTIME_DIR` or the temporary directory.
+    """
+    if os.environ.get(SOCKET_ENV):
+        return os.environ[SOCKET_ENV]
+
+    directory = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(directory, f"roiloc-{os.getuid()}.sock")
+
+
+def request(message: dict,
+            path: Optional[str] = None,
+            timeout: Optional[float] = None) -> dict:
+    """Send a request to the daemon and wait for its response.
+
+    Args:
+        message (dict): Request, with a "command" among "run", "coords",
+            "crop" and "ping", see `roiloc.server`.
+        path (Optional[str], optional): Socket of the daemon. Defaults to
+            None, see `socket_path`.
+        timeout (Optional[float], optional): Timeout in seconds. Defaults to
+            None, waiting until the request is processed.
+
+    Returns:
+        dict: Response of the daemon
+
+    Raises:
+        OSError: If no daemon listens on the socket.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path or socket_path())
+        client.sendall(json.dumps(message).encode() + b"\n")
+
+        with client.makefile("rb") as f:
+            line = f.readline()
+
+    if not line:
+        raise ConnectionError("The daemon closed the connection.")
+
+    return json.loads(line)
+
+
+def start():
+    argv = sys.argv[1:]
+
+    if argv[:1] == ["serve"]:
+        from roiloc.server import start as serve
+        serve(argv[1:])
+        return
+
+    if argv[:1] == ["crop"]:
+        # Only reads and writes images, no template is needed
+        from roiloc.coords import start as crop
+        crop(argv[1:])
+        return
+
+    if not os.environ.get(NO_DAEMON_ENV) and os.path.exists(socket_path()):
+        try:
+            response = request({
+                "command": "run",
+                "argv": argv,
+                "cwd": os.getcwd()
+            })
+        except OSError:
+            # Stale socket of a stopped daemon
+            response = None
+
+        if response is not None:
+            sys.stdout.write(response["output"])
+            sys.exit(response["status"])
+
+    from roiloc.roiloc import start as run
+    run(argv)
@@ -0,0 +1,345 @@
+"""
+Per-run tables of ROI coordinates, and `roiloc crop --from-coords`.
+
+With `--coords-only`, the CLI locates ROIs without reading or writing any
+crop, and writes a single table with one row per subject, ROI and side.
+Crops are then applied in bulk from the table, without registering again:
+
+    roiloc -p data -i "*/t1.nii.gz" -c t1 --coords-only
+    roiloc crop --from-coords data/roiloc_coords.csv --extracrops "*t2*"
+
+Coordinates are voxel indices of the image in LPI orientation, in xyzxyz
+format with upper bounds excluded, as in `ants.crop_indices`.
+
+Crops resampled on a fixed grid can also be gathered in a single
+memory-mapped `.npy` stack, e.g. to train models:
+
+    roiloc crop --from-coords data/roiloc_coords.csv --gridshape 64 64 64 \
+        --stack crops.npy
+"""
+
+import argparse
+import csv
+import os
+from pathlib import Path
+from typing import Optional
+
+from rich import print
+
+from .location import crop, make_grid
+from .pipeline import AsyncWriter, write_image
+from .reader import LazyImage
+
+COORDS_COLUMNS = ["xmin", "ymin", "zmin", "xmax", "ymax", "zmax"]
+SHAPE_COLUMNS = ["nx", "ny", "nz"]
+SPACING_COLUMNS = ["sx", "sy", "sz"]
+COLUMNS = [
+    "subject", "roi", "side", *COORDS_COLUMNS, *SHAPE_COLUMNS,
+    *SPACING_COLUMNS, "template", "transform", "transform_key", "quality"
+]
+
+
+def coords_row(subject: str,
+               roi: str,
+               side: str,
+               coords: list,
+               shape: tuple,
+               spacing: tuple,
+               template: str,
+               transform: str,
+               transform_key: str = "",
+               quality: Optional[float] = None) -> dict:
+    """Row of a coordinates table.
+
+    Args:
+        subject (str): Path of the subject's image.
+        roi (str): Name of the ROI.
+        side (str): "right" or "left".
+        coords (list): Coordinates of the ROI, in xyzxyz format.
+        shape (tuple): Shape of the image in LPI orientation.
+        spacing (tuple): Voxel spacing of the image in mm.
+        template (str): Template the image was registered to.
+        transform (str): Type of registration.
+        transform_key (str, optional): Key of the transforms in the
+            transform store, if any. Defaults to "".
+        quality (Optional[float], optional): Quality of the registration,
+            see `registration.registration_quality`. Defaults to None, if
+            unknown (e.g. transforms reused from the store).
+
+    Returns:
+        dict: Row, with the keys of `COLUMNS`
+    """
+    return {
+        "subject": str(subject),
+        "roi": roi,
+        "side": side,
+        **{c: int(v) for c, v in zip(COORDS_COLUMNS, coords)},
+        **{c: int(v) for c, v in zip(SHAPE_COLUMNS, shape)},
+        **{c: float(v) for c, v in zip(SPACING_COLUMNS, spacing)},
+        "template": template,
+        "transform": transform,
+        "transform_key": transform_key or "",
+        "quality": None if quality is None else round(float(quality), 4),
+    }
+
+
+def write_coords_table(rows: list, path: str):
+    """Write a coordinates table, as CSV or as Parquet if `path` ends with
+    `.parquet` (needs pandas' Parquet engine, e.g. pyarrow).
+
+    Args:
+        rows (list): Rows, see `coords_row`.
+        path (str): Output path.
+    """
+    path = Path(path).expanduser()
+    if path.suffix == ".parquet":
+        import pandas as pd
+        pd.DataFrame(rows, columns=COLUMNS).to_parquet(path, index=False)
+        return
+
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def read_coords_table(path: str) -> list:
+    """Read a coordinates table written by `write_coords_table`.
+
+    Args:
+        path (str): Path of the CSV or Parquet table.
+
+    Returns:
+        list: Rows, see `coords_row`
+    """
+    path = Path(path).expanduser()
+    if path.suffix == ".parquet":
+        import pandas as pd
+        rows = pd.read_parquet(path).to_dict("records")
+    else:
+        with open(path, newline="") as f:
+            rows = list(csv.DictReader(f))
+
+    for row in rows:
+        for c in [*COORDS_COLUMNS, *SHAPE_COLUMNS]:
+            row[c] = int(row[c])
+        for c in SPACING_COLUMNS:
+            row[c] = float(row[c])
+        # Unknown, or missing from tables of older versions
+        quality = row.get("quality")
+        row["quality"] = None if quality in [None, ""] else float(quality)
+
+    return rows
+
+
+def crop_from_table(rows: list,
+                    extracrops: list = [],
+                    output_dir: Optional[str] = None,
+                    image: bool = True,
+                    queuesize: int = 8,
+                    compresslevel: int = 6,
+                    workers: int = 1,
+                    grid: Optional[dict] = None,
+                    stack: Optional[str] = None) -> list:
+    """Crop the images of a coordinates table.
+
+    Each file is read at most once for all its crops, and only its cropped
+    regions if it is an uncompressed NIfTI. Crops are written in the
+    background, named as by the CLI.
+
+    Args:
+        rows (list): Rows of a coordinates table, see `read_coords_table`.
+        extracrops (list, optional): Patterns of other files to crop, in
+            the directory of each subject's image. Defaults to [].
+        output_dir (Optional[str], optional): Directory of the crops, where
+            the layout of the subjects' directories is kept. Defaults to
+            None, writing them next to the cropped files.
+        image (bool, optional): Crop the subjects' images. Defaults to True.
+        queuesize (int, optional): Number of crops waiting to be written.
+            Defaults to 8.
+        compresslevel (int, optional): Gzip compression level of the crops.
+            Defaults to 6.
+        workers (int, optional): Number of writer threads. Defaults to 1.
+        grid (Optional[dict], optional): Fixed grid on which crops are
+            resampled, see `location.make_grid`. Defaults to None.
+        stack (Optional[str], optional): Path of a `.npy` stack of all
+            crops, written instead of files, see `batch.CropStack`. Needs a
+            `grid`. Defaults to None.
+
+    Returns:
+        list: Paths of the written crops, or of the stack and its table
+    """
+    from rich.progress import track
+
+    from .batch import CropStack
+
+    subjects = {}
+    for row in rows:
+        subjects.setdefault(row["subject"], []).append(row)
+
+    # Common parent of the subjects, whose layout is kept in `output_dir`
+    root = Path(os.path.commonpath([Path(s).parent for s in subjects
+                                    ])) if subjects else None
+
+    files = {}
+    for subject in subjects:
+        image_path = Path(subject)
+        files[subject] = [image_path] if image else []
+        files[subject] += [
+            f for e in extracrops for f in image_path.parent.glob(e)
+        ]
+
+    crops = None
+    if stack is not None:
+        assert grid is not None, "Crops of a stack need a fixed grid."
+        crops = CropStack(
+            sum(len(files[s]) * len(r) for s, r in subjects.items()),
+            grid["shape"], stack)
+
+    outputs = []
+
+    def write(cropped_image, path):
+        outputs.append(path)
+        writer.submit(write_image,
+                      cropped_image,
+                      path,
+                      compresslevel=compresslevel)
+
+    with AsyncWriter(maxsize=queuesize, workers=workers) as writer:
+        for subject, subject_rows in track(subjects.items(),
+                                           total=len(subjects)):
+            for file in files[subject]:
+                source = LazyImage(file)
+                fstem = file.stem.split(".")[0]
+                directory = file.parent
+                if output_dir:
+                    directory = Path(output_dir).expanduser(
+                    ) / file.parent.relative_to(root)
+                    directory.mkdir(parents=True, exist_ok=True)
+
+                for row in subject_rows:
+                    shape = tuple(row[c] for c in SHAPE_COLUMNS)
+                    assert tuple(
+                        source.shape
+                    ) == shape, f"{str(file)} has shape {list(source.shape)} instead of {list(shape)} in the coordinates table."
+
+                    coords = [row[c] for c in COORDS_COLUMNS]
+                    if crops is not None:
+                        crops.append(crop(source, coords, ri=True, grid=grid),
+                                     subject=file,
+                                     roi=row["roi"],
+                                     side=row["side"],
+                                     coords=coords)
+                        continue
+
+                    crop(source,
+                         coords,
+                         directory / (f"{fstem}_{row['roi']}_{row['side']}_"
+                                      f"{row['transform']}_crop.nii.gz"),
+                         log_coords=False,
+                         write=write,
+                         grid=grid)
+
+    if crops is not None:
+        crops.close()
+        outputs = [crops.path, crops.path.with_suffix(".csv")]
+
+    return outputs
+
+
+def start(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(
+        prog="roiloc crop",
+        description=
+        "Crop images in bulk from the coordinates table of a `--coords-only` run."
+    )
+    parser.add_argument(
+        "--from-coords",
+        help="<Required> Path of the CSV or Parquet coordinates table.",
+        required=True,
+        dest="from_coords",
+        type=str)
+    parser.add_argument(
+        "--extracrops",
+        nargs="+",
+        help=
+        "Pattern for other files to crop, in the directory of each subject's image (e.g. manual segmentation: '*manual_segmentation_left*.nii.gz').",
+        type=str,
+        default=[])
+    parser.add_argument(
+        "--noimage",
+        help="Flag to only crop the files given by `--extracrops`.",
+        dest="image",
+        action="store_false",
+        default=True)
+    parser.add_argument(
+        "-o",
+        "--outputdir",
+        help=
+        "Directory of the crops, keeping the layout of the subjects' directories. Default: next to each cropped file.",
+        type=str,
+        default=None)
+
+    parser.add_argument(
+        "--compresslevel",
+        help=
+        "Compression level of the crops, from 0 (none) to 9 (smallest, slowest). Default: 6",
+        choices=range(10),
+        metavar="{0-9}",
+        type=int,
+        default=6)
+    parser.add_argument(
+        "--writers",
+        help="Number of threads writing crops. Default: 1",
+        type=int,
+        default=1)
+
+    parser.add_argument(
+        "--gridshape",
+        nargs=3,
+        type=int,
+        help=
+        "Shape in voxels of a fixed grid on which crops are resampled, centred on the ROIs (e.g. 64 64 64). Default: crops of the ROIs' coordinates.",
+        default=None)
+    parser.add_argument(
+        "--gridspacing",
+        nargs="+",
+        type=float,
+        help=
+        "Isotropic spacing, or spacing of each axis, in mm of the grid given by `--gridshape`. Default: 1",
+        default=None)
+    parser.add_argument(
+        "--gridinterpolation",
+        help=
+        "Interpolation of the crops resampled on the grid. Use `genericLabel` for label images. Default: `linear`",
+        choices=["linear", "nearestNeighbor", "genericLabel", "bSpline"],
+        type=str,
+        default="linear")
+    parser.add_argument(
+        "--stack",
+        help=
+        "Path of a `.npy` stack of all crops, of shape (N, X, Y, Z), written instead of crop files, with a CSV table of the subject, ROI, side and coordinates of each crop. Needs `--gridshape`.",
+        type=str,
+        default=None)
+
+    args = parser.parse_args(argv)
+    if args.stack and not args.gridshape:
+        parser.error("--stack needs --gridshape.")
+
+    rows = read_coords_table(args.from_coords)
+    outputs = crop_from_table(rows,
+                              extracrops=args.extracrops,
+                              output_dir=args.outputdir,
+                              image=args.image,
+                              compresslevel=args.compresslevel,
+                              workers=args.writers,
+                              grid=make_grid(args.gridshape, args.gridspacing,
+                                             args.gridinterpolation),
+                              stack=args.stack)
+
+    if args.stack:
+        print(f"[bold green]Wrote a stack of crops from {len(rows)} rows to "
+              f"{args.stack}.")
+        return
+
+    print(f"[bold green]Wrote {len(outputs)} crops from {len(rows)} rows.")
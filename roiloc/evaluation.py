@@ -0,0 +1,79 @@
+"""
+Speed and accuracy comparison of locator configurations.
+"""
+
+from __future__ import annotations
+
+import time
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from ._lazy import ants
+from .location import coords_overlap
+from .locator import RoiLocator
+
+if TYPE_CHECKING:
+    from ants.core import ANTsImage
+
+
+def _flatten_coords(coords: dict) -> dict:
+    """Flatten `RoiLocator.coords` into a {"roi/side": coords} dict."""
+    flat = {}
+    for key, value in coords.items():
+        if isinstance(value, dict):
+            flat.update({f"{key}/{side}": c for side, c in value.items()})
+        else:
+            flat[key] = value
+
+    return flat
+
+
+def compare_locators(images: list, reference: RoiLocator,
+                     candidate: RoiLocator) -> dict:
+    """Compare the throughput and coordinates of two locators.
+
+    Typically used to evaluate a fast configuration (e.g. downsampled
+    registration or corner coordinates) against the default
+    `AffineFast` full-resolution one.
+
+    Args:
+        images (list): Images (ANTsImage) to fit both locators to.
+        reference (RoiLocator): Reference locator.
+        candidate (RoiLocator): Evaluated locator.
+
+    Returns:
+        dict: Fit times of both locators, speedup, and overlap of the
+            candidate's coords against the reference ones
+    """
+    seconds = {"reference": [], "candidate": []}
+    overlaps = []
+
+    for image in images:
+        assert isinstance(image, ants.ANTsImage)
+
+        for name, locator in [("reference", reference),
+                              ("candidate", candidate)]:
+            start = time.perf_counter()
+            locator.fit(image)
+            seconds[name].append(time.perf_counter() - start)
+
+        ref_coords = _flatten_coords(reference.get_coords())
+        cand_coords = _flatten_coords(candidate.get_coords())
+        overlaps.append({
+            key: coords_overlap(ref_coords[key], cand_coords[key])
+            for key in ref_coords
+        })
+
+    ious = [o["iou"] for image in overlaps for o in image.values()]
+    errors = [o["max_error"] for image in overlaps for o in image.values()]
+
+    return {
+        "reference_seconds": seconds["reference"],
+        "candidate_seconds": seconds["candidate"],
+        "speedup": float(
+            np.sum(seconds["reference"]) / np.sum(seconds["candidate"])),
+        "overlaps": overlaps,
+        "min_iou": float(np.min(ious)),
+        "max_error": int(np.max(errors)),
+    }
@@ -1,11 +1,84 @@
+from __future__ import annotations
+
 from pathlib import PosixPath
-from typing import Optional
+from typing import TYPE_CHECKING, Callable, Optional, Union
 
-import ants
 import numpy as np
-from ants.core import ANTsImage
 from rich import print
 
+from ._lazy import ants
+from .reader import LazyImage
+from .registration import apply_transforms, is_linear, read_transforms
+
+if TYPE_CHECKING:
+    from ants.core import ANTsImage
+
+
+def apply_margin(bbox: tuple,
+                 shape: tuple,
+                 margin: list = [8, 8, 8],
+                 offset: list = [0, 0, 0]) -> list:
+    """Apply a margin with offset to a bounding box, clamped to the image.
+
+    Args:
+        bbox (tuple): Inclusive minimum and maximum indices of the ROI,
+            as two sequences of 3 integers
+        shape (tuple): Shape of the image
+        margin (list, optional): margin for xyz axes. Defaults to [8, 8, 8]
+        offset (list, optional): offset for xyz axes. Defaults to [0, 0, 0]
+
+    Returns:
+        list: Coordinates in xyzxyz format
+    """
+    lower, upper = bbox
+
+    coords = []
+    for i in range(3):
+        low = int(lower[i]) + offset[i] - margin[i]
+        coords.append(low if low > 0 else 0)
+    for i in range(3):
+        up = int(upper[i]) + offset[i] + margin[i]
+        coords.append(up if up < shape[i] else shape[i])
+
+    return coords
+
+
+def get_bbox(x: np.ndarray) -> Optional[tuple]:
+    """Get the bounding box of the non-zero voxels of a mask, or of a stack
+    of masks.
+
+    Extents are found from projections of the mask on its axes, with
+    `any()` reductions that never materialize the indices of its voxels.
+    The last axis is only scanned within the extents of the first two. See
+    `get_labels_bbox` for the boxes of all labels of a label volume.
+
+    Args:
+        x (np.ndarray): Mask of shape (X, Y, Z), or stack of masks of shape
+            (N, X, Y, Z)
+
+    Returns:
+        Optional[tuple]: Inclusive minimum and maximum indices, None for an
+            empty mask. A list of them for a stack of masks.
+    """
+    if x.ndim == 4:
+        return [get_bbox(mask) for mask in x]
+
+    xy = np.any(x, axis=2)
+    xs, ys = np.any(xy, axis=1), np.any(xy, axis=0)
+    if not xs.any():
+        return None
+
+    lower, upper = [], []
+    for projection in [xs, ys]:
+        lower.append(int(np.argmax(projection)))
+        upper.append(len(projection) - 1 - int(np.argmax(projection[::-1])))
+
+    zs = np.any(x[lower[0]:upper[0] + 1, lower[1]:upper[1] + 1], axis=(0, 1))
+    lower.append(int(np.argmax(zs)))
+    upper.append(len(zs) - 1 - int(np.argmax(zs[::-1])))
+
+    return lower, upper
+
 
 def get_coords(x: np.ndarray,
                margin: list = [8, 8, 8],
@@ -13,47 +86,331 @@ def get_coords(x: np.ndarray,
     """Get coordinates of a given ROI, and apply a margin with offset.
 
     Args:
-        x (np.ndarray): ROI in binary format
+        x (np.ndarray): ROI in binary format, or stack of ROIs of shape
+            (N, X, Y, Z)
         margin (list, optional): margin for xyz axes. Defaults to [8, 8, 8]
         offset (list, optional): offset for xyz axes. Defaults to [0, 0, 0]
 
     Returns:
-        list: Coordinates in xyzxyz format
+        list: Coordinates in xyzxyz format. A list of them for a stack of
+            ROIs, None for empty ones.
+
+    Raises:
+        ValueError: If the ROI is empty.
     """
-    ux, uy, uz = x.shape
+    bbox = get_bbox(x)
 
-    mask = np.where(x != 0)
+    if x.ndim == 4:
+        return [
+            apply_margin(b, x.shape[1:], margin=margin, offset=offset)
+            if b is not None else None for b in bbox
+        ]
+
+    if bbox is None:
+        raise ValueError("Empty ROI, no coordinates to get.")
+
+    return apply_margin(bbox, x.shape, margin=margin, offset=offset)
+
+
+def get_labels_bbox(x: np.ndarray, labels: list) -> dict:
+    """Get the bounding boxes of several labels in a single pass.
+
+    Args:
+        x (np.ndarray): Label volume (e.g. a registered atlas)
+        labels (list): Labels to locate
+
+    Returns:
+        dict: Inclusive minimum and maximum indices of each label,
+            None for labels absent from `x`
+    """
+    # scipy is only imported when needed, see `roiloc._lazy`
+    from scipy.ndimage import find_objects
 
-    minx, maxx = int(np.min(mask[0])) + offset[0], int(np.max(
-        mask[0])) + offset[0]
-    miny, maxy = int(np.min(mask[1])) + offset[1], int(np.max(
-        mask[1])) + offset[1]
-    minz, maxz = int(np.min(mask[2])) + offset[2], int(np.max(
-        mask[2])) + offset[2]
+    labels = [int(label) for label in labels]
 
-    minx = (minx - margin[0]) if (minx - margin[0]) > 0 else 0
-    miny = (miny - margin[1]) if (miny - margin[1]) > 0 else 0
-    minz = (minz - margin[2]) if (minz - margin[2]) > 0 else 0
-    maxx = (maxx + margin[0]) if (maxx + margin[0]) < ux else ux
-    maxy = (maxy + margin[1]) if (maxy + margin[1]) < uy else uy
-    maxz = (maxz + margin[2]) if (maxz + margin[2]) < uz else uz
+    if not np.issubdtype(x.dtype, np.integer):
+        x = x.astype(np.int64)
 
-    return [minx, miny, minz, maxx, maxy, maxz]
+    objects = find_objects(x, max_label=max(labels))
+
+    boxes = {}
+    for label in labels:
+        slices = objects[label - 1]
+        if slices is None:
+            boxes[label] = None
+        else:
+            boxes[label] = ([s.start for s in slices],
+                            [s.stop - 1 for s in slices])
+
+    return boxes
+
+
+def index_to_physical(image: ANTsImage, indices: np.ndarray) -> np.ndarray:
+    """Convert continuous voxel indices to physical points.
+
+    Args:
+        image (ANTsImage): Image defining the voxel grid
+        indices (np.ndarray): Indices, of shape (n, 3)
+
+    Returns:
+        np.ndarray: Physical points, of shape (n, 3)
+    """
+    affine = image.direction @ np.diag(image.spacing)
+    return np.asarray(indices) @ affine.T + np.asarray(image.origin)
+
+
+def physical_to_index(image: ANTsImage, points: np.ndarray) -> np.ndarray:
+    """Convert physical points to continuous voxel indices.
+
+    Args:
+        image (ANTsImage): Image defining the voxel grid
+        points (np.ndarray): Physical points, of shape (n, 3)
+
+    Returns:
+        np.ndarray: Continuous indices, of shape (n, 3)
+    """
+    affine = image.direction @ np.diag(image.spacing)
+    return (np.asarray(points) - np.asarray(image.origin)) @ np.linalg.inv(
+        affine).T
+
+
+def transform_bbox(bbox: tuple, moving: ANTsImage, fixed: ANTsImage,
+                   transformlist: list) -> tuple:
+    """Map a bounding box from the moving to the fixed space of a linear
+    registration, by transforming its corners instead of resampling a whole
+    label volume.
+
+    The resulting box contains every fixed voxel whose center falls inside
+    the moving box, so it is a slightly conservative approximation of the
+    box of the nearest-neighbor resampled label.
+
+    Args:
+        bbox (tuple): Inclusive minimum and maximum indices in moving space
+        moving (ANTsImage): Image defining the moving voxel grid
+        fixed (ANTsImage): Image defining the fixed voxel grid
+        transformlist (list): Forward transforms of the registration, as
+            given to `ants.apply_transforms`, or already read as
+            ANTsTransform
+
+    Returns:
+        tuple: Inclusive minimum and maximum indices in fixed space
+
+    Raises:
+        ValueError: If a transform is not linear.
+    """
+    if not all(is_linear(t) for t in transformlist):
+        raise ValueError(
+            "Bounding boxes can only be transformed through linear transforms."
+        )
+
+    lower, upper = np.asarray(bbox[0]) - .5, np.asarray(bbox[1]) + .5
+    corners = np.array([[(lower, upper)[c][i]
+                         for i, c in enumerate(corner)]
+                        for corner in np.ndindex(2, 2, 2)])
+    points = index_to_physical(moving, corners)
+
+    # Forward transforms map fixed points to moving points, so moving points
+    # go through their inverses, in reverse order
+    for transform in reversed(read_transforms(transformlist)):
+        transform = transform.invert()
+        points = np.array([transform.apply_to_point(p) for p in points])
+
+    indices = physical_to_index(fixed, points)
+
+    return ([int(i) for i in np.ceil(indices.min(axis=0))],
+            [int(i) for i in np.floor(indices.max(axis=0))])
+
+
+def transform_labels_bbox(boxes: dict, labels: list, moving: ANTsImage,
+                          fixed: ANTsImage, transformlist: list) -> dict:
+    """Map the bounding boxes of several labels through a linear registration.
+
+    Args:
+        boxes (dict): Bounding boxes of the labels in moving space
+            (e.g. from `template.get_atlas_bboxes`)
+        labels (list): Labels to map
+        moving (ANTsImage): Image defining the moving voxel grid
+        fixed (ANTsImage): Image defining the fixed voxel grid
+        transformlist (list): Forward transforms of the registration
+
+    Returns:
+        dict: Bounding boxes in fixed space, None for labels absent from
+            `boxes`. See `transform_bbox`.
+    """
+    return {
+        int(label): transform_bbox(boxes[int(label)], moving, fixed,
+                                   transformlist)
+        if boxes.get(int(label)) is not None else None for label in labels
+    }
 
 
-def crop(image: ANTsImage,
+def coords_overlap(reference: list, candidate: list) -> dict:
+    """Compare two sets of coordinates.
+
+    Args:
+        reference (list): Reference coordinates in xyzxyz format
+        candidate (list): Candidate coordinates in xyzxyz format
+
+    Returns:
+        dict: Intersection over union and maximum absolute difference
+            (in voxels) of the coordinates
+    """
+    reference, candidate = np.asarray(reference), np.asarray(candidate)
+
+    inter = np.clip(
+        np.minimum(reference[3:], candidate[3:]) -
+        np.maximum(reference[:3], candidate[:3]), 0, None).prod()
+    union = (reference[3:] - reference[:3]).prod() + (
+        candidate[3:] - candidate[:3]).prod() - inter
+
+    return {
+        "iou": float(inter / union) if union else 1.,
+        "max_error": int(np.abs(reference - candidate).max()),
+    }
+
+
+def compare_bbox_modes(atlas: ANTsImage, fixed: ANTsImage,
+                       transformlist: list, labels: list) -> dict:
+    """Compare the label bounding boxes obtained by transforming the atlas'
+    box corners against those of the fully warped atlas.
+
+    Args:
+        atlas (ANTsImage): Label volume in moving space
+        fixed (ANTsImage): Image defining the fixed voxel grid
+        transformlist (list): Linear forward transforms of the registration
+        labels (list): Labels to compare
+
+    Returns:
+        dict: `coords_overlap` of each label, taking the warped atlas as
+            reference. Labels lost by the warp are skipped.
+    """
+    warped = apply_transforms(fixed=fixed,
+                              moving=atlas,
+                              transformlist=transformlist,
+                              interpolator="nearestNeighbor")
+    reference = get_labels_bbox(warped.numpy(), labels)
+    moving = get_labels_bbox(atlas.numpy(), labels)
+
+    overlaps = {}
+    for label in reference:
+        if reference[label] is None or moving[label] is None:
+            continue
+
+        candidate = transform_bbox(moving[label], atlas, fixed, transformlist)
+        overlaps[label] = coords_overlap(
+            [*reference[label][0], *[i + 1 for i in reference[label][1]]],
+            [*candidate[0], *[i + 1 for i in candidate[1]]])
+
+    return overlaps
+
+
+def make_grid(shape: Optional[list],
+              spacing: Optional[list] = None,
+              interpolation: str = "linear") -> Optional[dict]:
+    """Arguments of `grid_crop`, e.g. from the CLI.
+
+    Args:
+        shape (Optional[list]): Shape of the grid, or None for no grid.
+        spacing (Optional[list], optional): Isotropic spacing, or spacing
+            of each axis, in mm. Defaults to None, 1mm.
+        interpolation (str, optional): See `grid_crop`. Defaults to
+            "linear".
+
+    Returns:
+        Optional[dict]: `grid` argument of `crop`
+    """
+    if not shape:
+        return None
+
+    spacing = list(spacing or [1.])
+    assert len(shape) == 3, f"Grid shape {shape} should have 3 values."
+    assert len(spacing) in [1, 3], f"Grid spacing {spacing} should have 1 or 3 values."
+
+    return {
+        "shape": tuple(int(s) for s in shape),
+        "spacing": tuple(float(s) for s in spacing * (3 // len(spacing))),
+        "interpolation": interpolation,
+    }
+
+
+def grid_crop(image: Union[ANTsImage, LazyImage],
+              coords: list,
+              shape: tuple,
+              spacing: tuple,
+              interpolation: str = "linear") -> ANTsImage:
+    """Resample an image on a grid of fixed shape and spacing, centred on
+    coordinates.
+
+    The grid has the orientation of the image, and its voxels outside the
+    image are zero. Only the region of the image covered by the grid is
+    read or resampled.
+
+    Args:
+        image (Union[ANTsImage, LazyImage]): Image, in LPI orientation.
+        coords (list): Coordinates of the ROI, in xyzxyz format.
+        shape (tuple): Shape of the grid, in voxels.
+        spacing (tuple): Spacing of the grid, in mm.
+        interpolation (str, optional): "linear", "nearestNeighbor",
+            "genericLabel" (for label images) or "bSpline".
+            Defaults to "linear".
+
+    Returns:
+        ANTsImage: Resampled crop, of shape `shape`
+    """
+    shape, spacing = np.asarray(shape), np.asarray(spacing, dtype=float)
+    center = (np.asarray(coords[:3]) + np.asarray(coords[3:]) - 1) / 2
+
+    # LazyImage only gives the geometry of its crops
+    image_spacing = (image.crop_indices([0, 0, 0], [1, 1, 1]) if isinstance(
+        image, LazyImage) else image).spacing
+
+    # Region covering the grid, axes of the grid and image being the same
+    half = shape * spacing / 2 / np.asarray(image_spacing)
+    lower = np.clip(np.floor(center - half).astype(int) - 1, 0, None)
+    upper = np.minimum(
+        np.ceil(center + half).astype(int) + 2, image.shape)
+
+    if isinstance(image, LazyImage):
+        region = image.crop_indices(lower.tolist(), upper.tolist())
+    else:
+        region = ants.crop_indices(image, lower.tolist(), upper.tolist())
+
+    direction = np.asarray(region.direction)
+    origin = index_to_physical(region, [center - lower])[0] - direction @ (
+        (shape - 1) / 2 * spacing)
+    target = ants.make_image(shape.tolist(),
+                             spacing=tuple(spacing),
+                             origin=tuple(origin),
+                             direction=direction)
+
+    return ants.resample_image_to_target(region,
+                                         target,
+                                         interp_type=interpolation)
+
+
+def crop(image: Union[ANTsImage, LazyImage],
          coords: list,
          output_path: Optional[PosixPath] = None,
          log_coords: bool = True,
-         ri: bool = False):
+         ri: bool = False,
+         write: Optional[Callable] = None,
+         grid: Optional[dict] = None):
     """Crop an image using coordinates.
 
     Args:
-        image (ANTsImage): image to be cropped
+        image (Union[ANTsImage, LazyImage]): image to be cropped, in LPI
+            orientation. A LazyImage only reads the cropped region.
         coords (list): coordinates of the ROI
         output_path (PosixPath, optional): path to save the cropped image
         log_coords (bool, optional): log the coordinates. Defaults to True.
         ri (bool): if True, return the ROI as an ANTsImage. Defaults to False.
+        write (Callable, optional): function called as
+            `write(cropped_image, output_path)` to write the cropped image,
+            e.g. in the background. Defaults to None, using `ants.image_write`.
+        grid (Optional[dict], optional): Arguments of `grid_crop`
+            ("shape", "spacing" and optionally "interpolation"), to
+            resample the crop on a fixed grid centred on the coordinates.
+            Defaults to None, cropping the coordinates.
     """
     assert all(
         [a <= b for a, b in zip(coords[:3], image.shape)]
@@ -62,13 +419,22 @@ def crop(image: ANTsImage,
         [a <= b for a, b in zip(coords[3:], image.shape)]
     ), f"Coordinates {coords[3:]} out-of-range for image shape {list(image.shape)}. It may indicate a registration problem, or too big margins."
 
-    cropped_image = ants.crop_indices(image,
-                                      lowerind=coords[:3],
-                                      upperind=coords[3:])
+    if grid is not None:
+        cropped_image = grid_crop(image, coords, **grid)
+    elif isinstance(image, LazyImage):
+        cropped_image = image.crop_indices(lowerind=coords[:3],
+                                           upperind=coords[3:])
+    else:
+        cropped_image = ants.crop_indices(image,
+                                          lowerind=coords[:3],
+                                          upperind=coords[3:])
 
     if cropped_image.numpy().any():
         if output_path:
-            ants.image_write(cropped_image, str(output_path), ri=False)
+            if write is None:
+                ants.image_write(cropped_image, str(output_path), ri=False)
+            else:
+                write(cropped_image, output_path)
             if log_coords:
                 np.savetxt(output_path.with_suffix(".txt"), coords)
 
@@ -79,3 +445,107 @@ def crop(image: ANTsImage,
 
     if ri:
         return cropped_image
+
+
+def crop_coords(reference: ANTsImage, cropped: ANTsImage) -> list:
+    """Get the coordinates of a crop in the image it was cropped from.
+
+    Args:
+        reference (ANTsImage): Image the crop comes from
+        cropped (ANTsImage): Crop, in the same voxel grid as `reference`
+
+    Returns:
+        list: Coordinates of the crop in xyzxyz format, upper bounds
+            excluded as in `ants.crop_indices`
+    """
+    lower = np.rint(physical_to_index(reference,
+                                      [cropped.origin])[0]).astype(int)
+    upper = lower + np.array(cropped.shape)
+
+    assert all(lower >= 0) and all(
+        upper <= np.array(reference.shape)
+    ), f"Crop at {lower.tolist()} of shape {list(cropped.shape)} out-of-range for image shape {list(reference.shape)}."
+
+    return [*lower.tolist(), *upper.tolist()]
+
+
+def decrop(images: list,
+           reference: ANTsImage,
+           decrop_is_zero: bool = True) -> ANTsImage:
+    """Paste crops back into a single image, same as successive calls to
+    `ants.decrop_image`.
+
+    Crops are written in place into a single output image, zeroed or copied
+    from `reference`, instead of one full-size image per crop.
+
+    Args:
+        images (list): Crops of `reference` (ANTsImage)
+        reference (ANTsImage): Image the crops come from
+        decrop_is_zero (bool, optional): Whether to paste crops on zeros or
+            on the reference image. Defaults to True.
+
+    Returns:
+        ANTsImage: Image of the reference's geometry, with the pixel type
+            of the crops
+    """
+    return SparseImage(reference,
+                       images).to_image(None if decrop_is_zero else reference)
+
+
+class SparseImage:
+    """Crops of an image with their coordinates, instead of a dense image.
+
+    Args:
+        reference (ANTsImage): Image the crops come from. Only its geometry
+            is kept.
+        images (list): Crops of `reference` (ANTsImage).
+
+    Attributes:
+        patches (list): Coordinates (xyzxyz) and voxels of each crop.
+
+    Exemples:
+        >>> sparse = SparseImage(image, [right_seg, left_seg])
+        >>> for coords, voxels in sparse.patches:
+        ...     ...
+        >>> dense = sparse.to_image()
+    """
+
+    def __init__(self, reference: ANTsImage, images: list):
+        self.shape = reference.shape
+        self.spacing = reference.spacing
+        self.origin = reference.origin
+        self.direction = reference.direction
+        self.pixeltype = images[0].pixeltype
+        self.patches = [(crop_coords(reference, image), image.numpy())
+                        for image in images]
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the voxels of all patches."""
+        return sum(voxels.nbytes for _, voxels in self.patches)
+
+    def to_image(self, reference: Optional[ANTsImage] = None) -> ANTsImage:
+        """Get the dense image.
+
+        Args:
+            reference (Optional[ANTsImage], optional): Image to paste the
+                patches on. Defaults to None, pasting them on zeros.
+
+        Returns:
+            ANTsImage: Dense image
+        """
+        if reference is None:
+            decropped = ants.from_numpy(np.zeros(self.shape,
+                                                 dtype=self.patches[0][1].dtype),
+                                        origin=self.origin,
+                                        spacing=self.spacing,
+                                        direction=self.direction)
+        else:
+            decropped = reference.clone(self.pixeltype)
+
+        voxels = decropped.view()
+        for coords, patch in self.patches:
+            voxels[coords[0]:coords[3], coords[1]:coords[4],
+                   coords[2]:coords[5]] = patch
+
+        return decropped
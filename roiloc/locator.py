@@ -1,13 +1,30 @@
-from typing import Optional
+from __future__ import annotations
+
+import logging
+from typing import TYPE_CHECKING, Optional, Union
 
-import ants
 import numpy as np
-from ants.core import ANTsImage
 
 from ._cache import handle_cache
-from .location import crop, get_coords
-from .registration import get_roi
-from .template import get_atlas, get_mni, get_roi_indices
+from ._lazy import ants
+from .location import (SparseImage, apply_margin, crop, decrop,
+                       get_labels_bbox, transform_labels_bbox)
+from .profiling import Profiler
+from .registration import (MIN_QUALITY, apply_transforms,
+                           center_of_mass_transform, downsample, is_linear,
+                           read_transforms, register_with_fallback)
+from .registry import DEFAULT_TEMPLATE
+from .template import (get_atlas, get_atlas_bboxes, get_mni, get_mni_name,
+                       get_roi_indices)
+from .transformstore import TransformStore
+
+if TYPE_CHECKING:
+    from ants.core import ANTsImage
+
+log = logging.getLogger(__name__)
+
+COORDS_MODES = ["warp", "corners"]
+INIT_MODES = ["none", "com"]
 
 
 class RoiLocator:
@@ -15,7 +32,8 @@ class RoiLocator:
 
     Args:
         contrast (str): Contrast to use for registration.
-        roi (str): ROI to use for registration.
+        roi (Union[str, list]): ROI to locate, or list of ROIs to locate
+            from a single registration.
         bet (bool, optional): Use brain extracted MNI template. Defaults to False.
         transform_type (str, optional): Type of transformation for the registration.
                                         Defaults to "AffineFast".
@@ -24,14 +42,55 @@ class RoiLocator:
         leftoffset (list, optional): Offset to apply to the left hippocampus. Defaults to [0, 0, 0].
         mask (Optional[ANTsImage], optional): Brain mask to improve registration quality.
                                               Defaults to None.
+        transform_store (Optional[TransformStore], optional): Persistent store
+            to reuse the transforms of images already registered.
+            Defaults to None.
+        coords_mode (str, optional): How to locate ROIs in native space.
+            "warp" resamples the whole atlas in native space, "corners"
+            only transforms the corners of the ROIs' bounding boxes, which
+            is much faster but slightly conservative, and only available for
+            linear transforms. Defaults to "warp".
+        registration_resolution (Optional[float], optional): Resolution in mm
+            at which images are registered, e.g. 2. or 3. for a fast
+            registration. Transforms are still applied at native resolution.
+            Defaults to None, registering at full resolution.
+        profiler (Optional[Profiler], optional): Profiler recording the
+            time and memory of each stage. Defaults to None, not profiling.
+        in_memory (bool, optional): Keep the registration transforms in
+            memory as ANTsTransform, instead of paths of files removed after
+            `fit` (unless a transform store is used). Inverse transforms are
+            then already inverted. Defaults to False.
+        template (str, optional): Templates and atlas to register to, as a
+            name or a JSON file, see `roiloc.registry`. Defaults to the MNI
+            ICBM152 09c templates and CerebrA atlas.
+        init (str, optional): Initialization of the registration. "none"
+            aligns the centers of mass of the intensities, "com" the
+            centers of the heads' foregrounds, which is robust to a large
+            field of view (e.g. neck coverage), see
+            `registration.center_of_mass_transform`. Defaults to "none".
+        fallback (list, optional): Types of transform tried in turn when
+            the quality of the registration is below `min_quality`, e.g.
+            ["Affine", "SyNRA"]. Defaults to [].
+        min_quality (float, optional): Quality from which a registration is
+            accepted, see `registration.registration_quality`. Defaults to
+            MIN_QUALITY.
 
     Attributes:
         coords (dict): Dictionary of coordinates for each side of the ROI.
-        _fwdtransforms (list): List of forward transforms.
-        _invtransforms (list): List of inverse transforms.
-        _mni (ANTsImage): MNI template.
-        _atlas (ANTsImage): CerebrA atlas image.
-        _roi_idx (list): List of indices for the ROI in the CerebrA atlas.
+            If several ROIs are given, dictionary of such dictionaries for
+            each ROI.
+        rois (list): ROIs to locate.
+        quality (Optional[float]): Quality of the last registration, None if
+            its transforms came from the transform store.
+        attempts (list): Type of transform, quality and wall time of each
+            registration tried for the last image.
+        _fwdtransforms (list): List of forward transforms, paths or
+            ANTsTransform.
+        _invtransforms (list): List of inverse transforms, paths or
+            ANTsTransform.
+        _mni (ANTsImage): MNI template, shared read-only between locators.
+        _atlas (ANTsImage): CerebrA atlas image, shared read-only between locators.
+        _rois_idx (dict): Right and left indices of each ROI in the CerebrA atlas.
         _image (ANTsImage): Input image used to inverse transform.
 
     Exemples:
@@ -40,25 +99,55 @@ class RoiLocator:
 
     def __init__(self,
                  contrast: str,
-                 roi: str,
+                 roi: Union[str, list],
                  bet: bool = False,
                  transform_type: str = "AffineFast",
                  margin: list = [8, 8, 8],
                  rightoffset: list = [0, 0, 0],
                  leftoffset: list = [0, 0, 0],
-                 mask: Optional[ANTsImage] = None):
+                 mask: Optional[ANTsImage] = None,
+                 transform_store: Optional[TransformStore] = None,
+                 coords_mode: str = "warp",
+                 registration_resolution: Optional[float] = None,
+                 profiler: Optional[Profiler] = None,
+                 in_memory: bool = False,
+                 template: str = DEFAULT_TEMPLATE,
+                 init: str = "none",
+                 fallback: list = [],
+                 min_quality: float = MIN_QUALITY):
+        assert coords_mode in COORDS_MODES, f"coords_mode must be one of {COORDS_MODES}"
+        assert init in INIT_MODES, f"init must be one of {INIT_MODES}"
 
+        self.contrast = contrast
+        self.bet = bet
         self.transform_type = transform_type
         self.margin = margin
         self.rightoffset = rightoffset
         self.leftoffset = leftoffset
         self.mask = mask
+        self.transform_store = transform_store
+        self.coords_mode = coords_mode
+        self.registration_resolution = registration_resolution
+        self.profiler = profiler or Profiler(enabled=False)
+        self.in_memory = in_memory
+        self.template = template
+        self.init = init
+        self.fallback = list(fallback)
+        self.min_quality = min_quality
 
-        self._roi_idx = get_roi_indices(roi)
-        self._mni = get_mni(contrast, bet)
-        self._atlas = get_atlas()
+        self._multi = not isinstance(roi, str)
+        self.rois = list(roi) if self._multi else [roi]
+
+        with self.profiler.stage("template"):
+            self._rois_idx = {
+                r: get_roi_indices(r, template) for r in self.rois
+            }
+            self._mni = get_mni(contrast, bet, template=template)
+            self._atlas = get_atlas(template=template)
 
         self._image = None
+        self.quality = None
+        self.attempts = []
         self._fwdtransforms = None
         self._invtransforms = None
         self.coords = {}
@@ -81,75 +170,228 @@ class RoiLocator:
         """
         self._image = image
 
-        registration = ants.registration(fixed=image,
-                                         moving=self._mni,
-                                         type_of_transform=self.transform_type,
-                                         mask=self.mask,
-                                         outprefix=outprefix)
+        template = get_mni_name(self.contrast, self.bet, self.template)
+        if self.registration_resolution:
+            template += f"@{self.registration_resolution}mm"
+
+        registration = None
+        self.quality = None
+        self.attempts = []
+        if self.transform_store is not None:
+            transform_type = self.transform_type if self.init == "none" else (
+                f"{self.transform_type}+{self.init}")
+            if self.fallback:
+                transform_type += (f">{'>'.join(self.fallback)}"
+                                   f"@{self.min_quality}")
+            key = self.transform_store.key(image, template, transform_type,
+                                           self.mask)
+            registration = self.transform_store.get(key)
+
+        if registration is None:
+            fixed, moving, mask = image, self._mni, self.mask
+            if self.registration_resolution:
+                # Transforms are defined in physical space, so that they
+                # still apply at native resolution
+                fixed = downsample(image, self.registration_resolution)
+                moving = get_mni(self.contrast,
+                                 self.bet,
+                                 resolution=self.registration_resolution,
+                                 template=self.template)
+                if mask is not None:
+                    mask = downsample(mask,
+                                      self.registration_resolution,
+                                      interpolation="nearestNeighbor")
+
+            initial_transform = None
+            if self.init == "com":
+                with self.profiler.stage("initialization"):
+                    initial_transform = center_of_mass_transform(
+                        fixed, moving, outprefix=outprefix)
+
+            with self.profiler.stage("registration"):
+                registration = register_with_fallback(
+                    fixed,
+                    moving, [self.transform_type, *self.fallback],
+                    self.min_quality,
+                    mask=mask,
+                    outprefix=outprefix,
+                    initial_transform=initial_transform)
+            self.quality = registration["quality"]
+            self.attempts = registration["attempts"]
+
+            if self.transform_store is not None:
+                registration = self.transform_store.put(key, registration)
 
         self._fwdtransforms = registration["fwdtransforms"]
         self._invtransforms = registration["invtransforms"]
+        if self.in_memory:
+            # Read before the temporary files are removed
+            self._fwdtransforms = read_transforms(self._fwdtransforms)
+            self._invtransforms = read_transforms(
+                self._invtransforms,
+                whichtoinvert=[is_linear(t) for t in self._invtransforms])
+
+        labels = [int(i) for idx in self._rois_idx.values() for i in idx]
+        linear = all(is_linear(t) for t in self._fwdtransforms)
+
+        if self.coords_mode == "corners" and linear:
+            with self.profiler.stage("get_coords"):
+                boxes = transform_labels_bbox(
+                    get_atlas_bboxes(template=self.template), labels,
+                    self._atlas, image, self._fwdtransforms)
+                self._locate(boxes, image.shape)
+            return
+
+        if self.coords_mode == "corners":
+            log.warning("Non-linear transforms, falling back to warping "
+                        "the whole atlas to locate ROIs.")
+
+        with self.profiler.stage("apply_transforms"):
+            registered_atlas = apply_transforms(
+                fixed=image,
+                moving=self._atlas,
+                transformlist=self._fwdtransforms,
+                interpolator="nearestNeighbor")
+
+        with self.profiler.stage("get_coords"):
+            boxes = get_labels_bbox(registered_atlas.numpy(), labels)
+            self._locate(boxes, image.shape)
 
-        registered_atlas = ants.apply_transforms(
-            fixed=image,
-            moving=self._atlas,
-            transformlist=self._fwdtransforms,
-            interpolator="nearestNeighbor")
+    def _locate(self, boxes: dict, shape: tuple):
+        """Set the coords of all ROIs from their boxes in native space.
 
-        for i, side in enumerate(["right", "left"]):
-            region = get_roi(registered_atlas=registered_atlas,
-                             idx=int(self._roi_idx[i]),
-                             save=False)
-            offset = self.rightoffset if side == "right" else self.leftoffset
-            coords = get_coords(region.numpy(),
-                                margin=self.margin,
-                                offset=offset)
+        Args:
+            boxes (dict): Inclusive minimum and maximum indices of each label.
+            shape (tuple): Shape of the native image.
+        """
+
+        coords = {}
+        for roi, idx in self._rois_idx.items():
+            coords[roi] = {}
+            for i, side in enumerate(["right", "left"]):
+                bbox = boxes[int(idx[i])]
+                if bbox is None:
+                    raise ValueError(
+                        f"{roi} ({side}) not found in the registered atlas. "
+                        "It may indicate a registration problem.")
+
+                offset = self.rightoffset if side == "right" else self.leftoffset
+                coords[roi][side] = apply_margin(bbox,
+                                                 shape,
+                                                 margin=self.margin,
+                                                 offset=offset)
 
-            self.coords[side] = coords
+        self.coords = coords if self._multi else coords[self.rois[0]]
 
-    def transform(self, image: ANTsImage) -> list:
+    def transform(self,
+                  image: ANTsImage,
+                  grid: Optional[dict] = None) -> Union[list, dict]:
         """Crop the image to the ROI.
 
         Args:
             image (ANTsImage): Image to transform.
+            grid (Optional[dict], optional): Shape, spacing and optionally
+                interpolation of a fixed grid on which crops are resampled,
+                centred on the ROIs, e.g. `{"shape": (64, 64, 64),
+                "spacing": (1., 1., 1.)}`, see `location.grid_crop`.
+                Defaults to None, cropping the ROIs' coordinates.
 
         Returns:
-            list: List of transformed images.
+            Union[list, dict]: List of transformed images (right, left).
+                If several ROIs are given, dictionary of such lists for
+                each ROI.
         """
-        return [
-            crop(image, self.coords[side], log_coords=False, ri=True)
-            for side in ["right", "left"]
-        ]
+        with self.profiler.stage("crop"):
+            if self._multi:
+                return {
+                    roi: [
+                        crop(image,
+                             coords[side],
+                             log_coords=False,
+                             ri=True,
+                             grid=grid) for side in ["right", "left"]
+                    ] for roi, coords in self.coords.items()
+                }
 
-    def fit_transform(self, image: ANTsImage) -> list:
+            return [
+                crop(image,
+                     self.coords[side],
+                     log_coords=False,
+                     ri=True,
+                     grid=grid) for side in ["right", "left"]
+            ]
+
+    def fit_transform(self, image: ANTsImage) -> Union[list, dict]:
         """Fit the ROI to the image and transform.
 
         Args:
             image (ANTsImage): Image to fit the ROI to.
 
         Returns:
-            list: List of transformed images.
+            Union[list, dict]: Transformed images, see `transform`.
         """
         self.fit(image)
         return self.transform(image)
 
+    def warp(self,
+             image: ANTsImage,
+             inverse: bool = False,
+             interpolator: str = "linear") -> ANTsImage:
+        """Warp an image between the template and the fitted image.
+
+        Transforms must still be available, i.e. kept `in_memory` or in a
+        transform store.
+
+        Args:
+            image (ANTsImage): Image to warp, in template space, or in the
+                fitted image's space if `inverse`.
+            inverse (bool, optional): Warp from the fitted image to the
+                template. Defaults to False.
+            interpolator (str, optional): "linear" or "nearestNeighbor".
+                Defaults to "linear".
+
+        Returns:
+            ANTsImage: Warped image
+        """
+        if inverse:
+            transforms = read_transforms(
+                self._invtransforms,
+                whichtoinvert=None if self.in_memory else
+                [is_linear(t) for t in self._invtransforms])
+            fixed = self._mni
+        else:
+            transforms = read_transforms(self._fwdtransforms)
+            fixed = self._image
+
+        return apply_transforms(fixed, image, transforms, interpolator)
+
     def inverse_transform(self,
-                          image: ANTsImage,
-                          decrop_is_zero: bool = True) -> ANTsImage:
+                          image: Union[ANTsImage, list, dict],
+                          decrop_is_zero: bool = True,
+                          sparse: bool = False) -> Union[ANTsImage,
+                                                         SparseImage]:
         """Inverse transform the image to the native space.
 
         Args:
-            image (ANTsImage): Image to inverse transform.
+            image (Union[ANTsImage, list, dict]): Image to inverse transform,
+                or several ones (e.g. the right and left crops, as returned
+                by `transform`) to paste into a single native-space image.
             decrop_is_zero (bool, optional): Whether to decrop the image with
                 zeros or original tissue. Defaults to True.
+            sparse (bool, optional): Return the crops with their coordinates
+                in native space instead of a dense image. Defaults to False.
 
         Returns:
-            ANTsImage: Inverse transformed image.
+            Union[ANTsImage, SparseImage]: Inverse transformed image.
         """
-        if decrop_is_zero:
-            reference = self._image.new_image_like(
-                np.zeros_like(self._image.numpy()))
+        if isinstance(image, dict):
+            images = [i for crops in image.values() for i in crops]
+        elif isinstance(image, (list, tuple)):
+            images = list(image)
         else:
-            reference = self._image
+            images = [image]
+
+        if sparse:
+            return SparseImage(self._image, images)
 
-        return ants.decrop_image(image, reference)
+        return decrop(images, self._image, decrop_is_zero=decrop_is_zero)
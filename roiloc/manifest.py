@@ -0,0 +1,251 @@
+"""
+Manifest of the subjects processed by the `roiloc` CLI, to resume runs.
+
+The manifest is an append-only JSONL file with one record per processed
+subject: hashes of its input files, parameters of the run, written outputs
+and status. A subject is complete for a run if a successful record exists
+with the same inputs and parameters, and all its outputs still exist.
+
+Subjects, input files and outputs are recorded by their absolute path, so that runs
+can be resumed from any directory. Inputs are only hashed once a subject is
+processed (e.g. in the worker which processed it), or to look up a subject
+recorded in the manifest.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+# CLI arguments that change the outputs of a subject
+OUTPUT_PARAMS = [
+    "contrast", "bet", "transform", "init", "fallback", "minquality", "roi",
+    "margin", "rightoffset", "leftoffset", "mask", "extracrops", "savesteps",
+    "outputformat", "gridshape", "gridspacing", "gridinterpolation",
+    "coordsmode", "regresolution", "coords_only", "template", "group_by",
+    "group_reference"
+]
+
+
+def file_hash(path: str) -> str:
+    """Hash the content of a file.
+
+    Args:
+        path (str): Path of the file.
+
+    Returns:
+        str: Hex digest
+    """
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024**2), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def fingerprint(files: list, known: Optional[dict] = None) -> dict:
+    """Hash input files.
+
+    Args:
+        files (list): Paths of the input files of a subject.
+        known (Optional[dict], optional): Size, modification time and hash
+            of files already hashed, by path. Unchanged files are not hashed
+            again. Defaults to None.
+
+    Returns:
+        dict: Size, modification time and hash of each file
+    """
+    known = known or {}
+    inputs = {}
+    for file in files:
+        stat = os.stat(file)
+        info = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+        previous = known.get(str(file))
+        if previous and (previous["size"],
+                         previous["mtime"]) == (info["size"], info["mtime"]):
+            info["hash"] = previous["hash"]
+        else:
+            info["hash"] = file_hash(file)
+        inputs[str(file)] = info
+
+    return inputs
+
+
+class RunManifest:
+    """Append-only record of processed subjects.
+
+    Records can be appended and looked up from several threads, e.g. the
+    writer threads of the streaming pipeline.
+
+    Args:
+        path (str): Path of the JSONL manifest, created if needed.
+
+    Exemples:
+        >>> manifest = RunManifest("data/roiloc_manifest.jsonl")
+        >>> inputs = manifest.fingerprint([image_path])
+        >>> key = manifest.key(inputs, params)
+        >>> if not manifest.is_done(image_path, key):
+        ...     outputs = process(image_path)
+        ...     manifest.record(image_path, key, inputs, params, outputs)
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path).expanduser()
+        self._done = {}
+        self._subjects = {}
+        self._stats = {}
+        self._lock = threading.RLock()
+
+        if self.path.exists():
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        self._load(json.loads(line))
+                    except json.JSONDecodeError:
+                        # Last line of an interrupted run
+                        continue
+
+    def _load(self, record: dict):
+        subject = record["subject"]
+        if record["status"] == "done":
+            if (subject, record["key"]) not in self._done:
+                self._subjects[subject] = self._subjects.get(subject, 0) + 1
+            self._done[(subject, record["key"])] = record
+        elif self._done.pop((subject, record["key"]), None) is not None:
+            self._subjects[subject] -= 1
+
+        for file, info in record["inputs"].items():
+            self._stats[file] = info
+
+    def fingerprint(self, files: list) -> dict:
+        """Hash input files.
+
+        Files whose size and modification time are unchanged since they
+        were last recorded are not hashed again.
+
+        Args:
+            files (list): Paths of the input files of a subject.
+
+        Returns:
+            dict: Size, modification time and hash of each file
+        """
+        return fingerprint(files, self._stats)
+
+    def has_done(self, subject: str) -> bool:
+        """Whether a subject has a successful record, with any inputs and
+        parameters, i.e. whether looking it up is worth hashing its inputs.
+
+        Args:
+            subject (str): Subject, e.g. the path of its image.
+
+        Returns:
+            bool: True if the subject was processed successfully before
+        """
+        with self._lock:
+            return self._subjects.get(str(subject), 0) > 0
+
+    @staticmethod
+    def key(inputs: dict, params: dict) -> str:
+        """Key of a subject's inputs and run parameters.
+
+        Args:
+            inputs (dict): Output of `fingerprint`.
+            params (dict): Parameters changing the outputs.
+
+        Returns:
+            str: Hex digest
+        """
+        content = {
+            "inputs": {
+                file: info["hash"] for file, info in inputs.items()
+            },
+            "params": params,
+        }
+        return hashlib.blake2b(json.dumps(content, sort_keys=True).encode(),
+                               digest_size=20).hexdigest()
+
+    def get(self, subject: str, key: str) -> Optional[dict]:
+        """Get the successful record of a subject, if any.
+
+        Args:
+            subject (str): Subject, e.g. the path of its image.
+            key (str): Output of `key`.
+
+        Returns:
+            Optional[dict]: Record of the subject
+        """
+        with self._lock:
+            return self._done.get((str(subject), key))
+
+    def is_done(self, subject: str, key: str) -> bool:
+        """Whether a subject was processed with the same inputs and
+        parameters, and its outputs still exist.
+
+        Args:
+            subject (str): Subject, e.g. the path of its image.
+            key (str): Output of `key`.
+
+        Returns:
+            bool: True if the subject can be skipped
+        """
+        with self._lock:
+            record = self.get(subject, key)
+            if record is None:
+                return False
+
+            return all(
+                os.path.exists(output) for output in record["outputs"])
+
+    def record(self,
+               subject: str,
+               key: str,
+               inputs: dict,
+               params: dict,
+               outputs: Optional[list] = None,
+               status: str = "done",
+               error: str = "",
+               coords: Optional[list] = None,
+               attempts: Optional[list] = None):
+        """Append a subject's record to the manifest.
+
+        Args:
+            subject (str): Subject, e.g. the path of its image.
+            key (str): Output of `key`.
+            inputs (dict): Output of `fingerprint`.
+            params (dict): Parameters of the run.
+            outputs (Optional[list], optional): Paths of the written files.
+                Defaults to None.
+            status (str, optional): "done" or "failed". Defaults to "done".
+            error (str, optional): Error message of a failed subject.
+                Defaults to "".
+            coords (Optional[list], optional): Rows of the coordinates
+                table of the subject, see `coords.coords_row`. Defaults to
+                None.
+            attempts (Optional[list], optional): Registrations tried for
+                the subject, see `registration.register_with_fallback`.
+                Defaults to None.
+        """
+        record = {
+            "subject": str(subject),
+            "key": key,
+            "status": status,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "inputs": inputs,
+            "params": params,
+            "outputs": [os.path.abspath(o) for o in outputs or []],
+            "error": error,
+            "coords": coords or [],
+            "attempts": attempts or [],
+        }
+
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+            self._load(record)
@@ -0,0 +1,135 @@
+"""
+Synthetic phantoms with known ROI locations, for benchmarks and tests.
+
+A phantom is the bundled MNI template deformed by a known affine transform
+and resampled on a grid of given shape and spacing. The CerebrA atlas
+deformed the same way gives the ground-truth location of every ROI.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, NamedTuple, Optional
+
+import numpy as np
+
+from ._lazy import ants
+from .location import get_labels_bbox, index_to_physical
+from .reader import LPI_DIRECTION
+from .template import get_atlas, get_mni
+
+if TYPE_CHECKING:
+    from ants.core import ANTsImage, ANTsTransform
+
+
+class Phantom(NamedTuple):
+    """Synthetic subject.
+
+    Attributes:
+        image (ANTsImage): Deformed template, in LPI orientation.
+        atlas (ANTsImage): Deformed atlas, on the grid of `image`.
+        transform (ANTsTransform): Transform mapping points of `image` to
+            the template.
+    """
+    image: ANTsImage
+    atlas: ANTsImage
+    transform: ANTsTransform
+
+    def labels_bbox(self, labels: list) -> dict:
+        """Ground-truth bounding boxes of labels, see `get_labels_bbox`."""
+        return get_labels_bbox(self.atlas.numpy(), labels)
+
+
+def random_affine(center: list,
+                  seed: int = 0,
+                  max_rotation: float = 10.,
+                  max_translation: float = 10.,
+                  max_scaling: float = .1) -> ANTsTransform:
+    """Draw a random affine transform.
+
+    Args:
+        center (list): Center of rotation and scaling, in physical space.
+        seed (int, optional): Random seed. Defaults to 0.
+        max_rotation (float, optional): Maximum rotation around each axis,
+            in degrees. Defaults to 10.
+        max_translation (float, optional): Maximum translation along each
+            axis, in mm. Defaults to 10.
+        max_scaling (float, optional): Maximum relative scaling along each
+            axis. Defaults to .1.
+
+    Returns:
+        ANTsTransform: Affine transform
+    """
+    rng = np.random.default_rng(seed)
+
+    matrix = np.eye(3)
+    for axis, angle in enumerate(
+            np.deg2rad(rng.uniform(-max_rotation, max_rotation, 3))):
+        i, j = [a for a in range(3) if a != axis]
+        rotation = np.eye(3)
+        rotation[[i, i, j, j], [i, j, i, j]] = [
+            np.cos(angle), -np.sin(angle),
+            np.sin(angle), np.cos(angle)
+        ]
+        matrix = rotation @ matrix
+    matrix = matrix @ np.diag(1 + rng.uniform(-max_scaling, max_scaling, 3))
+
+    return ants.create_ants_transform(
+        transform_type="AffineTransform",
+        dimension=3,
+        matrix=matrix,
+        translation=rng.uniform(-max_translation, max_translation,
+                                3).tolist(),
+        center=[float(c) for c in center])
+
+
+def make_phantom(contrast: str = "t1",
+                 bet: bool = False,
+                 shape: Optional[tuple] = None,
+                 spacing: Optional[tuple] = None,
+                 seed: int = 0,
+                 **kwargs) -> Phantom:
+    """Deform the MNI template and CerebrA atlas with a random affine.
+
+    Args:
+        contrast (str, optional): Contrast of the template. Defaults to "t1".
+        bet (bool, optional): Use the brain extracted template.
+            Defaults to False.
+        shape (Optional[tuple], optional): Shape of the phantom. Defaults to
+            None, covering the template's field of view.
+        spacing (Optional[tuple], optional): Spacing of the phantom in mm.
+            Defaults to None, the spacing of the template.
+        seed (int, optional): Seed of the transform. Defaults to 0.
+        **kwargs: Bounds of the transform, see `random_affine`.
+
+    Returns:
+        Phantom: Deformed template and atlas, with the transform used
+    """
+    mni = get_mni(contrast, bet)
+    atlas = get_atlas()
+
+    extent = np.array(mni.shape) * np.array(mni.spacing)
+    spacing = np.array(spacing if spacing is not None else mni.spacing,
+                       dtype=float)
+    shape = tuple(shape) if shape is not None else tuple(
+        np.round(extent / spacing).astype(int))
+
+    # Center of the template's field of view, in physical space
+    center = index_to_physical(mni, [(np.array(mni.shape) - 1) / 2])[0]
+    # Grid centered on the template, in LPI orientation
+    origin = np.array(center) - LPI_DIRECTION @ (spacing *
+                                                 (np.array(shape) - 1) / 2)
+    reference = ants.make_image(shape,
+                                spacing=tuple(spacing),
+                                origin=tuple(origin),
+                                direction=LPI_DIRECTION)
+
+    transform = random_affine(center, seed=seed, **kwargs)
+
+    return Phantom(
+        image=transform.apply_to_image(mni,
+                                       reference=reference,
+                                       interpolation="linear"),
+        atlas=transform.apply_to_image(atlas,
+                                       reference=reference,
+                                       interpolation="nearestneighbor"),
+        transform=transform)
@@ -0,0 +1,308 @@
+"""
+Streaming stages of the `roiloc` CLI.
+
+Subjects are read ahead in a background thread and crops are written by
+others, both through bounded queues, while the main thread registers.
+ANTs holds the GIL during its calls, so the costly part of both stages,
+gzip decoding and encoding, is done with Python's zlib, which releases it.
+
+Crops are written as NIfTI files, gzipped or not, or gathered in a single
+`.npz` archive per subject (see `write_archive`), avoiding many small files
+on shared filesystems.
+"""
+
+from __future__ import annotations
+
+import gzip
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import uuid
+from concurrent.futures import Future
+from pathlib import Path
+from typing import (TYPE_CHECKING, Callable, Iterable, Iterator, Optional,
+                    Union)
+
+import numpy as np
+
+from ._lazy import ants
+
+if TYPE_CHECKING:
+    from ants.core import ANTsImage
+
+
+_DONE = object()
+
+
+def decompress(path: Path, scratch_dir: str) -> Path:
+    """Decompress a gzipped image into a scratch directory.
+
+    Args:
+        path (Path): Path of the image.
+        scratch_dir (str): Directory receiving the decompressed image.
+
+    Returns:
+        Path: Path of the uncompressed image, `path` itself if it is not
+            gzipped
+    """
+    if not str(path).endswith(".gz"):
+        return path
+
+    output = Path(scratch_dir) / Path(path).name[:-len(".gz")]
+    with gzip.open(path, "rb") as src, open(output, "wb") as dst:
+        shutil.copyfileobj(src, dst, length=1024**2)
+
+    return output
+
+
+def _temporary_path(path: str) -> str:
+    """Hidden, unique path next to `path`, with the same extension.
+
+    Unlike `tempfile.mkstemp`, the file is created by its writer, with the
+    permissions given by the umask.
+    """
+    path = Path(path)
+    # Suffixes, e.g. ".nii.gz", give its format to ITK
+    suffix = "".join(path.suffixes[-2:] if path.suffix == ".gz" else
+                     path.suffixes[-1:])
+
+    return str(path.parent / f".{uuid.uuid4().hex}{suffix}")
+
+
+def write_image(image: Union[ANTsImage, dict],
+                path: str,
+                compresslevel: int = 6,
+                scratch_dir: Optional[str] = None):
+    """Write an image, gzipping it with Python's zlib if needed.
+
+    The image is written to a temporary file in the output directory, then
+    renamed, so that a failed or interrupted write leaves no partial file.
+
+    Args:
+        image (Union[ANTsImage, dict]): Image to write, or crops of an
+            archive if `path` ends with `.npz`, see `write_archive`.
+        path (str): Output path, compressed if it ends with `.gz`.
+        compresslevel (int, optional): Gzip compression level, 0 to 9.
+            Defaults to 6.
+        scratch_dir (Optional[str], optional): Directory for the
+            uncompressed temporary file. Defaults to None, using the
+            output directory.
+    """
+    path = str(path)
+    if path.endswith(".npz"):
+        write_archive(image, path, compress=compresslevel > 0)
+        return
+
+    output = _temporary_path(path)
+    try:
+        if not path.endswith(".gz"):
+            ants.image_write(image, output)
+        else:
+            fd, tmp = tempfile.mkstemp(
+                suffix=".nii", dir=scratch_dir or os.path.dirname(path))
+            os.close(fd)
+            try:
+                ants.image_write(image, tmp)
+                with open(tmp, "rb") as src, gzip.open(
+                        output, "wb", compresslevel=compresslevel) as dst:
+                    shutil.copyfileobj(src, dst, length=1024**2)
+            finally:
+                os.remove(tmp)
+        os.replace(output, path)
+    except BaseException:
+        if os.path.exists(output):
+            os.remove(output)
+        raise
+
+
+def write_archive(crops: dict, path: str, compress: bool = True):
+    """Write crops and their coordinates in a single `.npz` archive.
+
+    For each crop `<key>`, the archive has its voxels as `<key>`, its
+    coordinates in the cropped image (xyzxyz) as `<key>.coords`, and its
+    geometry as `<key>.origin`, `<key>.spacing` and `<key>.direction`.
+
+    Args:
+        crops (dict): Crop (ANTsImage) and coordinates of each key, e.g.
+            `{"t1_Hippocampus_right": (cropped_image, coords)}`.
+        path (str): Output path, ending with `.npz`.
+        compress (bool, optional): Whether to deflate the arrays.
+            Defaults to True.
+    """
+    arrays = {}
+    for key, (image, coords) in crops.items():
+        arrays[key] = image.numpy()
+        arrays[f"{key}.coords"] = np.asarray(coords, dtype=np.int64)
+        arrays[f"{key}.origin"] = np.asarray(image.origin)
+        arrays[f"{key}.spacing"] = np.asarray(image.spacing)
+        arrays[f"{key}.direction"] = np.asarray(image.direction)
+
+    # Written atomically, so that an interrupted run leaves no archive
+    tmp = _temporary_path(path)
+    try:
+        with open(tmp, "wb") as f:
+            (np.savez_compressed if compress else np.savez)(f, **arrays)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def read_archive(path: str) -> dict:
+    """Read the crops of an archive written by `write_archive`.
+
+    Args:
+        path (str): Path of the `.npz` archive.
+
+    Returns:
+        dict: Crop (ANTsImage) and coordinates of each key
+    """
+    crops = {}
+    with np.load(path) as arrays:
+        for key in arrays.files:
+            if "." in key:
+                continue
+            image = ants.from_numpy(
+                arrays[key],
+                origin=arrays[f"{key}.origin"].tolist(),
+                spacing=arrays[f"{key}.spacing"].tolist(),
+                direction=arrays[f"{key}.direction"])
+            crops[key] = (image, arrays[f"{key}.coords"].tolist())
+
+    return crops
+
+
+def prefetch(iterable: Iterable, size: int = 1) -> Iterator:
+    """Consume an iterable in a background thread, ahead of its consumer.
+
+    Args:
+        iterable (Iterable): Iterable to prefetch, e.g. a generator reading
+            subjects.
+        size (int, optional): Maximum number of items buffered.
+            Defaults to 1.
+
+    Yields:
+        Items of `iterable`, in order. Exceptions raised while producing an
+        item are raised by the consumer instead.
+    """
+    buffer = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                buffer.put((item, None))
+        except Exception as e:
+            buffer.put((None, e))
+        buffer.put((_DONE, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+        # Unblock the producer if it is waiting on a full buffer
+        while thread.is_alive():
+            try:
+                buffer.get_nowait()
+            except queue.Empty:
+                thread.join(timeout=.1)
+
+
+class AsyncWriter:
+    """Run write tasks in background threads, through a bounded queue.
+
+    Tasks start in submission order, but run concurrently with more than one
+    worker: a task depending on others should wait for their futures.
+
+    Args:
+        maxsize (int, optional): Maximum number of pending tasks, `submit`
+            blocking beyond. Defaults to 8.
+        workers (int, optional): Number of writer threads. Defaults to 1.
+        raise_errors (bool, optional): Raise the errors of tasks on the
+            next `submit` and on `close`. With False, they are only set on
+            the tasks' futures, to be checked by the caller. Defaults to
+            True.
+
+    Exemples:
+        >>> with AsyncWriter(workers=4) as writer:
+        ...     writer.submit(write_image, cropped, "crop.nii.gz")
+    """
+
+    def __init__(self,
+                 maxsize: int = 8,
+                 workers: int = 1,
+                 raise_errors: bool = True):
+        assert workers >= 1, "At least one writer thread is needed."
+
+        self.raise_errors = raise_errors
+        self._tasks = queue.Queue(maxsize=maxsize)
+        self._errors = []
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True)
+            for _ in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is _DONE:
+                return
+
+            future, func, args, kwargs = task
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+                if self.raise_errors:
+                    self._errors.append(e)
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        """Queue a task, blocking while the queue is full.
+
+        Args:
+            func (Callable): Function to run in a writer thread.
+            *args, **kwargs: Arguments of `func`.
+
+        Returns:
+            Future: Result of the task
+        """
+        if self._errors:
+            raise self._errors.pop(0)
+
+        future = Future()
+        self._tasks.put((future, func, args, kwargs))
+
+        return future
+
+    def close(self):
+        """Wait for pending tasks, and raise the first error if any."""
+        alive = [t for t in self._threads if t.is_alive()]
+        for _ in alive:
+            self._tasks.put(_DONE)
+        for thread in alive:
+            thread.join()
+
+        if self._errors:
+            raise self._errors.pop(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
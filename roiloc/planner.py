@@ -0,0 +1,592 @@
+"""
+Dry-run planning of large cohorts, `roiloc --plan`.
+
+Images are found as by a run, but only their headers are read, for their
+shape and spacing. The processing time, memory peak and output size of each
+subject are then estimated from a calibration table, and a number of jobs
+and ITK threads is recommended:
+
+    roiloc -p data -i "*/t1.nii.gz" -c t1 --extracrops "*t2*" --plan
+
+The calibration table is built once per machine and configuration (contrast,
+template, transforms, output format, ...) by a local benchmark processing
+synthetic phantoms of two sizes (see `roiloc.phantom`), each one in a fresh
+worker process as `--jobs` would. Times and memory peaks are assumed to be
+affine in the number of voxels, and the speedup of ITK threads to follow
+Amdahl's law. Tables are stored in `$ROILOC_CALIBRATION`, or in
+`$XDG_CACHE_HOME/roiloc/calibration.json` (`~/.cache/roiloc`).
+"""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import heapq
+import json
+import os
+import struct
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from rich import print
+
+from . import __version__
+from ._cache import PIXELTYPE_SIZES
+from .profiling import Profiler, peak_rss
+from .scheduler import run_parallel
+
+CALIBRATION_ENV = "ROILOC_CALIBRATION"
+
+# Parameters on which the cost of a subject depends
+CALIBRATION_PARAMS = [
+    "contrast", "bet", "template", "transform", "init", "fallback",
+    "minquality", "regresolution", "coordsmode", "savesteps", "coords_only",
+    "outputformat", "compresslevel", "gridshape", "gridspacing",
+    "gridinterpolation"
+]
+
+# Spacings in mm of the phantoms of the calibration
+CALIBRATION_SPACINGS = (2., 1.)
+
+# Registrations whose transforms are matrices, others add displacement fields
+LINEAR_TRANSFORMS = [
+    "Translation", "Rigid", "Similarity", "QuickRigid", "DenseRigid",
+    "BOLDRigid", "Affine", "AffineFast", "BOLDAffine", "TRSAA"
+]
+
+# Share of the available memory the workers are planned to use
+MEMORY_SHARE = .8
+
+
+def read_header(path: str) -> dict:
+    """Read the shape and voxel size of an image from its header only.
+
+    NIfTI-1 and NIfTI-2 headers, gzipped or not, are parsed directly (only
+    the header of a gzipped file is decompressed), other formats are read
+    by ITK with `ants.image_header_info`.
+
+    Args:
+        path (str): Path of the image.
+
+    Returns:
+        dict: Shape, spacing in mm, and size in bytes of the voxels
+            ("nbytes") of the image, and size of its file ("filesize")
+    """
+    path = str(path)
+    header = None
+    if path.endswith((".nii", ".nii.gz")):
+        with (gzip.open if path.endswith(".gz") else open)(path, "rb") as f:
+            header = _parse_nifti_header(f.read(540))
+
+    if header is None:
+        from ._lazy import ants
+
+        info = ants.image_header_info(path)
+        header = {
+            "shape": tuple(int(d) for d in info["dimensions"]),
+            "spacing": tuple(float(s) for s in info["spacing"]),
+            "itemsize": PIXELTYPE_SIZES.get(info["pixeltype"], 8) *
+                        info["nComponents"],
+        }
+
+    itemsize = header.pop("itemsize")
+    header["nbytes"] = int(np.prod(header["shape"])) * itemsize
+    header["filesize"] = os.path.getsize(path)
+
+    return header
+
+
+def _parse_nifti_header(raw: bytes) -> Optional[dict]:
+    """Shape, spacing and item size from a NIfTI-1 or NIfTI-2 header."""
+    if len(raw) < 348:
+        return None
+
+    for endian in "<>":
+        size = struct.unpack(f"{endian}i", raw[:4])[0]
+        if size == 348:
+            dim = struct.unpack(f"{endian}8h", raw[40:56])
+            bitpix = struct.unpack(f"{endian}h", raw[72:74])[0]
+            pixdim = struct.unpack(f"{endian}8f", raw[76:108])
+            break
+        if size == 540 and len(raw) >= 540:
+            bitpix = struct.unpack(f"{endian}h", raw[14:16])[0]
+            dim = struct.unpack(f"{endian}8q", raw[16:80])
+            pixdim = struct.unpack(f"{endian}8d", raw[104:168])
+            break
+    else:
+        return None
+
+    ndim = max(3, min(dim[0], 7))
+    return {
+        "shape": tuple(int(d) for d in dim[1:4]),
+        "spacing": tuple(abs(float(s)) or 1. for s in pixdim[1:4]),
+        # Time points or components are all read
+        "itemsize": max(1, bitpix // 8) * int(
+            np.prod([max(1, d) for d in dim[4:ndim + 1]])),
+    }
+
+
+def calibration_path() -> Path:
+    """Path of the calibration tables.
+
+    It is `$ROILOC_CALIBRATION` if set, else `calibration.json` in
+    `$XDG_CACHE_HOME/roiloc` (`~/.cache/roiloc`).
+    """
+    if os.environ.get(CALIBRATION_ENV):
+        return Path(os.environ[CALIBRATION_ENV]).expanduser()
+
+    return Path(
+        os.environ.get("XDG_CACHE_HOME") or
+        os.path.expanduser("~/.cache")) / "roiloc" / "calibration.json"
+
+
+def calibration_key(args: argparse.Namespace) -> str:
+    """Key of the calibration table of a configuration."""
+    return json.dumps(
+        {p: getattr(args, p, None) for p in CALIBRATION_PARAMS},
+        sort_keys=True)
+
+
+def _calibration_point(image_path: Path, args: argparse.Namespace,
+                       rois_idx: dict) -> dict:
+    """Process a phantom in a worker, measuring its cost."""
+    from .registry import DEFAULT_TEMPLATE
+    from .roiloc import process_subject
+    from .template import get_atlas, get_mni
+
+    # Paid once per worker, not per subject
+    start = time.perf_counter()
+    template = getattr(args, "template", DEFAULT_TEMPLATE)
+    get_mni(args.contrast, args.bet, template=template)
+    get_atlas(template=template)
+    startup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = process_subject(image_path, args, rois_idx, Profiler())
+    seconds = time.perf_counter() - start
+
+    # Voxels cropped from the image, and bytes written for them
+    crop_voxels = sum(
+        int(np.prod([row[f"{a}max"] - row[f"{a}min"] for a in "xyz"]))
+        for row in result["coords"])
+    if getattr(args, "gridshape", None):
+        crop_voxels = len(result["coords"]) * int(np.prod(args.gridshape))
+    output_bytes = sum(
+        os.path.getsize(f)
+        for f in result["outputs"]
+        if str(f).endswith(("_crop.nii.gz", "_crop.nii", "_crops.npz")))
+
+    return {
+        "voxels": int(np.prod(read_header(image_path)["shape"])),
+        "startup": startup,
+        "seconds": seconds,
+        "registration": sum(r["wall"]
+                            for r in result["profile"]
+                            if r["stage"] in
+                            ["initialization", "registration"]),
+        "peak_rss": peak_rss(),
+        "crop_voxels": crop_voxels,
+        "output_bytes": output_bytes,
+    }
+
+
+def _affine_fit(x: list, y: list) -> list:
+    """Non-negative intercept and slope of `y` against `x`."""
+    slope = max(0., (y[1] - y[0]) / (x[1] - x[0])) if x[1] != x[0] else 0.
+    return [max(0., y[0] - slope * x[0]), slope]
+
+
+def calibrate(args: argparse.Namespace,
+              rois_idx: dict,
+              spacings: tuple = CALIBRATION_SPACINGS) -> dict:
+    """Measure the cost of processing subjects on this machine.
+
+    Phantoms of two sizes are processed with all CPUs, and the smallest one
+    also with a single thread, each one in a fresh worker process.
+
+    Args:
+        args (argparse.Namespace): CLI arguments of the planned run.
+        rois_idx (dict): Right & left CerebrA indices of each ROI.
+        spacings (tuple, optional): Spacings in mm of the phantoms.
+            Defaults to CALIBRATION_SPACINGS.
+
+    Returns:
+        dict: Calibration table, with the measured "points", the intercept
+            and slope against the number of voxels of the time ("seconds",
+            with all CPUs) and memory peak ("peak_rss") of a subject, the
+            share of the time sped up by threads ("parallel_fraction"), the
+            time for a worker to load the templates ("startup"), and the
+            bytes written per cropped voxel ("bytes_per_voxel")
+    """
+    from ._lazy import ants
+    from .phantom import make_phantom
+
+    cpus = os.cpu_count() or 1
+    # Inputs of the phantoms are the images only, and nothing is reused
+    calibration_args = argparse.Namespace(
+        **{
+            **vars(args),
+            "extracrops": [],
+            "mask": None,
+            "transformcache": None,
+            "profile_report": None,
+        })
+
+    points = []
+    with tempfile.TemporaryDirectory() as root:
+        paths = []
+        for i, spacing in enumerate(sorted(spacings, reverse=True)):
+            path = Path(root) / f"phantom-{i}" / "image.nii.gz"
+            path.parent.mkdir()
+            phantom = make_phantom(args.contrast,
+                                   args.bet,
+                                   spacing=[spacing] * 3)
+            ants.image_write(phantom.image, str(path))
+            paths.append(path)
+
+        runs = [(path, cpus) for path in paths]
+        if cpus > 1:
+            runs.append((paths[0], 1))
+
+        for path, threads in runs:
+            print(f"\tCalibrating on {list(read_header(path)['shape'])} "
+                  f"voxels with {threads} thread(s)...")
+            result = next(
+                run_parallel(_calibration_point, [path],
+                             jobs=1,
+                             threads=threads,
+                             args=calibration_args,
+                             rois_idx=rois_idx))
+            if not result.ok:
+                raise RuntimeError(
+                    f"Calibration failed:\n{result.error}{result.log}")
+            points.append({**result.value, "threads": threads})
+
+    full = [p for p in points if p["threads"] == cpus]
+    voxels = [p["voxels"] for p in full]
+
+    parallel_fraction = 0.
+    if cpus > 1:
+        # Amdahl's law, from the single-threaded run of the small phantom
+        serial = points[-1]["seconds"] / full[0]["seconds"]
+        parallel_fraction = float(
+            np.clip((1 - 1 / serial) / (1 - 1 / cpus), 0, 1))
+
+    crop_voxels = sum(p["crop_voxels"] for p in full)
+
+    return {
+        "roiloc": __version__,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "cpus": cpus,
+        "points": points,
+        "seconds": _affine_fit(voxels, [p["seconds"] for p in full]),
+        "peak_rss": _affine_fit(voxels, [p["peak_rss"] for p in full]),
+        "parallel_fraction": parallel_fraction,
+        "startup": max(p["startup"] for p in points),
+        "bytes_per_voxel": sum(p["output_bytes"] for p in full) /
+                           crop_voxels if crop_voxels else 0.,
+    }
+
+
+def load_calibration(args: argparse.Namespace,
+                     rois_idx: dict,
+                     recalibrate: bool = False) -> dict:
+    """Load the calibration table of a configuration, calibrating if needed.
+
+    Tables are calibrated again when the number of CPUs changed.
+
+    Args:
+        args (argparse.Namespace): CLI arguments of the planned run.
+        rois_idx (dict): Right & left CerebrA indices of each ROI.
+        recalibrate (bool, optional): Calibrate even if a table exists.
+            Defaults to False.
+
+    Returns:
+        dict: Calibration table, see `calibrate`
+    """
+    path = calibration_path()
+    key = calibration_key(args)
+
+    tables = {}
+    if path.exists():
+        try:
+            with open(path) as f:
+                tables = json.load(f)
+        except (OSError, ValueError):
+            # Corrupted, calibrated again
+            pass
+
+    table = tables.get(key)
+    if table is not None and table["cpus"] == os.cpu_count() and not recalibrate:
+        return table
+
+    print("Calibrating the cost of a subject on this machine, once...")
+    tables[key] = calibrate(args, rois_idx)
+
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix=".json", dir=path.parent)
+        with os.fdopen(fd, "w") as f:
+            json.dump(tables, f, indent=2)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[bold red]Could not write the calibration to {path}: {e}")
+
+    return tables[key]
+
+
+def subject_seconds(voxels: int, calibration: dict, threads: int) -> float:
+    """Estimated processing time of a subject.
+
+    Args:
+        voxels (int): Number of voxels of the subject's image.
+        calibration (dict): Calibration table, see `calibrate`.
+        threads (int): ITK threads of the worker.
+
+    Returns:
+        float: Time in seconds
+    """
+    intercept, slope = calibration["seconds"]
+    p = calibration["parallel_fraction"]
+
+    # Calibrated with all CPUs, scaled to `threads` by Amdahl's law
+    single = (intercept + slope * voxels) / (1 - p + p / calibration["cpus"])
+    return single * (1 - p + p / max(1, threads))
+
+
+def crop_voxels(header: dict, args: argparse.Namespace, bboxes: list,
+                template_spacing: tuple) -> int:
+    """Estimated number of voxels of the crops of an image.
+
+    Args:
+        header (dict): Header of the image, see `read_header`.
+        args (argparse.Namespace): CLI arguments.
+        bboxes (list): Inclusive bounding boxes of the ROIs' labels in the
+            template's voxels, see `registry.load_index`.
+        template_spacing (tuple): Spacing of the template in mm.
+
+    Returns:
+        int: Number of voxels of all the crops of one file
+    """
+    if getattr(args, "gridshape", None):
+        return len(bboxes) * int(np.prod(args.gridshape))
+
+    margin = np.asarray(args.margin)
+    voxels = 0
+    for lower, upper in bboxes:
+        extent = (np.asarray(upper) - lower + 1) * template_spacing
+        size = np.minimum(
+            np.ceil(extent / header["spacing"]) + 2 * margin, header["shape"])
+        voxels += int(np.prod(size))
+
+    return voxels
+
+
+def schedule(seconds: list, jobs: int, startup: float = 0.) -> float:
+    """Simulate the wall time of subjects processed in order by a pool.
+
+    Args:
+        seconds (list): Processing time of each subject.
+        jobs (int): Number of workers.
+        startup (float, optional): Time for a worker to start. Defaults to 0.
+
+    Returns:
+        float: Time in seconds until the last subject is done
+    """
+    workers = [startup] * jobs
+    for s in seconds:
+        heapq.heappush(workers, heapq.heappop(workers) + s)
+
+    return max(workers)
+
+
+def available_memory() -> int:
+    """Memory available to new processes, in bytes."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def recommend(voxels: list,
+              calibration: dict,
+              peak: int,
+              cpus: Optional[int] = None,
+              memory: Optional[int] = None) -> dict:
+    """Recommend a number of jobs and threads for a cohort.
+
+    Every split of the CPUs between jobs is simulated, and the fastest
+    one whose workers fit in memory is recommended, preferring fewer jobs
+    unless more are at least 5% faster.
+
+    Args:
+        voxels (list): Number of voxels of each subject's image.
+        calibration (dict): Calibration table, see `calibrate`.
+        peak (int): Memory peak of a worker, in bytes.
+        cpus (Optional[int], optional): Number of CPUs. Defaults to None,
+            those of the machine.
+        memory (Optional[int], optional): Available memory in bytes.
+            Defaults to None, see `available_memory`.
+
+    Returns:
+        dict: Recommended "jobs" and "threads", the estimated wall time
+            ("seconds"), and the wall time and memory of every number of
+            jobs considered ("options")
+    """
+    cpus = cpus or os.cpu_count() or 1
+    memory = memory or available_memory()
+
+    options = []
+    for jobs in range(1, max(1, min(cpus, len(voxels))) + 1):
+        threads = max(1, cpus // jobs)
+        options.append({
+            "jobs": jobs,
+            "threads": threads,
+            "seconds": schedule(
+                [subject_seconds(v, calibration, threads) for v in voxels],
+                jobs, calibration.get("startup", 0.)),
+            "memory": jobs * peak,
+        })
+
+    # At least one job, even if it does not fit in memory
+    fitting = [o for o in options if o["memory"] <= MEMORY_SHARE * memory
+              ] or options[:1]
+    best = fitting[0]
+    for option in fitting[1:]:
+        if option["seconds"] < .95 * best["seconds"]:
+            best = option
+
+    return {**best, "options": options}
+
+
+def plan_run(images: list,
+             args: argparse.Namespace,
+             rois_idx: dict,
+             recalibrate: bool = False) -> dict:
+    """Estimate the cost of a run from the headers of its images.
+
+    Args:
+        images (list): Paths of the subjects' images.
+        args (argparse.Namespace): CLI arguments of the run.
+        rois_idx (dict): Right & left CerebrA indices of each ROI.
+        recalibrate (bool, optional): Calibrate again, see
+            `load_calibration`. Defaults to False.
+
+    Returns:
+        dict: Number of subjects and files, estimated time, memory peak and
+            scratch space per subject, total output size, and recommended
+            schedule (see `recommend`)
+    """
+    from .registry import DEFAULT_TEMPLATE, get_template_entry
+    from .roiloc import find_extra_files
+    from .template import get_atlas_index
+
+    template = getattr(args, "template", DEFAULT_TEMPLATE)
+    index = get_atlas_index(template)
+    bboxes = [
+        index["bboxes"][int(i)]
+        for idx in rois_idx.values()
+        for i in idx
+        if int(i) in index["bboxes"]
+    ]
+    template_header = read_header(
+        get_template_entry(template).template(args.contrast, args.bet))
+
+    calibration = load_calibration(args, rois_idx, recalibrate)
+
+    resolution = getattr(args, "regresolution", None)
+    ladder = [args.transform, *(getattr(args, "fallback", None) or [])]
+    linear = all(t in LINEAR_TRANSFORMS for t in ladder)
+
+    voxels, peaks, scratch, outputs, files = [], [], [], 0, 0
+    for image_path in images:
+        header = read_header(image_path)
+        extra = [read_header(f) for f in find_extra_files(image_path, args)]
+        files += 1 + len(extra)
+
+        voxels.append(int(np.prod(header["shape"])))
+        intercept, slope = calibration["peak_rss"]
+        peaks.append(intercept + slope * voxels[-1])
+
+        # Gzipped files decompressed to be memory-mapped, and the forward
+        # and inverse displacement fields of non-linear registrations
+        temporary = sum(h["nbytes"]
+                        for f, h in zip([image_path, *extra], [header, *extra])
+                        if str(f).endswith(".gz"))
+        if not linear:
+            fields = voxels[-1]
+            if resolution:
+                fields = int(fields * np.prod(
+                    np.asarray(header["spacing"]) / resolution))
+            temporary += 2 * 3 * 4 * fields
+        scratch.append(temporary)
+
+        if not getattr(args, "coords_only", False):
+            outputs += calibration["bytes_per_voxel"] * sum(
+                crop_voxels(h, args, bboxes, template_header["spacing"])
+                for h in [header, *extra])
+
+    peak = int(max(peaks, default=0))
+    recommendation = recommend(voxels, calibration, peak)
+
+    return {
+        "subjects": len(images),
+        "files": files,
+        "voxels": [min(voxels, default=0), max(voxels, default=0)],
+        "seconds": [
+            subject_seconds(v, calibration, recommendation["threads"])
+            for v in [min(voxels, default=0), max(voxels, default=0)]
+        ],
+        "peak_rss": peak,
+        "scratch": int(max(scratch, default=0)),
+        "outputs": int(outputs),
+        "calibration": calibration,
+        "recommendation": recommendation,
+    }
+
+
+def _bytes(n: float) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if n < 1024:
+            return f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+def _duration(seconds: float) -> str:
+    hours, seconds = divmod(int(round(seconds)), 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else (
+        f"{minutes}m{seconds:02d}s")
+
+
+def print_plan(plan: dict):
+    """Print a plan, see `plan_run`."""
+    recommendation = plan["recommendation"]
+    jobs, threads = recommendation["jobs"], recommendation["threads"]
+
+    print(f"\n[bold]Plan for {plan['subjects']} subject(s), "
+          f"{plan['files']} file(s):")
+    print(f"\tImage size: {plan['voxels'][0]} to {plan['voxels'][1]} voxels")
+    print(f"\tTime per subject ({threads} thread(s)): "
+          f"{plan['seconds'][0]:.1f}s to {plan['seconds'][1]:.1f}s")
+    print(f"\tMemory peak per job: {_bytes(plan['peak_rss'])}")
+    print(f"\tScratch space per subject: {_bytes(plan['scratch'])}")
+    print(f"\tOutputs: {_bytes(plan['outputs'])}")
+
+    print("\n\tJobs  Threads  Wall time  Memory")
+    for option in recommendation["options"]:
+        print(f"\t{option['jobs']:>4}  {option['threads']:>7}  "
+              f"{_duration(option['seconds']):>9}  "
+              f"{_bytes(option['memory']):>9}")
+
+    print(f"\n[bold green]Recommended: --jobs {jobs} --threads {threads}, "
+          f"about {_duration(recommendation['seconds'])}.")
@@ -0,0 +1,134 @@
+"""
+Per-stage timing and memory instrumentation.
+
+Stages are recorded per subject with their wall time, CPU time and the peak
+resident set size of the process, and can be dumped as a JSON report.
+"""
+
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+# `ru_maxrss` is in bytes on macOS, in kilobytes elsewhere
+_RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def peak_rss() -> int:
+    """Get the peak resident set size of the current process, in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_UNIT
+
+
+class Profiler:
+    """Record the wall time, CPU time and peak memory of processing stages.
+
+    CPU time is the one of the whole process, including ITK threads, so
+    that concurrent stages (e.g. background writes) are counted in each
+    other. Peak RSS is the high-water mark of the process at the end of a
+    stage, and `peak_rss_increase` how much the stage raised it. Stages
+    may be nested (e.g. a synchronous "write" within "crop").
+
+    Args:
+        enabled (bool, optional): Whether to record stages. A disabled
+            profiler has no overhead. Defaults to True.
+
+    Attributes:
+        records (list): One dictionary per recorded stage.
+
+    Exemples:
+        >>> profiler = Profiler()
+        >>> with profiler.stage("registration", subject="sub-01"):
+        ...     ...
+        >>> profiler.dump("profile.json")
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.records = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str, subject: Optional[str] = None):
+        """Record a stage.
+
+        Args:
+            name (str): Name of the stage (e.g. "registration").
+            subject (Optional[str], optional): Subject being processed.
+                Defaults to None, for stages shared by all subjects.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        rss = peak_rss()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            record = {
+                "subject": None if subject is None else str(subject),
+                "stage": name,
+                "wall": time.perf_counter() - wall,
+                "cpu": time.process_time() - cpu,
+                "peak_rss": peak_rss(),
+            }
+            record["peak_rss_increase"] = record["peak_rss"] - rss
+            with self._lock:
+                self.records.append(record)
+
+    def extend(self, records: list):
+        """Add records of another profiler, e.g. from a worker process.
+
+        Args:
+            records (list): Records to add.
+        """
+        with self._lock:
+            self.records.extend(records)
+
+    def summary(self) -> dict:
+        """Aggregate records per stage.
+
+        Returns:
+            dict: Count, total wall and CPU times, and maximum peak RSS of
+                each stage
+        """
+        summary = {}
+        for record in self.records:
+            stage = summary.setdefault(record["stage"], {
+                "count": 0,
+                "wall": 0.,
+                "cpu": 0.,
+                "peak_rss": 0
+            })
+            stage["count"] += 1
+            stage["wall"] += record["wall"]
+            stage["cpu"] += record["cpu"]
+            stage["peak_rss"] = max(stage["peak_rss"], record["peak_rss"])
+
+        return summary
+
+    def report(self) -> dict:
+        """Get the full report.
+
+        Returns:
+            dict: Total wall time, per-stage summary and all records
+        """
+        return {
+            "wall": time.perf_counter() - self._start,
+            "summary": self.summary(),
+            "records": self.records,
+        }
+
+    def dump(self, path: str):
+        """Write the report as JSON.
+
+        Args:
+            path (str): Output path.
+        """
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
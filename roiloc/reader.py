@@ -0,0 +1,236 @@
+"""
+Region-only reading of images to crop.
+
+Uncompressed NIfTI files are memory-mapped, so that cropping only touches
+the voxels of the bounding box. Other formats are read once and kept in
+memory for all the crops of a subject.
+"""
+
+from __future__ import annotations
+
+import os
+import struct
+import tempfile
+from pathlib import PosixPath
+from typing import TYPE_CHECKING, Optional
+
+import numpy as np
+
+from ._lazy import ants
+
+if TYPE_CHECKING:
+    from ants.core import ANTsImage
+
+# NIfTI datatype codes supported for memory-mapping
+NIFTI_DTYPES = {
+    2: np.uint8,
+    4: np.int16,
+    8: np.int32,
+    16: np.float32,
+    64: np.float64,
+    256: np.int8,
+    512: np.uint16,
+    768: np.uint32,
+    1024: np.int64,
+    1280: np.uint64,
+}
+
+# Axes directions of an LPI image, in ITK's LPS physical space
+LPI_DIRECTION = np.diag([-1., -1., 1.])
+
+
+def read_nifti_header(path: str) -> Optional[dict]:
+    """Read the fields of a NIfTI-1 header needed to memory-map its voxels.
+
+    Args:
+        path (str): Path of an uncompressed NIfTI-1 file
+
+    Returns:
+        Optional[dict]: Dimensions, dtype, offset and scaling of the voxels,
+            or None if the file cannot be memory-mapped
+    """
+    with open(path, "rb") as f:
+        header = f.read(348)
+
+    if len(header) < 348:
+        return None
+
+    for endian in "<>":
+        if struct.unpack(f"{endian}i", header[:4])[0] == 348:
+            break
+    else:
+        # Not a NIfTI-1 header (e.g. NIfTI-2)
+        return None
+
+    dim = struct.unpack(f"{endian}8h", header[40:56])
+    datatype = struct.unpack(f"{endian}h", header[70:72])[0]
+    vox_offset = struct.unpack(f"{endian}f", header[108:112])[0]
+    scl_slope, scl_inter = struct.unpack(f"{endian}2f", header[112:120])
+
+    if dim[0] < 3 or any(d > 1 for d in dim[4:dim[0] + 1]):
+        # Only 3D images are supported
+        return None
+    if datatype not in NIFTI_DTYPES:
+        return None
+
+    return {
+        "shape": tuple(dim[1:4]),
+        "dtype": np.dtype(NIFTI_DTYPES[datatype]).newbyteorder(endian),
+        "offset": int(vox_offset),
+        "slope": scl_slope,
+        "inter": scl_inter,
+        "endian": endian,
+    }
+
+
+def read_nifti_geometry(path: str, header: dict) -> ANTsImage:
+    """Read the geometry of a NIfTI-1 file as ITK does, without its voxels.
+
+    The header is copied into a single-voxel image read by ANTs, which
+    gives the exact origin, spacing and direction of the original image.
+
+    Args:
+        path (str): Path of an uncompressed NIfTI-1 file
+        header (dict): Output of `read_nifti_header`
+
+    Returns:
+        ANTsImage: Single-voxel image with the geometry of the file
+    """
+    with open(path, "rb") as f:
+        raw = bytearray(f.read(header["offset"]))
+
+    raw[42:48] = struct.pack(f"{header['endian']}3h", 1, 1, 1)
+    raw += bytes(header["dtype"].itemsize)
+
+    fd, stub = tempfile.mkstemp(suffix=".nii")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(raw)
+        return ants.image_read(stub)
+    finally:
+        os.remove(stub)
+
+
+def lpi_mapping(direction: np.ndarray) -> tuple:
+    """Get how the axes of an image map to those of its LPI reorientation.
+
+    Args:
+        direction (np.ndarray): Direction matrix of the image
+
+    Returns:
+        tuple: For each LPI axis, the index of the image axis it comes from,
+            and whether it is flipped
+    """
+    permutation, flips = [], []
+    for j in range(3):
+        # Image axis whose direction is closest to the LPI axis
+        cosines = direction.T @ LPI_DIRECTION[:, j]
+        i = int(np.argmax(np.abs(cosines)))
+        permutation.append(i)
+        flips.append(bool(cosines[i] < 0))
+
+    return permutation, flips
+
+
+class LazyImage:
+    """Image to crop in LPI coordinates, read at most once.
+
+    Uncompressed NIfTI-1 files are memory-mapped and only the cropped
+    region is read. Other images are fully read on the first crop, and
+    kept for the next ones.
+
+    Args:
+        path (PosixPath): Path of the image.
+        image (Optional[ANTsImage], optional): Image already read in LPI
+            orientation, to avoid reading it again. Defaults to None.
+
+    Exemples:
+        >>> image = LazyImage(Path("sub-01/t2.nii"))
+        >>> cropped = image.crop_indices([10, 20, 30], [40, 60, 70])
+    """
+
+    def __init__(self, path: PosixPath, image: Optional[ANTsImage] = None):
+        self.path = path
+        self._image = image
+        self._voxels = None
+        self._header = None
+        self._geometry = None
+
+        if image is None and str(path).endswith(".nii"):
+            self._header = read_nifti_header(str(path))
+
+    @property
+    def memory_mapped(self) -> bool:
+        """Whether crops are read from a memory-mapped file."""
+        return self._image is None and self._header is not None
+
+    def _load(self):
+        if self.memory_mapped:
+            if self._voxels is None:
+                self._geometry = read_nifti_geometry(str(self.path),
+                                                     self._header)
+                self._voxels = np.memmap(self.path,
+                                         dtype=self._header["dtype"],
+                                         mode="r",
+                                         offset=self._header["offset"],
+                                         shape=self._header["shape"],
+                                         order="F")
+        elif self._image is None:
+            self._image = ants.image_read(str(self.path), reorient="LPI")
+
+    @property
+    def shape(self) -> tuple:
+        """Shape of the image in LPI orientation."""
+        self._load()
+        if not self.memory_mapped:
+            return self._image.shape
+
+        permutation, _ = lpi_mapping(self._geometry.direction)
+        return tuple(self._header["shape"][i] for i in permutation)
+
+    def crop_indices(self, lowerind: list, upperind: list) -> ANTsImage:
+        """Crop the image, same as `ants.crop_indices` on the LPI image.
+
+        Args:
+            lowerind (list): Lower indices in LPI orientation.
+            upperind (list): Upper indices (excluded) in LPI orientation.
+
+        Returns:
+            ANTsImage: Cropped image
+        """
+        self._load()
+        if not self.memory_mapped:
+            return ants.crop_indices(self._image, lowerind, upperind)
+
+        direction = self._geometry.direction
+        spacing = np.asarray(self._geometry.spacing)
+        origin = np.asarray(self._geometry.origin)
+        shape = self._header["shape"]
+        permutation, flips = lpi_mapping(direction)
+
+        # On-disk slices, and index of the first LPI voxel on disk
+        slices, first = [None] * 3, np.zeros(3)
+        for j, (i, flip) in enumerate(zip(permutation, flips)):
+            if flip:
+                slices[i] = slice(shape[i] - upperind[j],
+                                  shape[i] - lowerind[j])
+                first[i] = shape[i] - 1 - lowerind[j]
+            else:
+                slices[i] = slice(lowerind[j], upperind[j])
+                first[i] = lowerind[j]
+
+        region = np.asarray(self._voxels[tuple(slices)], dtype=np.float32)
+        region = region.transpose(permutation)
+        region = region[tuple(
+            slice(None, None, -1) if flip else slice(None) for flip in flips)]
+
+        slope, inter = self._header["slope"], self._header["inter"]
+        if slope != 0 and (slope, inter) != (1, 0):
+            region = region * slope + inter
+
+        return ants.from_numpy(
+            np.ascontiguousarray(region),
+            origin=tuple(origin + direction @ (spacing * first)),
+            spacing=tuple(spacing[permutation]),
+            direction=direction[:, permutation] *
+            np.where(flips, -1., 1.))
@@ -1,11 +1,72 @@
+from __future__ import annotations
+
+import time
 from copy import deepcopy
 from pathlib import PosixPath
-from typing import Optional
+from typing import TYPE_CHECKING, Optional, Union
 
-import ants
-from ants.core.ants_image import ANTsImage
+import numpy as np
 from rich import print
 
+from ._lazy import ants
+
+if TYPE_CHECKING:
+    from ants.core import ANTsImage, ANTsTransform
+
+# Quality from which registrations are accepted, see `registration_quality`
+MIN_QUALITY = 0.2
+
+
+def downsample(image: ANTsImage,
+               resolution: float,
+               interpolation: str = "linear") -> ANTsImage:
+    """Downsample an image to a given resolution.
+
+    Axes already coarser than `resolution` are left untouched.
+
+    Args:
+        image (ANTsImage): Image to downsample.
+        resolution (float): Target resolution in mm.
+        interpolation (str, optional): "linear" or "nearestNeighbor".
+            Defaults to "linear".
+
+    Returns:
+        ANTsImage: Downsampled image
+    """
+    spacing = tuple(max(s, resolution) for s in image.spacing)
+    if spacing == tuple(image.spacing):
+        return image
+
+    return ants.resample_image(image,
+                               spacing,
+                               use_voxels=False,
+                               interp_type=1
+                               if interpolation == "nearestNeighbor" else 0)
+
+
+def get_mask(path: PosixPath, mask: Optional[str]) -> Optional[ANTsImage]:
+    """Find and read a registration mask.
+
+    Args:
+        path (PosixPath): Path where to find masks.
+        mask (Optional[str]): Pattern to find masks.
+
+    Returns:
+        Optional[ANTsImage]: Mask, or None if no mask was found
+    """
+    if not mask:
+        return None
+
+    mask_path = list(path.glob(mask))
+    if mask_path:
+        print(f"\tUsing mask {str(mask_path[0])}")
+        return ants.image_read(
+            str(mask_path[0]), pixeltype="unsigned int", reorient="LPI"
+        )
+
+    print("\t[bold red]Warning: no mask found. Registering without mask...")
+    return None
+
 
 def register(
     fixed: ANTsImage,
@@ -13,7 +74,8 @@ def register(
     type_of_transform: list,
     outprefix: str = "",
     path: Optional[PosixPath] = None,
-    mask: Optional[str] = None,
+    mask: Optional[Union[str, ANTsImage]] = None,
+    initial_transform: Optional[str] = None,
 ) -> dict:
     """Registration wrapper around ANTs
 
@@ -23,30 +85,281 @@ def register(
         type_of_transform (list): See ANTs doc for registration type.
         outprefix (str): Where to save ANTs tmporary files.
         path (Optional[PosixPath], optional): Path where to find masks. Defaults to None.
-        mask (Optional[str], optional): Pattern to find masks. Defaults to None.
+        mask (Optional[Union[str, ANTsImage]], optional): Pattern to find masks,
+            or mask itself. Defaults to None.
+        initial_transform (Optional[str], optional): Path of a transform
+            initializing the registration, see `center_of_mass_transform`.
+            It is included in the resulting transforms. Defaults to None,
+            aligning the centers of mass of the intensities.
 
     Returns:
         dict: Registration results
     """
-    if mask:
-        mask_path = list(path.glob(mask))
-        if mask_path:
-            mask = ants.image_read(
-                str(mask_path[0]), pixeltype="unsigned int", reorient="LPI"
-            )
-            print(f"\tUsing mask {str(mask_path[0])}")
-        else:
-            print("\t[bold red]Warning: no mask found. Registering without mask...")
+    if isinstance(mask, str):
+        mask = get_mask(path, mask)
 
     return ants.registration(
         fixed=fixed,
         moving=moving,
         type_of_transform=type_of_transform,
+        initial_transform=initial_transform,
         mask=mask,
         outprefix=outprefix,
     )
 
 
+def registration_quality(fixed: ANTsImage,
+                         warped: ANTsImage,
+                         resolution: float = 4.,
+                         bins: int = 32) -> float:
+    """Similarity of an image and a template registered to it.
+
+    It is the mutual information of both images normalized by their
+    entropies (symmetric uncertainty), from 0 for independent images to 1
+    for identical ones up to a bijection of intensities. It is computed at
+    low resolution, over the foreground of the registered template.
+
+    Args:
+        fixed (ANTsImage): Image.
+        warped (ANTsImage): Template registered to the image, e.g. the
+            "warpedmovout" of a registration.
+        resolution (float, optional): Resolution in mm at which it is
+            computed. Defaults to 4.
+        bins (int, optional): Number of bins of the joint histogram.
+            Defaults to 32.
+
+    Returns:
+        float: Quality of the registration, from 0 to 1
+    """
+    fixed = downsample(fixed, resolution).numpy()
+    warped = downsample(warped, resolution).numpy()
+    mask = warped > 0
+    if not mask.any():
+        return 0.
+
+    joint, _, _ = np.histogram2d(fixed[mask], warped[mask], bins=bins)
+    joint /= joint.sum()
+
+    def entropy(p):
+        p = p[p > 0]
+        return -np.sum(p * np.log(p))
+
+    marginals = entropy(joint.sum(axis=1)) + entropy(joint.sum(axis=0))
+    if marginals == 0:
+        return 0.
+
+    return float(2 * (marginals - entropy(joint)) / marginals)
+
+
+def register_with_fallback(fixed: ANTsImage,
+                           moving: ANTsImage,
+                           ladder: list,
+                           min_quality: float = MIN_QUALITY,
+                           outprefix: str = "",
+                           mask: Optional[ANTsImage] = None,
+                           initial_transform: Optional[str] = None) -> dict:
+    """Register with increasingly costly transforms until good enough.
+
+    Each type of transform of the ladder is tried in turn, until the
+    quality of the registration (see `registration_quality`) reaches
+    `min_quality`. If none does, the best registration is kept.
+
+    Args:
+        fixed (ANTsImage): Image that stays in the native space.
+        moving (ANTsImage): Image to move in native space.
+        ladder (list): Types of transform, e.g.
+            ["AffineFast", "Affine", "SyNRA"].
+        min_quality (float, optional): Quality from which a registration
+            is accepted. Defaults to MIN_QUALITY.
+        outprefix (str): Where to save ANTs tmporary files.
+        mask (Optional[ANTsImage], optional): Registration mask.
+            Defaults to None.
+        initial_transform (Optional[str], optional): Path of a transform
+            initializing the registrations. Defaults to None.
+
+    Returns:
+        dict: Registration results of the accepted registration, with its
+            "quality", and the type of transform, quality and wall time of
+            every registration in "attempts"
+    """
+    attempts = []
+    best = None
+    for i, type_of_transform in enumerate(ladder):
+        start = time.perf_counter()
+        registration = register(fixed,
+                                moving,
+                                type_of_transform,
+                                outprefix=f"{outprefix}{i}_"
+                                if outprefix else "",
+                                mask=mask,
+                                initial_transform=initial_transform)
+        quality = registration_quality(fixed, registration["warpedmovout"])
+        attempts.append({
+            "transform": type_of_transform,
+            "quality": round(quality, 4),
+            "seconds": round(time.perf_counter() - start, 3),
+        })
+
+        if best is None or quality > best["quality"]:
+            best = {**registration, "quality": quality}
+        if quality >= min_quality:
+            break
+
+        if i + 1 < len(ladder):
+            print(f"\t[bold yellow]Registration quality {quality:.2f} "
+                  f"below {min_quality}, trying {ladder[i + 1]}...")
+        else:
+            print(f"\t[bold red]Registration quality {quality:.2f} below "
+                  f"{min_quality}, keeping the best registration.")
+
+    return {**best, "attempts": attempts}
+
+
+def _foreground_points(image: ANTsImage) -> np.ndarray:
+    """Physical coordinates of the voxels of an image's foreground."""
+    mask = ants.threshold_image(image, "Otsu", 1).numpy() > 0
+    indices = np.argwhere(mask)
+
+    return np.asarray(image.origin) + (indices * np.asarray(
+        image.spacing)) @ np.asarray(image.direction).T
+
+
+def center_of_mass_transform(fixed: ANTsImage,
+                             moving: ANTsImage,
+                             outprefix: str,
+                             resolution: float = 4.) -> Optional[str]:
+    """Translation aligning the centers of the heads of two images.
+
+    ANTs aligns the centers of mass of the intensities by default, which
+    are pulled away from the brain by a large field of view (e.g. neck
+    coverage). Here, the foregrounds of both images are thresholded at low
+    resolution, and the foreground of `fixed` is restricted to the height
+    of the foreground of `moving` below the top of the head, as the
+    template covers the head only.
+
+    Args:
+        fixed (ANTsImage): Image, in LPI orientation.
+        moving (ANTsImage): Template.
+        outprefix (str): Prefix of the written transform, e.g. the scratch
+            directory of `handle_cache`, which removes it.
+        resolution (float, optional): Resolution in mm at which the
+            foregrounds are computed. Defaults to 4.
+
+    Returns:
+        Optional[str]: Path of the transform, as `initial_transform` of
+            `register`, or None if an image has no foreground
+    """
+    fixed_points = _foreground_points(downsample(fixed, resolution))
+    moving_points = _foreground_points(downsample(moving, resolution))
+    if not len(fixed_points) or not len(moving_points):
+        return None
+
+    # Superior is +z in the physical (LPS) space of ITK
+    height = moving_points[:, 2].max() - moving_points[:, 2].min()
+    fixed_points = fixed_points[
+        fixed_points[:, 2] >= fixed_points[:, 2].max() - height]
+
+    # Maps points of `fixed` to `moving`, as the transforms of ANTs
+    offset = moving_points.mean(axis=0) - fixed_points.mean(axis=0)
+    print(f"\tInitial offset of {np.linalg.norm(offset):.1f}mm")
+    transform = ants.create_ants_transform(transform_type="AffineTransform",
+                                           dimension=3,
+                                           translation=tuple(offset))
+
+    path = f"{outprefix}init.mat"
+    ants.write_transform(transform, path)
+
+    return path
+
+
+def read_transforms(transformlist: list,
+                    whichtoinvert: Optional[list] = None) -> list:
+    """Read the transforms of a registration in memory.
+
+    Args:
+        transformlist (list): Paths of the transforms, as given to
+            `ants.apply_transforms`. Transforms already in memory are kept.
+        whichtoinvert (Optional[list], optional): Whether to invert each
+            linear transform, as in `ants.apply_transforms`. Defaults to None.
+
+    Returns:
+        list: ANTsTransform of each transform
+    """
+    whichtoinvert = whichtoinvert or [False] * len(transformlist)
+
+    transforms = []
+    for transform, invert in zip(transformlist, whichtoinvert):
+        if not isinstance(transform, ants.ANTsTransform):
+            if str(transform).endswith(".mat"):
+                transform = ants.read_transform(str(transform))
+            else:
+                transform = ants.transform_from_displacement_field(
+                    ants.image_read(str(transform)))
+        transforms.append(transform.invert() if invert else transform)
+
+    return transforms
+
+
+def is_linear(transform: Union[str, ANTsTransform]) -> bool:
+    """Whether a transform, or the path of a transform, is linear."""
+    if isinstance(transform, ants.ANTsTransform):
+        return transform.transform_type != "DisplacementFieldTransform"
+
+    return str(transform).endswith(".mat")
+
+
+def headers_match(image: ANTsImage,
+                  reference: ANTsImage,
+                  tolerance: float = 1e-3) -> bool:
+    """Whether two images share the same voxel grid in physical space, e.g.
+    contrasts of a subject acquired in the same session and resampled.
+
+    Args:
+        image (ANTsImage): Image.
+        reference (ANTsImage): Other image.
+        tolerance (float, optional): Absolute tolerance on the spacing,
+            origin and direction. Defaults to 1e-3.
+
+    Returns:
+        bool: True if transforms of one image apply to the other as is
+    """
+    if image.shape != reference.shape:
+        return False
+
+    return all(
+        np.allclose(getattr(image, a), getattr(reference, a), atol=tolerance)
+        for a in ["spacing", "origin", "direction"])
+
+
+def apply_transforms(fixed: ANTsImage,
+                     moving: ANTsImage,
+                     transformlist: list,
+                     interpolator: str = "linear") -> ANTsImage:
+    """Apply transforms given as paths or in memory.
+
+    Args:
+        fixed (ANTsImage): Image defining the output grid.
+        moving (ANTsImage): Image to transform.
+        transformlist (list): Paths of the transforms, or ANTsTransform.
+        interpolator (str, optional): "linear" or "nearestNeighbor".
+            Defaults to "linear".
+
+    Returns:
+        ANTsImage: Transformed image
+    """
+    if not any(isinstance(t, ants.ANTsTransform) for t in transformlist):
+        return ants.apply_transforms(fixed=fixed,
+                                     moving=moving,
+                                     transformlist=transformlist,
+                                     interpolator=interpolator)
+
+    # Composed in the order of `ants.apply_transforms`
+    transform = ants.compose_ants_transforms(read_transforms(transformlist))
+    return transform.apply_to_image(moving,
+                                    reference=fixed,
+                                    interpolation=interpolator.lower())
+
+
 def get_roi(
     registered_atlas: ANTsImage,
     idx: int,
@@ -0,0 +1,326 @@
+"""
+Registry of templates and atlases.
+
+An entry pairs templates (one per contrast, with or without brain
+extraction) with an atlas in the same space, and the right and left labels
+of its regions. The bundled MNI ICBM152 09c templates and CerebrA atlas are
+the default entry, "mni_icbm152_09c". Other entries (e.g. pediatric or
+ex-vivo templates) are registered from Python with `register_template`, or
+described by a JSON file given instead of a name:
+
+    {
+        "name": "nihpd_asym_04.5-08.5",
+        "templates": {"t1": "nihpd_t1w.nii", "t1bet": "nihpd_t1w_bet.nii"},
+        "atlas": "nihpd_atlas.nii",
+        "labels": "nihpd_labels.csv"
+    }
+
+Relative paths are relative to the JSON file. The labels are a CSV table
+with "name", "right" and "left" columns.
+
+The bounding boxes and centroids of all labels of an atlas, in atlas voxels
+of LPI orientation, are computed once and stored with the labels in a
+compact `.npz` index, so that runs neither scan the atlas nor parse the
+label table. The index is rebuilt when the atlas or the label table
+change.
+"""
+
+import csv
+import importlib.resources
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import NamedTuple, Optional, Union
+
+import numpy as np
+
+from ._cerebra import CEREBRA_LABELS
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TEMPLATE = "mni_icbm152_09c"
+
+# Directory of the indices of the atlases, unless given by their entry
+INDEX_DIR_ENV = "ROILOC_INDEX_DIR"
+
+
+class TemplateEntry(NamedTuple):
+    """Templates and atlas of a registry entry.
+
+    Attributes:
+        name (str): Name of the entry.
+        templates (dict): Path of the template of each contrast, with a
+            "bet" suffix for brain extracted ones (e.g. "t1", "t1bet").
+        atlas (str): Path of the atlas, in the space of the templates.
+        labels (Union[dict, str]): Right and left labels of each region, by
+            name, or path of a CSV table with "name", "right" and "left"
+            columns.
+        index (Optional[str]): Path of the index of the atlas. Defaults to
+            None, see `index_path`.
+    """
+    name: str
+    templates: dict
+    atlas: str
+    labels: Union[dict, str]
+    index: Optional[str] = None
+
+    def template(self, contrast: str, bet: bool) -> str:
+        """Path of the template of a contrast."""
+        key = contrast + ("bet" if bet else "")
+        assert key in self.templates, f"No {key} template in {self.name}, available: {list(self.templates)}"
+
+        return self.templates[key]
+
+
+REGISTRY = {}
+
+# Entries loaded from JSON files, by resolved path
+_TEMPLATE_FILES = {}
+
+
+def register_template(name: str,
+                      templates: dict,
+                      atlas: str,
+                      labels: Union[dict, str],
+                      index: Optional[str] = None) -> TemplateEntry:
+    """Register templates and their atlas.
+
+    Args:
+        name (str): Name of the entry, e.g. to select it in the CLI.
+        templates (dict): Path of the template of each contrast, with a
+            "bet" suffix for brain extracted ones (e.g. "t1", "t1bet").
+        atlas (str): Path of the atlas, in the space of the templates.
+        labels (Union[dict, str]): Right and left labels of each region, by
+            name, or path of a CSV table with "name", "right" and "left"
+            columns.
+        index (Optional[str], optional): Path of the index of the atlas.
+            Defaults to None, see `index_path`.
+
+    Returns:
+        TemplateEntry: Registered entry
+    """
+    entry = TemplateEntry(name=name,
+                          templates={k: str(v)
+                                     for k, v in templates.items()},
+                          atlas=str(atlas),
+                          labels=labels if isinstance(labels, dict) else
+                          str(labels),
+                          index=str(index) if index else None)
+    REGISTRY[name] = entry
+
+    return entry
+
+
+def _register_bundled():
+    res = importlib.resources.files("roiloc") / "MNI"
+    register_template(
+        DEFAULT_TEMPLATE,
+        templates={
+            f"{contrast}{bet}": str(
+                res / "icbm152" /
+                f"mni_icbm152_{contrast}{bet}_tal_nlin_sym_09c.nii")
+            for contrast in ["t1", "t2"] for bet in ["", "bet"]
+        },
+        atlas=str(res / "cerebra" / "mni_icbm152_CerebrA_tal_nlin_sym_09c.nii"),
+        labels=CEREBRA_LABELS)
+
+
+_register_bundled()
+
+
+def load_template_file(path: str) -> TemplateEntry:
+    """Register the entry described by a JSON file.
+
+    Args:
+        path (str): Path of the JSON file, see the module's documentation.
+
+    Returns:
+        TemplateEntry: Registered entry
+    """
+    path = Path(path).expanduser()
+    with open(path) as f:
+        spec = json.load(f)
+
+    def resolve(p):
+        return str(path.parent / Path(p).expanduser())
+
+    return register_template(
+        spec["name"],
+        templates={k: resolve(v) for k, v in spec["templates"].items()},
+        atlas=resolve(spec["atlas"]),
+        labels=spec["labels"] if isinstance(spec["labels"], dict) else
+        resolve(spec["labels"]),
+        index=resolve(spec["index"]) if spec.get("index") else None)
+
+
+def get_template_entry(template: str = DEFAULT_TEMPLATE) -> TemplateEntry:
+    """Get a registry entry.
+
+    Args:
+        template (str, optional): Name of the entry, or path of a JSON file
+            describing it. Defaults to DEFAULT_TEMPLATE.
+
+    Returns:
+        TemplateEntry: Entry
+    """
+    if template in REGISTRY:
+        return REGISTRY[template]
+
+    if str(template).endswith(".json"):
+        # Entries are keyed by the name given in the file
+        path = Path(template).expanduser().resolve()
+        if path not in _TEMPLATE_FILES:
+            _TEMPLATE_FILES[path] = load_template_file(path)
+        return _TEMPLATE_FILES[path]
+
+    raise KeyError(
+        f"Unknown template {template}, registered: {list(REGISTRY)}")
+
+
+def read_label_table(path: str) -> dict:
+    """Read a CSV table with "name", "right" and "left" columns."""
+    with open(path, newline="") as f:
+        return {
+            row["name"]: (int(row["right"]), int(row["left"]))
+            for row in csv.DictReader(f)
+        }
+
+
+def _sources_stat(entry: TemplateEntry) -> list:
+    """Size and modification time of the atlas and label table of an
+    entry, to detect stale indices."""
+    files = [entry.atlas]
+    if not isinstance(entry.labels, dict):
+        files.append(entry.labels)
+
+    stat = []
+    for file in files:
+        st = os.stat(file)
+        stat += [st.st_size, st.st_mtime_ns]
+
+    return stat
+
+
+def index_path(entry: TemplateEntry) -> Path:
+    """Path of the index of an entry's atlas.
+
+    It is the entry's `index` if given, else `<name>_index.npz` in
+    `$ROILOC_INDEX_DIR`, or in `$XDG_CACHE_HOME/roiloc` (`~/.cache/roiloc`).
+    """
+    if entry.index:
+        return Path(entry.index).expanduser()
+
+    directory = os.environ.get(INDEX_DIR_ENV) or os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "roiloc")
+
+    return Path(directory) / f"{entry.name}_index.npz"
+
+
+def build_index(entry: TemplateEntry, path: Optional[str] = None) -> dict:
+    """Compute and write the index of an entry's atlas.
+
+    Args:
+        entry (TemplateEntry): Entry.
+        path (Optional[str], optional): Output path. Defaults to None, see
+            `index_path`.
+
+    Returns:
+        dict: Index, see `load_index`
+    """
+    from scipy.ndimage import center_of_mass
+
+    from ._lazy import ants
+    from .location import get_labels_bbox
+
+    atlas = ants.image_read(entry.atlas,
+                            pixeltype="unsigned int",
+                            reorient="LPI").numpy()
+    labels = np.unique(atlas)
+    labels = labels[labels > 0]
+
+    boxes = get_labels_bbox(atlas, labels)
+    centroids = center_of_mass(atlas > 0, atlas, labels)
+
+    names = entry.labels if isinstance(entry.labels,
+                                       dict) else read_label_table(
+                                           entry.labels)
+    arrays = {
+        "labels": labels.astype(np.int32),
+        "lower": np.array([boxes[int(l)][0] for l in labels], dtype=np.int32),
+        "upper": np.array([boxes[int(l)][1] for l in labels], dtype=np.int32),
+        "centroids": np.array(centroids, dtype=np.float32).reshape(-1, 3),
+        "names": np.array(list(names), dtype=str),
+        "sides": np.array(list(names.values()), dtype=np.int32).reshape(-1, 2),
+        "shape": np.array(atlas.shape, dtype=np.int32),
+        "sources_stat": np.array(_sources_stat(entry), dtype=np.int64),
+    }
+
+    path = Path(path) if path else index_path(entry)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written atomically, as workers may build it concurrently
+        fd, tmp = tempfile.mkstemp(suffix=".npz", dir=path.parent)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    except OSError as e:
+        log.warning(f"Could not write the index of {entry.name}: {e}")
+
+    return _unpack_index(arrays)
+
+
+def _unpack_index(arrays) -> dict:
+    labels = [int(l) for l in arrays["labels"]]
+    return {
+        "bboxes": {
+            label: (lower.tolist(), upper.tolist()) for label, lower, upper in
+            zip(labels, arrays["lower"], arrays["upper"])
+        },
+        "centroids": {
+            label: centroid.tolist()
+            for label, centroid in zip(labels, arrays["centroids"])
+        },
+        "labels": {
+            str(name): tuple(int(s) for s in sides)
+            for name, sides in zip(arrays["names"], arrays["sides"])
+        },
+        "shape": tuple(int(s) for s in arrays["shape"]),
+    }
+
+
+def load_index(entry: TemplateEntry) -> dict:
+    """Load the index of an entry's atlas, building it if needed.
+
+    The index is rebuilt when the atlas or the label table changed since it
+    was built.
+
+    Args:
+        entry (TemplateEntry): Entry.
+
+    Returns:
+        dict: Inclusive minimum and maximum indices ("bboxes") and centroid
+            ("centroids") of each label in atlas voxels of LPI orientation,
+            right and left labels of each region ("labels"), and shape of
+            the atlas ("shape")
+    """
+    path = index_path(entry)
+    stat = _sources_stat(entry)
+
+    if path.exists():
+        try:
+            with np.load(path) as arrays:
+                if arrays["sources_stat"].tolist() == stat:
+                    return _unpack_index(arrays)
+        except (OSError, ValueError, KeyError):
+            # Corrupted, or written by another version
+            pass
+
+    return build_index(entry, path)
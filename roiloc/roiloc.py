@@ -3,35 +3,766 @@ Script to center and crop an MRI based on regions given by the CerebrA atlas.
 Distributed under MIT License by Clément POIRET.
 """
 
+from __future__ import annotations
+
 import argparse
+import os
+import re
 import tempfile
+import traceback
+from concurrent.futures import wait
+from fnmatch import fnmatch
+from functools import partial
 from pathlib import Path
 from shutil import rmtree
+from typing import TYPE_CHECKING, Callable, Optional
+
+from rich import get_console, print
+
+from roiloc._cache import handle_cache
+from roiloc._lazy import ants
+from roiloc.coords import coords_row, write_coords_table
+from roiloc.location import (apply_margin, crop, get_labels_bbox, make_grid,
+                             transform_labels_bbox)
+from roiloc.manifest import OUTPUT_PARAMS, RunManifest, fingerprint
+from roiloc.pipeline import AsyncWriter, decompress, prefetch, write_image
+from roiloc.profiling import Profiler
+from roiloc.reader import LazyImage
+from roiloc.registry import DEFAULT_TEMPLATE
+from roiloc.registration import (MIN_QUALITY, apply_transforms,
+                                 center_of_mass_transform, downsample,
+                                 get_mask, get_roi, headers_match, is_linear,
+                                 read_transforms, register,
+                                 register_with_fallback)
+from roiloc.scheduler import run_parallel, set_thread_budget, thread_budget
+from roiloc.template import (get_atlas, get_atlas_bboxes, get_mni, get_mni_name,
+                             get_roi_indices)
+from roiloc.transformstore import TransformStore
+
+if TYPE_CHECKING:
+    from ants.core import ANTsImage
+
+def find_extra_files(image_path: Path, args: argparse.Namespace) -> list:
+    """Find the other files of a subject to crop."""
+    if getattr(args, "coords_only", False):
+        return []
+
+    return [
+        f for f_ in [image_path.parent.glob(e) for e in args.extracrops]
+        for f in f_
+    ]
+
+
+def find_input_files(image_path: Path,
+                     args: argparse.Namespace,
+                     reference: Optional[Path] = None) -> list:
+    """Find all the files a subject's outputs depend on, as absolute paths.
+
+    Args:
+        image_path (Path): Path of the subject's image.
+        args (argparse.Namespace): CLI arguments.
+        reference (Optional[Path], optional): Reference image of the
+            subject's group, see `--group-by`. Defaults to None.
+
+    Returns:
+        list: Paths of the image, extra files, mask and reference
+    """
+    masks = list(image_path.parent.glob(args.mask))[:1] if args.mask else []
+    files = [image_path, *find_extra_files(image_path, args), *masks]
+    if reference is not None and reference != image_path:
+        # Outputs also depend on the reference of the group
+        files.append(reference)
+
+    return [Path(f).resolve() for f in files]
+
+
+def group_images(images: list,
+                 pattern: str,
+                 reference: Optional[str] = None) -> dict:
+    """Group the images of a subject, e.g. its contrasts and sessions.
+
+    Images whose paths contain the same match of `pattern` form a group,
+    and images without a match are a group of their own.
+
+    Args:
+        images (list): Paths of the images.
+        pattern (str): Regular expression matching the part of the paths
+            identifying a group, e.g. `sub-[^/]+`.
+        reference (Optional[str], optional): Glob pattern of the file name
+            of the reference image of each group, e.g. `*T1w*`. Defaults to
+            None, the first image of each group in sorted order.
+
+    Returns:
+        dict: Images of each group, by matched string, reference first
+    """
+    regex = re.compile(pattern)
+
+    groups = {}
+    for image_path in sorted(images):
+        match = regex.search(str(image_path))
+        key = match.group(0) if match else str(image_path)
+        groups.setdefault(key, []).append(image_path)
+
+    if reference:
+        for members in groups.values():
+            members.sort(key=lambda i: not fnmatch(i.name, reference))
+
+    return groups
+
+
+def read_subject(image_path: Path,
+                 args: argparse.Namespace,
+                 scratch_dir: Optional[str] = None,
+                 profiler: Optional[Profiler] = None) -> dict:
+    """Read a subject's image, and open the files to crop.
+
+    Args:
+        image_path (Path): Path of the subject's image.
+        args (argparse.Namespace): CLI arguments.
+        scratch_dir (Optional[str], optional): Directory where gzipped files
+            are decompressed, so that their crops are memory-mapped.
+            Defaults to None, reading them with ANTs.
+        profiler (Optional[Profiler], optional): Profiler recording the
+            "read" stage. Defaults to None.
+
+    Returns:
+        dict: Subject's path, image, files to crop, their LazyImage and
+            scratch directory
+    """
+    profiler = profiler or Profiler(enabled=False)
+
+    extra_files = find_extra_files(image_path, args)
+
+    with profiler.stage("read", image_path):
+        image, sources = _read_sources(image_path, extra_files, scratch_dir)
+
+    # Each file is read at most once, and only its cropped regions if it is
+    # an uncompressed NIfTI
+    sources[image_path] = LazyImage(image_path, image=image)
+
+    return {
+        "path": image_path,
+        "image": image,
+        "files": [image_path, *extra_files],
+        "sources": sources,
+        "scratch_dir": scratch_dir,
+    }
+
+
+def _read_sources(image_path: Path, extra_files: list,
+                  scratch_dir: Optional[str]) -> tuple:
+    """Read a subject's image, and open its extra files as LazyImage."""
+    if scratch_dir:
+        decompressed = decompress(image_path, scratch_dir)
+        image = ants.image_read(str(decompressed),
+                                pixeltype="float",
+                                reorient="LPI")
+        if decompressed != image_path:
+            os.remove(decompressed)
+
+        sources = {
+            file: LazyImage(decompress(file, scratch_dir))
+            for file in extra_files
+        }
+    else:
+        image = ants.image_read(str(image_path),
+                                pixeltype="float",
+                                reorient="LPI")
+        sources = {file: LazyImage(file) for file in extra_files}
+
+    return image, sources
+
+
+def process_subject(image_path: Path,
+                    args: argparse.Namespace,
+                    rois_idx: dict,
+                    profiler: Optional[Profiler] = None,
+                    group: Optional[dict] = None) -> dict:
+    """Register, locate and crop the ROIs of a single subject.
+
+    Args:
+        image_path (Path): Path of the subject's image.
+        args (argparse.Namespace): CLI arguments.
+        rois_idx (dict): Right & left CerebrA indices of each ROI.
+        profiler (Optional[Profiler], optional): Profiler recording the
+            stages. Defaults to None, creating one if `--profile-report`
+            is given.
+        group (Optional[dict], optional): State shared by the images of
+            the subject's group, see `crop_subject`. Defaults to None.
+
+    Returns:
+        dict: Written outputs, coordinates table rows, profiling records and
+            fingerprint of the inputs (see `manifest.fingerprint`) of the
+            subject, e.g. to be gathered from worker processes
+    """
+    if profiler is None:
+        profiler = Profiler(
+            enabled=getattr(args, "profile_report", None) is not None)
+
+    result = crop_subject(read_subject(image_path, args, profiler=profiler),
+                          args,
+                          rois_idx,
+                          profiler=profiler,
+                          group=group)
+
+    # Hashed here rather than before the run, e.g. in parallel workers
+    reference = group.get("path") if group else None
+    inputs = fingerprint(find_input_files(image_path, args, reference))
+
+    return {**result, "profile": profiler.records, "inputs": inputs}
+
+
+def process_group(images: list, args: argparse.Namespace,
+                  rois_idx: dict) -> list:
+    """Process the images of a group in order, in a single worker.
+
+    The failure of an image does not stop the group: if the reference
+    fails, the next image becomes the reference.
+
+    Args:
+        images (list): Paths of the group's images, reference first.
+        args (argparse.Namespace): CLI arguments.
+        rois_idx (dict): Right & left CerebrA indices of each ROI.
+
+    Returns:
+        list: Path, result (see `process_subject`) and error of each image
+    """
+    group = {}
+    results = []
+    for image_path in images:
+        try:
+            result = process_subject(image_path, args, rois_idx, group=group)
+            results.append((image_path, result, ""))
+        except Exception:
+            results.append((image_path, None, traceback.format_exc()))
+
+    return results
+
+
+def register_to_reference(image: ANTsImage,
+                          group: dict,
+                          mask: Optional[ANTsImage] = None,
+                          resolution: Optional[float] = None,
+                          outprefix: str = "") -> dict:
+    """Get the transforms of an image from those of its group's reference.
+
+    Transforms of the reference to the template are reused as is if both
+    images share the same voxel grid. Otherwise, the image is rigidly
+    registered to the reference, and both transforms are chained.
+
+    Args:
+        image (ANTsImage): Image, in LPI orientation.
+        group (dict): Reference image and its forward transforms to the
+            template, in memory, see `crop_subject`.
+        mask (Optional[ANTsImage], optional): Registration mask of the
+            image. Defaults to None.
+        resolution (Optional[float], optional): Resolution in mm at which
+            the image is registered. Defaults to None.
+        outprefix (str, optional): Prefix for ANTs' temporary files.
+
+    Returns:
+        dict: Forward transforms of the template to the image
+    """
+    if headers_match(image, group["image"]):
+        print("\tReusing the transforms of the group's reference...")
+        return {"fwdtransforms": group["fwdtransforms"]}
+
+    print("\tRegistering the group's reference to native space...")
+    fixed, moving = image, group["image"]
+    if resolution:
+        fixed = downsample(fixed, resolution)
+        moving = downsample(moving, resolution)
+        if mask is not None:
+            mask = downsample(mask, resolution, "nearestNeighbor")
+    rigid = register(fixed, moving, "Rigid", mask=mask, outprefix=outprefix)
+
+    # Points of the image are mapped to the reference, then to the template
+    return {
+        "fwdtransforms":
+            read_transforms(rigid["fwdtransforms"]) + group["fwdtransforms"]
+    }
+
+
+@handle_cache
+def crop_subject(subject: dict,
+                 args: argparse.Namespace,
+                 rois_idx: dict,
+                 write: Optional[Callable] = None,
+                 profiler: Optional[Profiler] = None,
+                 outprefix: str = "",
+                 group: Optional[dict] = None) -> dict:
+    """Register, locate and crop the ROIs of a subject already read.
+
+    With `--coords-only`, ROIs are only located, and nothing is cropped.
+
+    Args:
+        subject (dict): Subject, as returned by `read_subject`.
+        args (argparse.Namespace): CLI arguments.
+        rois_idx (dict): Right & left CerebrA indices of each ROI.
+        write (Optional[Callable], optional): Function writing crops,
+            see `location.crop`. Defaults to None, writing crops
+            synchronously.
+        profiler (Optional[Profiler], optional): Profiler recording the
+            stages. Defaults to None.
+        outprefix (str, optional): Prefix for ANTs' temporary files.
+        group (Optional[dict], optional): State shared by the images of a
+            group (see `--group-by`). The first image of the group is
+            registered to the template, and its transforms are kept in
+            `group` for the next ones, see `register_to_reference`.
+            Defaults to None, registering every image to the template.
+
+    Returns:
+        dict: Paths of the written files, rows of the coordinates table
+            (see `coords.coords_row`), and registration attempts (see
+            `registration.register_with_fallback`)
+    """
+    profiler = profiler or Profiler(enabled=False)
+
+    image_path, image = subject["path"], subject["image"]
+    files, sources = subject["files"], subject["sources"]
+    image_stem = image_path.stem.split(".")[0]
+
+    template = getattr(args, "template", DEFAULT_TEMPLATE)
+    with profiler.stage("template", image_path):
+        mni = get_mni(args.contrast, args.bet, template=template)
+        atlas = get_atlas(template=template)
+
+    print(f"\n[bold blue]Processing {str(image_path)}")
+
+    with profiler.stage("read", image_path):
+        mask = get_mask(image_path.parent, args.mask)
+
+    if write is None:
+
+        def write(cropped_image, path):
+            with profiler.stage("write", image_path):
+                write_image(cropped_image,
+                            path,
+                            compresslevel=getattr(args, "compresslevel", 6))
+
+    outputs = []
+    rows = []
+    coords_only = getattr(args, "coords_only", False)
+    output_format = getattr(args, "outputformat", "nii.gz")
+    grid = make_grid(getattr(args, "gridshape", None),
+                     getattr(args, "gridspacing", None),
+                     getattr(args, "gridinterpolation", "linear"))
+
+    def write_output(cropped_image, path):
+        outputs.extend([path, path.with_suffix(".txt")])
+        write(cropped_image, path)
+
+    # Crops and coordinates of the subject's archive, with `npz` outputs
+    archive = {}
+
+    def add_to_archive(cropped_image, path, coords):
+        key = path.name[:-len(f"_{args.transform}_crop.npz")]
+        archive[key] = (cropped_image, coords)
+
+    resolution = getattr(args, "regresolution", None)
+    template_name = get_mni_name(args.contrast, args.bet, template)
+    if resolution:
+        template_name += f"@{resolution}mm"
 
-import ants
-from rich import print
-from rich.console import Console
-from rich.progress import track
+    # Initialization and fallbacks change the transforms, so they are part
+    # of their key
+    init = getattr(args, "init", "none")
+    fallback = getattr(args, "fallback", [])
+    min_quality = getattr(args, "minquality", MIN_QUALITY)
+    transform_type = args.transform if init == "none" else (
+        f"{args.transform}+{init}")
+    if fallback:
+        transform_type += f">{'>'.join(fallback)}@{min_quality}"
 
-from roiloc.location import crop, get_coords
-from roiloc.registration import get_roi, register
-from roiloc.template import get_atlas, get_mni, get_roi_indices
+    registration = None
+    attempts = []
+    store = None
+    key = ""
+    if group is not None and "image" in group:
+        with profiler.stage("registration", image_path):
+            registration = register_to_reference(image,
+                                                 group,
+                                                 mask=mask,
+                                                 resolution=resolution,
+                                                 outprefix=outprefix)
+    elif getattr(args, "transformcache", None):
+        store = TransformStore(args.transformcache,
+                               max_size=args.transformcachesize * 1024**2
+                               if args.transformcachesize else None)
+        key = store.key(image, template_name, transform_type, mask)
+        registration = store.get(key)
+        if registration is not None:
+            print("\tReusing stored transforms...")
 
-console = Console()
+    if registration is None:
+        fixed, moving = image, mni
+        if resolution:
+            fixed = downsample(image, resolution)
+            moving = get_mni(args.contrast,
+                             args.bet,
+                             resolution=resolution,
+                             template=template)
+            if mask is not None:
+                mask = downsample(mask, resolution, "nearestNeighbor")
+
+        initial_transform = None
+        if init == "com":
+            with profiler.stage("initialization", image_path):
+                initial_transform = center_of_mass_transform(
+                    fixed, moving, outprefix=outprefix)
+
+        print("\tRegistering MNI to native space...")
+        with profiler.stage("registration", image_path):
+            registration = register_with_fallback(
+                fixed,
+                moving, [args.transform, *fallback],
+                min_quality,
+                mask=mask,
+                outprefix=outprefix,
+                initial_transform=initial_transform)
+        attempts = registration["attempts"]
+
+        if store is not None:
+            # The store only keeps the transforms
+            registration = {
+                **store.put(key, registration), "quality":
+                    registration["quality"]
+            }
+
+    if group is not None and "image" not in group:
+        # Reference of the group, whose transforms are kept in memory for
+        # the other images
+        group["image"] = image
+        group["path"] = image_path
+        group["fwdtransforms"] = read_transforms(registration["fwdtransforms"])
+
+    labels = [int(i) for idx in rois_idx.values() for i in idx]
+    linear = all(is_linear(t) for t in registration["fwdtransforms"])
+
+    if getattr(args, "coordsmode",
+               "warp") == "corners" and linear and not args.savesteps:
+        with profiler.stage("get_coords", image_path):
+            boxes = transform_labels_bbox(get_atlas_bboxes(template=template),
+                                          labels, atlas,
+                                          image, registration["fwdtransforms"])
+    else:
+        with profiler.stage("apply_transforms", image_path):
+            registered_atlas = apply_transforms(
+                fixed=image,
+                moving=atlas,
+                transformlist=registration["fwdtransforms"],
+                interpolator="nearestNeighbor")
+
+        if args.savesteps:
+            print("\tSaving intermediate files...")
+            for suffix, step in [("_LPI", image),
+                                 ("_CerebrA", registered_atlas)]:
+                step_path = image_path.parent / (image_stem + suffix +
+                                                 ".nii.gz")
+                ants.image_write(step, str(step_path))
+                outputs.append(step_path)
+
+        with profiler.stage("get_coords", image_path):
+            boxes = get_labels_bbox(registered_atlas.numpy(), labels)
+
+    action = "Locating" if coords_only else "Transforming and saving"
+    for roi in rois_idx:
+        print(f"\t{action} {roi}...")
+
+        for i, side in enumerate(["right", "left"]):
+            if args.savesteps:
+                mask_file = f"{image_stem}_{roi}_{side}_{args.transform}_mask.nii.gz"
+                with profiler.stage("get_roi", image_path):
+                    get_roi(registered_atlas=registered_atlas,
+                            idx=int(rois_idx[roi][i]),
+                            output_dir=str(image_path.parent),
+                            output_file=mask_file,
+                            save=True)
+                outputs.append(image_path.parent / mask_file)
+
+            bbox = boxes[int(rois_idx[roi][i])]
+            if bbox is None:
+                print(
+                    f"[bold red]\t{roi} ({side}) not found in the registered atlas, skipping..."
+                )
+                continue
+
+            offset = args.rightoffset if side == "right" else args.leftoffset
+            coords = apply_margin(bbox,
+                                  image.shape,
+                                  margin=args.margin,
+                                  offset=offset)
+            rows.append(
+                coords_row(image_path.resolve(), roi, side, coords,
+                           image.shape, image.spacing, template_name,
+                           args.transform, key, registration.get("quality")))
+
+            if coords_only:
+                continue
+
+            for file in files:
+                fstem = file.stem.split(".")[0]
+                with profiler.stage("crop", image_path):
+                    crop(sources[file],
+                         coords,
+                         image_path.parent /
+                         (f"{fstem}_{roi}_{side}_{args.transform}_crop."
+                          f"{output_format}"),
+                         log_coords=output_format != "npz",
+                         write=partial(add_to_archive, coords=coords)
+                         if output_format == "npz" else write_output,
+                         grid=grid)
+
+    if archive:
+        archive_path = image_path.parent / (
+            f"{image_stem}_{args.transform}_crops.npz")
+        outputs.append(archive_path)
+        write(archive, archive_path)
+
+    return {"outputs": outputs, "coords": rows, "attempts": attempts}
+
+
+def report_failure(image_path: Path, error: str, console=None):
+    """Print the traceback of a subject that failed.
+
+    Args:
+        image_path (Path): Path of the subject's image.
+        error (str): Formatted traceback.
+        console (optional): Rich console to print to, e.g. that of a
+            progress bar. Defaults to None, the global console.
+    """
+    console = console or get_console()
+    console.print(f"[bold red]Failed to process {str(image_path)}:")
+    console.print(error.rstrip(), markup=False, highlight=False)
+
+
+def process_stream(images: list,
+                   args: argparse.Namespace,
+                   rois_idx: dict,
+                   queuesize: int,
+                   profiler: Optional[Profiler] = None,
+                   record: Optional[Callable] = None,
+                   groups: Optional[Callable] = None) -> list:
+    """Process subjects as a streaming pipeline.
+
+    The next subjects are read, and the crops of the previous ones written,
+    while the current subject is registered. The failure of a subject, or
+    of the writes of its crops, does not stop the pipeline.
+
+    Args:
+        images (list): Paths of the subjects' images.
+        args (argparse.Namespace): CLI arguments.
+        rois_idx (dict): Right & left CerebrA indices of each ROI.
+        queuesize (int): Number of subjects read ahead.
+        profiler (Optional[Profiler], optional): Profiler recording the
+            stages, including the background ones. Defaults to None.
+        record (Optional[Callable], optional): Function called as
+            `record(image_path, outputs, coords, error=error,
+            attempts=attempts, inputs=inputs)` once the crops of a subject
+            are written. Defaults to None.
+        groups (Optional[Callable], optional): Function returning the
+            state of the group of an image, see `crop_subject`. Defaults
+            to None.
+
+    Returns:
+        list: Paths of the subjects that failed.
+    """
+    from rich.progress import track
+
+    profiler = profiler or Profiler(enabled=False)
+    scratch_root = tempfile.mkdtemp()
+
+    def read_all():
+        for image_path in images:
+            scratch_dir = tempfile.mkdtemp(dir=scratch_root)
+            try:
+                yield read_subject(image_path,
+                                   args,
+                                   scratch_dir=scratch_dir,
+                                   profiler=profiler)
+            except Exception:
+                yield {
+                    "path": image_path,
+                    "scratch_dir": scratch_dir,
+                    "error": traceback.format_exc()
+                }
+
+    def timed_write(image, path, subject):
+        with profiler.stage("write", subject):
+            write_image(image,
+                        path,
+                        compresslevel=getattr(args, "compresslevel", 6),
+                        scratch_dir=scratch_root)
+
+    def record_written(futures, image_path, outputs, coords, attempts,
+                       reference):
+        # Writes of the subject may still run in other writer threads
+        wait(futures)
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        error = "".join(traceback.format_exception(
+            type(errors[0]), errors[0], errors[0].__traceback__)) \
+            if errors else ""
+        if record is not None:
+            record(image_path,
+                   outputs,
+                   coords,
+                   error=error,
+                   attempts=attempts,
+                   inputs=fingerprint(
+                       find_input_files(image_path, args, reference)))
+
+        return error
+
+    # Failed writes are recorded as failed subjects, see `record_written`
+    recorded = []
+    failed = []
+    try:
+        with AsyncWriter(maxsize=8 * queuesize,
+                         workers=getattr(args, "writers", 1),
+                         raise_errors=False) as writer:
+            for subject in track(prefetch(read_all(), size=queuesize),
+                                 total=len(images)):
+                image_path = subject["path"]
+                group = groups(image_path) if groups else None
+                futures = []
+
+                def write(image, path, subject=image_path):
+                    futures.append(
+                        writer.submit(timed_write, image, path, subject))
+
+                # Failed to read, see `read_all`
+                error = subject.get("error")
+                if error is None:
+                    try:
+                        result = crop_subject(subject,
+                                              args,
+                                              rois_idx,
+                                              write=write,
+                                              profiler=profiler,
+                                              group=group)
+                    except Exception:
+                        error = traceback.format_exc()
+
+                # Crops are copies, decompressed files are no longer needed
+                rmtree(subject["scratch_dir"])
+
+                if error is not None:
+                    if record is not None:
+                        record(image_path, [], error=error)
+                    report_failure(image_path, error)
+                    failed.append(image_path)
+                    continue
+
+                # Inputs are hashed in the background too
+                recorded.append((image_path,
+                                 writer.submit(
+                                     record_written, futures, image_path,
+                                     result["outputs"], result["coords"],
+                                     result["attempts"],
+                                     group.get("path") if group else None)))
+
+        for image_path, future in recorded:
+            error = future.result()
+            if error:
+                report_failure(image_path, error)
+                failed.append(image_path)
+    finally:
+        rmtree(scratch_root, ignore_errors=True)
+
+    return failed
+
+
+def process_parallel(images: list,
+                     args: argparse.Namespace,
+                     rois_idx: dict,
+                     jobs: int,
+                     threads: Optional[int] = None,
+                     profiler: Optional[Profiler] = None,
+                     record: Optional[Callable] = None,
+                     groups: Optional[list] = None) -> list:
+    """Process subjects in a pool of `jobs` processes.
+
+    Args:
+        images (list): Paths of the subjects' images.
+        args (argparse.Namespace): CLI arguments.
+        rois_idx (dict): Right & left CerebrA indices of each ROI.
+        jobs (int): Number of worker processes.
+        threads (int, optional): ITK threads per worker. Defaults to None.
+        profiler (Optional[Profiler], optional): Profiler gathering the
+            records of the workers. Defaults to None.
+        record (Optional[Callable], optional): Function called as
+            `record(image_path, outputs, coords, error=error,
+            attempts=attempts, inputs=inputs)` when a subject completes.
+            Defaults to None.
+        groups (Optional[list], optional): Images of each group, each group
+            being processed by a single worker. Defaults to None.
+
+    Returns:
+        list: Paths of the subjects that failed.
+    """
+    from rich.progress import Progress
+
+    threads = thread_budget(jobs, threads)
+    print(f"Running {jobs} workers with {threads} ITK thread(s) each...")
+
+    failed = []
+    with Progress(console=get_console()) as progress:
+        task = progress.add_task("Processing...", total=len(images))
+        for result in run_parallel(process_group if groups else
+                                   process_subject,
+                                   groups or images,
+                                   jobs=jobs,
+                                   threads=threads,
+                                   args=args,
+                                   rois_idx=rois_idx):
+            if result.log:
+                progress.console.print(result.log.rstrip(),
+                                       markup=False,
+                                       highlight=False)
+
+            if not groups:
+                subjects = [(result.item, result.value, result.error)]
+            elif result.ok:
+                subjects = result.value
+            else:
+                # The worker died, failing the whole group
+                subjects = [(i, None, result.error) for i in result.item]
+
+            for image_path, value, error in subjects:
+                if value is not None and profiler is not None:
+                    profiler.extend(value["profile"])
+                if record is not None:
+                    record(image_path,
+                           value["outputs"] if value is not None else [],
+                           value["coords"] if value is not None else [],
+                           error=error,
+                           attempts=value["attempts"]
+                           if value is not None else None,
+                           inputs=value["inputs"]
+                           if value is not None else None)
+                if value is None:
+                    failed.append(image_path)
+                    report_failure(image_path, error, progress.console)
+                progress.advance(task)
+
+    return failed
 
 
 def main(args):
     print(
         "For information purposes, you are currently running ROILoc with the following config:"
     )
-    console.log(args)
-
-    cache_dir = tempfile.mkdtemp() + "/"
+    get_console().log(args)
 
     path = Path(args.path).expanduser()
 
-    # Getting roi from cerebra's csv
-    rois_idx = {roi: get_roi_indices(roi) for roi in args.roi}
+    report = getattr(args, "profile_report", None)
+    profiler = Profiler(enabled=report is not None)
+
+    # Getting the labels of the ROIs from the atlas' lookup
+    template = getattr(args, "template", DEFAULT_TEMPLATE)
+    with profiler.stage("template"):
+        rois_idx = {roi: get_roi_indices(roi, template) for roi in args.roi}
 
     # Loading mris, template and atlas
     images = list(path.glob(args.inputpattern))
@@ -40,78 +771,180 @@ def main(args):
             "[bold red]Warning: no image found. Please double check your path and pattern."
         )
 
-    mni = get_mni(args.contrast, args.bet)
-    atlas = get_atlas()
+    # Images of a subject registered once, with their group's reference
+    groups = None
+    references = {}
+    if getattr(args, "group_by", None):
+        groups = group_images(images,
+                              args.group_by,
+                              reference=getattr(args, "group_reference",
+                                                None))
+        images = [i for members in groups.values() for i in members]
+        references = {
+            i: members[0] for members in groups.values() for i in members
+        }
+        print(f"Grouped {len(images)} images in {len(groups)} group(s)...")
 
-    for image_path in track(images):
-        image_stem = image_path.stem.split(".")[0]
+    if getattr(args, "plan", False):
+        from roiloc.planner import plan_run, print_plan
 
-        extra_files = [
-            f for f_ in [image_path.parent.glob(e) for e in args.extracrops]
-            for f in f_
-        ]
-        files = [image_path, *extra_files]
+        print_plan(
+            plan_run(images,
+                     args,
+                     rois_idx,
+                     recalibrate=getattr(args, "recalibrate", False)))
+        return
 
-        print(f"\n[bold blue]Processing {str(image_path)}")
-        image = ants.image_read(str(image_path),
-                                pixeltype="float",
-                                reorient="LPI")
+    # Subjects already processed with the same inputs and parameters are
+    # skipped when resuming
+    manifest = RunManifest(
+        getattr(args, "manifest", None) or path / "roiloc_manifest.jsonl")
+    params = {p: getattr(args, p, None) for p in OUTPUT_PARAMS}
+    subjects = list(images)
 
-        print("\tRegistering MNI to native space...")
-        registration = register(image,
-                                mni,
-                                args.transform,
-                                path=image_path.parent,
-                                mask=args.mask,
-                                outprefix=cache_dir)
-
-        registered_atlas = ants.apply_transforms(
-            fixed=image,
-            moving=atlas,
-            transformlist=registration["fwdtransforms"],
-            interpolator="nearestNeighbor")
+    # Rows of the coordinates table, by subject
+    table = getattr(args, "coordstable", None)
+    if table is None and getattr(args, "coords_only", False):
+        table = path / "roiloc_coords.csv"
+    rows = {}
 
-        if args.savesteps:
-            print("\tSaving intermediate files...")
-            ants.image_write(
-                image,
-                str(image_path.parent /
-                    (str(image_path.stem).split(".")[0] + "_LPI.nii.gz")))
-            ants.image_write(
-                registered_atlas,
-                str(image_path.parent /
-                    (str(image_path.stem).split(".")[0] + "_CerebrA.nii.gz")))
-
-        for roi in rois_idx:
-            print(f"\tTransforming and saving {roi}...")
-
-            for i, side in enumerate(["right", "left"]):
-                region = get_roi(
-                    registered_atlas=registered_atlas,
-                    idx=int(rois_idx[roi][i]),
-                    output_dir=str(image_path.parent),
-                    output_file=
-                    f"{image_stem}_{roi}_{side}_{args.transform}_mask.nii.gz",
-                    save=args.savesteps)
-
-                offset = args.rightoffset if side == "right" else args.leftoffset
-                coords = get_coords(region.numpy(),
-                                    margin=args.margin,
-                                    offset=offset)
-
-                for file in files:
-                    fstem = file.stem.split(".")[0]
-                    crop(ants.image_read(str(file), reorient="LPI"),
-                         coords,
-                         image_path.parent /
-                         f"{fstem}_{roi}_{side}_{args.transform}_crop.nii.gz",
-                         log_coords=True)
+    if getattr(args, "resume", False):
+        done = {}
+        for image_path in images:
+            # Inputs are only hashed for subjects recorded as done
+            if not manifest.has_done(image_path.resolve()):
+                continue
+            key = manifest.key(
+                manifest.fingerprint(
+                    find_input_files(image_path, args,
+                                     references.get(image_path))), params)
+            if manifest.is_done(image_path.resolve(), key):
+                done[image_path] = key
+        if groups is not None:
+            # Groups are processed again as a whole, from their reference,
+            # the others keeping their manifest keys to restore their rows
+            done = {
+                i: done[i] for members in groups.values()
+                if all(m in done for m in members) for i in members
+            }
+            groups = {
+                k: members for k, members in groups.items()
+                if not all(m in done for m in members)
+            }
+        if done:
+            print(f"Skipping {len(done)} subject(s) already processed...")
+        for image_path, key in done.items():
+            rows[image_path] = manifest.get(image_path.resolve(),
+                                            key).get("coords", [])
+        images = [i for i in images if i not in done]
+
+    def record(image_path,
+               outputs,
+               coords=None,
+               error="",
+               attempts=None,
+               inputs=None):
+        if inputs is None:
+            # Failed in a worker, or before it hashed the inputs
+            try:
+                inputs = manifest.fingerprint(
+                    find_input_files(image_path, args,
+                                     references.get(image_path)))
+            except OSError:
+                inputs = {}
+        rows[image_path] = coords or []
+        manifest.record(image_path.resolve(),
+                        manifest.key(inputs, params),
+                        inputs,
+                        params,
+                        outputs,
+                        status="failed" if error else "done",
+                        error=error,
+                        coords=coords,
+                        attempts=attempts)
+
+    # State of the group being processed, see `crop_subject`
+    states = {}
+
+    def group_state(image_path):
+        if groups is None:
+            return None
+        reference = references[image_path]
+        if reference not in states:
+            # Groups are contiguous, the previous one is done
+            states.clear()
+            states[reference] = {}
+        return states[reference]
+
+    jobs = getattr(args, "jobs", 1)
+    threads = getattr(args, "threads", None)
+
+    failed = []
+    try:
+        if jobs > 1:
+            failed = process_parallel(
+                images, args, rois_idx, jobs, threads, profiler, record,
+                list(groups.values()) if groups is not None else None)
+        else:
+            if threads:
+                set_thread_budget(threads)
+
+            queuesize = getattr(args, "queuesize", 0)
+            if queuesize > 0:
+                failed = process_stream(images, args, rois_idx, queuesize,
+                                        profiler, record, group_state)
+            else:
+                from rich.progress import track
+
+                for image_path in track(images):
+                    try:
+                        result = process_subject(image_path, args, rois_idx,
+                                                 profiler,
+                                                 group_state(image_path))
+                    except Exception:
+                        error = traceback.format_exc()
+                        record(image_path, [], error=error)
+                        report_failure(image_path, error)
+                        failed.append(image_path)
+                        continue
+                    record(image_path,
+                           result["outputs"],
+                           result["coords"],
+                           attempts=result["attempts"],
+                           inputs=result["inputs"])
+
+        print(f"\n[bold]Processed {len(images) - len(failed)}/{len(images)} "
+              "subjects successfully.")
+    finally:
+        if table is not None:
+            write_coords_table([
+                row for image_path in subjects
+                for row in rows.get(image_path, [])
+            ], table)
+            print(f"Coordinates table written to {table}")
+        if report is not None:
+            profiler.dump(report)
+            print(f"Profiling report written to {report}")
+
+    if failed:
+        print("[bold red]The following subjects failed:")
+        for image_path in failed:
+            print(f"\t{str(image_path)}")
+        return
 
-    rmtree(cache_dir)
     print("[bold green]Done! :)")
 
 
-def start():
+def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
+    """Parse the CLI arguments.
+
+    Args:
+        argv (Optional[list], optional): Arguments to parse. Defaults to
+            None, parsing `sys.argv`.
+
+    Returns:
+        argparse.Namespace: CLI arguments
+    """
     parser = argparse.ArgumentParser(
         description=
         "Locate the Hippocampus or any other CerebrA ROI by using MNI152 Template and CerebrA Atlas"
@@ -148,6 +981,14 @@ def start():
         required=True,
         type=str)
 
+    parser.add_argument(
+        "--template",
+        help=
+        "Templates and atlas to register to: name of a registry entry, or JSON file describing one (see `roiloc/registry.py`). Default: `mni_icbm152_09c`, the MNI152 09c templates and CerebrA atlas.",
+        required=False,
+        type=str,
+        default=DEFAULT_TEMPLATE)
+
     parser.add_argument(
         "-b",
         "--bet",
@@ -166,6 +1007,32 @@ def start():
         default="AffineFast",
         type=str)
 
+    parser.add_argument(
+        "--init",
+        help=
+        "Initialization of the registration: `none` aligns the centers of mass of the intensities, `com` the centers of the heads' foregrounds, ignoring what lies below the head (e.g. neck coverage, large field of view). Default: `none`",
+        required=False,
+        choices=["none", "com"],
+        type=str,
+        default="none")
+
+    parser.add_argument(
+        "--fallback",
+        nargs='+',
+        help=
+        "Types of registration tried in turn when the quality of the registration, the normalized mutual information of the image and registered template from 0 to 1, is below `--minquality` (e.g. `Affine SyNRA`). Default: no fallback.",
+        required=False,
+        type=str,
+        default=[])
+
+    parser.add_argument(
+        "--minquality",
+        help=
+        "Quality from which a registration is accepted, see `--fallback`. Scores of all subjects are recorded in the manifest and coordinates table, to calibrate it. Default: 0.2",
+        required=False,
+        type=float,
+        default=MIN_QUALITY)
+
     parser.add_argument(
         "-m",
         "--margin",
@@ -219,7 +1086,201 @@ def start():
         action='store_true',
         default=False)
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--coords-only",
+        help=
+        "Flag to only locate ROIs, without reading or writing any crop. Coordinates are written to the table given by `--coordstable`, to crop images later with `roiloc crop --from-coords`.",
+        required=False,
+        dest="coords_only",
+        action='store_true',
+        default=False)
+
+    parser.add_argument(
+        "--coordstable",
+        help=
+        "Path of a CSV (or `.parquet`) table of the coordinates, voxel spacing and transforms of every located ROI. Default: `roiloc_coords.csv` in the input images path with `--coords-only`, else no table.",
+        required=False,
+        type=str,
+        default=None)
+
+    parser.add_argument(
+        "--outputformat",
+        help=
+        "Format of the crops: `nii.gz`, `nii` (uncompressed, faster to write and read), or `npz` (a single `<image>_<transform>_crops.npz` archive per subject with all its crops and their coordinates, see `roiloc.pipeline.read_archive`). Default: `nii.gz`",
+        required=False,
+        choices=["nii.gz", "nii", "npz"],
+        type=str,
+        default="nii.gz")
+
+    parser.add_argument(
+        "--compresslevel",
+        help=
+        "Compression level of the crops, from 0 (none) to 9 (smallest, slowest). Default: 6",
+        required=False,
+        choices=range(10),
+        metavar="{0-9}",
+        type=int,
+        default=6)
+
+    parser.add_argument(
+        "--writers",
+        help=
+        "Number of threads writing crops in the background. Ignored with `--queuesize 0` or `--jobs`. Default: 1",
+        required=False,
+        type=int,
+        default=1)
+
+    parser.add_argument(
+        "--gridshape",
+        nargs=3,
+        type=int,
+        help=
+        "Shape in voxels of a fixed grid on which crops are resampled, centred on the ROIs (e.g. 64 64 64), so that all crops have the same shape and spacing. Default: crops of the ROIs' coordinates.",
+        required=False,
+        default=None)
+
+    parser.add_argument(
+        "--gridspacing",
+        nargs='+',
+        type=float,
+        help=
+        "Isotropic spacing, or spacing of each axis, in mm of the grid given by `--gridshape`. Default: 1",
+        required=False,
+        default=None)
+
+    parser.add_argument(
+        "--gridinterpolation",
+        help=
+        "Interpolation of the crops resampled on the grid given by `--gridshape`. Use `genericLabel` for label images. Default: `linear`",
+        required=False,
+        choices=["linear", "nearestNeighbor", "genericLabel", "bSpline"],
+        type=str,
+        default="linear")
+
+    parser.add_argument(
+        "--coordsmode",
+        help=
+        "How to locate ROIs in native space: `warp` resamples the whole atlas, `corners` only transforms the corners of the ROIs' bounding boxes (faster, slightly conservative, linear transforms only). Default: `warp`",
+        required=False,
+        choices=["warp", "corners"],
+        type=str,
+        default="warp")
+
+    parser.add_argument(
+        "--regresolution",
+        help=
+        "Resolution in mm at which images are registered (e.g. 2 or 3 for a fast registration). Transforms are still applied at native resolution. Default: full resolution.",
+        required=False,
+        type=float,
+        default=None)
+
+    parser.add_argument(
+        "--transformcache",
+        help=
+        "Directory of a persistent store of registration transforms, reused when processing the same image again (e.g. with other ROIs or margins).",
+        required=False,
+        type=str,
+        default=None)
+
+    parser.add_argument(
+        "--transformcachesize",
+        help=
+        "Maximum size of the transform store in MB, least recently used transforms being evicted. Default: unbounded.",
+        required=False,
+        type=int,
+        default=None)
+
+    parser.add_argument(
+        "--group-by",
+        help=
+        "Regular expression matching the part of the images' paths identifying a subject (e.g. `sub-[^/]+`), to register a single reference image of each subject to the template. Other images of the subject (contrasts, sessions) reuse its transforms if they share its voxel grid, and are otherwise rigidly registered to it.",
+        required=False,
+        dest="group_by",
+        type=str,
+        default=None)
+
+    parser.add_argument(
+        "--group-reference",
+        help=
+        "Pattern of the file name of the reference image of each group given by `--group-by` (e.g. `*T1w*`). Default: first image of each group in sorted order.",
+        required=False,
+        dest="group_reference",
+        type=str,
+        default=None)
+
+    parser.add_argument(
+        "--queuesize",
+        help=
+        "Number of subjects read ahead, and of crops written in the background, while registering. 0 processes subjects one step at a time. Ignored with `--jobs`. Default: 2",
+        required=False,
+        type=int,
+        default=2)
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help=
+        "Number of subjects to process in parallel, each one in its own process. Default: 1",
+        required=False,
+        type=int,
+        default=1)
+
+    parser.add_argument(
+        "--threads",
+        help=
+        "Number of ITK threads used by each job. Default: number of CPUs divided by the number of jobs.",
+        required=False,
+        type=int,
+        default=None)
+
+    parser.add_argument(
+        "--manifest",
+        help=
+        "Path of the JSONL manifest recording the inputs, parameters, outputs and status of each processed subject. Default: `roiloc_manifest.jsonl` in the input images path.",
+        required=False,
+        type=str,
+        default=None)
+
+    parser.add_argument(
+        "--resume",
+        help=
+        "Flag to skip the subjects of the manifest already processed with the same inputs and parameters, and whose outputs still exist.",
+        required=False,
+        dest="resume",
+        action='store_true',
+        default=False)
+
+    parser.add_argument(
+        "--profile-report",
+        help=
+        "Path of a JSON report of the wall time, CPU time and peak memory of each processing stage of each subject.",
+        required=False,
+        dest="profile_report",
+        type=str,
+        default=None)
+
+    parser.add_argument(
+        "--plan",
+        help=
+        "Flag to only estimate the time, memory, scratch space and output size of the run from the images' headers, and recommend `--jobs` and `--threads`, without processing any subject. Costs are calibrated once per machine and configuration by processing synthetic phantoms.",
+        required=False,
+        dest="plan",
+        action="store_true",
+        default=False)
+
+    parser.add_argument(
+        "--recalibrate",
+        help="Flag to calibrate the costs of `--plan` again.",
+        required=False,
+        dest="recalibrate",
+        action="store_true",
+        default=False)
+
+    return parser.parse_args(argv)
+
+
+def start(argv: Optional[list] = None):
+    args = parse_args(argv)
 
     print("""[bold green]Copyright (C) 2021  Clément POIRET[/bold green]
 This program comes with [bold magenta]ABSOLUTELY NO WARRANTY[/bold magenta]; for help, launch it with `-h`.
@@ -1,5 +1,11 @@
-import ants
-from ants.core.ants_image import ANTsImage
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from ._lazy import ants
+
+if TYPE_CHECKING:
+    from ants.core import ANTsImage
 
 
 def is_lpi(image: ANTsImage) -> bool:
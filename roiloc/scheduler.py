@@ -0,0 +1,143 @@
+"""
+Process-pool scheduling of subjects, for the `roiloc` CLI and batch API.
+
+`ants` is deliberately not imported here: workers must set their ITK thread
+budget before ANTs creates its thread pool.
+"""
+
+import multiprocessing
+import os
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import redirect_stdout
+from io import StringIO
+from typing import Any, Callable, Iterable, Iterator, NamedTuple, Optional
+
+ITK_THREADS_ENV = "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"
+
+
+class SubjectResult(NamedTuple):
+    """Outcome of a subject processed by a worker.
+
+    Attributes:
+        item: Item given to the worker (e.g. the subject's image path).
+        ok (bool): Whether the subject was processed without error.
+        value: Value returned by the worker function, if any.
+        error (str): Formatted traceback if the subject failed.
+        log (str): Captured console output of the worker for this subject.
+    """
+    item: Any
+    ok: bool
+    value: Any = None
+    error: str = ""
+    log: str = ""
+
+
+def thread_budget(jobs: int, threads: Optional[int] = None) -> int:
+    """Get the number of ITK threads each worker is allowed to use.
+
+    Args:
+        jobs (int): Number of concurrent workers.
+        threads (int, optional): Explicit number of threads per worker.
+            Defaults to None, splitting the available cores between workers.
+
+    Returns:
+        int: Number of threads per worker
+    """
+    if threads:
+        return threads
+
+    return max(1, (os.cpu_count() or 1) // max(1, jobs))
+
+
+def set_thread_budget(threads: int):
+    """Limit the number of threads used by ITK in the current process.
+
+    It has to be called before any ANTs registration is run.
+
+    Args:
+        threads (int): Number of threads.
+    """
+    os.environ[ITK_THREADS_ENV] = str(threads)
+
+
+def _init_worker(threads: int):
+    """Pool initializer, sets the thread budget of a worker."""
+    set_thread_budget(threads)
+
+
+def _run(func: Callable, item: Any, kwargs: dict) -> SubjectResult:
+    """Run `func` on a single item, capturing its output and errors."""
+    log = StringIO()
+    try:
+        with redirect_stdout(log):
+            value = func(item, **kwargs)
+    except Exception:
+        return SubjectResult(item,
+                             False,
+                             error=traceback.format_exc(),
+                             log=log.getvalue())
+
+    return SubjectResult(item, True, value=value, log=log.getvalue())
+
+
+def run_parallel(func: Callable,
+                 items: Iterable,
+                 jobs: int,
+                 threads: Optional[int] = None,
+                 max_pending: Optional[int] = None,
+                 **kwargs) -> Iterator[SubjectResult]:
+    """Process items in a pool of `jobs` processes.
+
+    Each worker runs with `threads` ITK threads so that `jobs * threads`
+    does not oversubscribe the machine. Workers are spawned rather than
+    forked, as forking a process in which ITK already started threads is
+    unsafe. Items are consumed lazily, at most `max_pending` of them being
+    submitted at once, so that memory stays bounded on large iterables.
+
+    Args:
+        func (Callable): Picklable function called as `func(item, **kwargs)`.
+        items (Iterable): Items to process.
+        jobs (int): Number of worker processes.
+        threads (int, optional): ITK threads per worker. Defaults to None,
+            see `thread_budget`.
+        max_pending (int, optional): Maximum number of submitted items not
+            yet yielded. Defaults to None, twice the number of jobs.
+        **kwargs: Picklable keyword arguments forwarded to `func`.
+
+    Yields:
+        SubjectResult: Results, in completion order.
+    """
+    max_pending = max_pending or 2 * jobs
+    items = iter(items)
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=jobs,
+                             mp_context=context,
+                             initializer=_init_worker,
+                             initargs=(thread_budget(jobs,
+                                                     threads),)) as pool:
+        pending = {}
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[pool.submit(_run, func, item, kwargs)] = item
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                try:
+                    yield future.result()
+                except Exception:
+                    # The worker itself died (e.g. killed by the OOM killer)
+                    yield SubjectResult(item,
+                                        False,
+                                        error=traceback.format_exc())
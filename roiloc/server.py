@@ -0,0 +1,302 @@
+"""
+`roiloc serve`: long-running daemon keeping templates warm.
+
+The daemon listens on a local Unix socket (see `roiloc.client`), with an
+asyncio front end dispatching requests to a pool of worker processes, each
+one loading the templates and atlas once. Requests and responses are JSON
+lines:
+
+    {"command": "run", "argv": [...], "cwd": "..."}
+        Run the CLI with the given arguments, as `roiloc <argv>` would.
+    {"command": "coords", "path": "...", "contrast": "t1", "roi": "..."}
+        Locate ROIs in an image, other keys being `RoiLocator` arguments.
+    {"command": "crop", "path": "...", "output_dir": "...", ...}
+        Locate ROIs and write their crops, as the CLI does.
+    {"command": "ping"}
+
+Every response has a "status" (0 on success) and an "output", with the
+captured console output or the error's traceback.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+from pathlib import Path
+from typing import Optional
+
+from .client import socket_path
+from .scheduler import set_thread_budget, thread_budget
+
+# Locators of a worker, by parameters
+LOCATORS = {}
+
+
+def _init_server_worker(threads: int, contrasts: list):
+    """Pool initializer, loads the templates once per worker."""
+    set_thread_budget(threads)
+
+    from .template import get_atlas, get_atlas_bboxes, get_mni
+
+    for contrast in contrasts:
+        get_mni(contrast, bet=False)
+        get_mni(contrast, bet=True)
+    get_atlas()
+    get_atlas_bboxes()
+
+
+def run_cli(argv: list, cwd: str) -> dict:
+    """Run the CLI in a worker, capturing its output."""
+    from .roiloc import start
+
+    output = StringIO()
+    status = 0
+    try:
+        os.chdir(cwd)
+        with redirect_stdout(output), redirect_stderr(output):
+            start(argv)
+    except SystemExit as e:
+        # e.g. `--help` or invalid arguments
+        status = e.code if isinstance(e.code, int) else 1
+    except Exception:
+        output.write(traceback.format_exc())
+        status = 1
+
+    return {"status": status, "output": output.getvalue()}
+
+
+def _fit(params: dict):
+    from ._lazy import ants
+    from .locator import RoiLocator
+
+    params = dict(params)
+    path = Path(params.pop("path")).expanduser()
+
+    key = json.dumps(params, sort_keys=True)
+    if key not in LOCATORS:
+        LOCATORS[key] = RoiLocator(**params)
+    locator = LOCATORS[key]
+
+    image = ants.image_read(str(path), pixeltype="float", reorient="LPI")
+    locator.fit(image)
+
+    return path, image, locator
+
+
+def locate(params: dict) -> dict:
+    """Locate ROIs in an image in a worker."""
+    _, _, locator = _fit(params)
+
+    return {"status": 0, "output": "", "coords": locator.coords}
+
+
+def locate_and_crop(params: dict) -> dict:
+    """Locate ROIs in an image and write their crops, in a worker."""
+    from .location import crop
+    from .pipeline import write_image
+
+    params = dict(params)
+    output_dir = params.pop("output_dir", None)
+    path, image, locator = _fit(params)
+    output_dir = Path(output_dir or path.parent).expanduser()
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    coords = locator.coords if locator._multi else {
+        locator.rois[0]: locator.coords
+    }
+    stem = path.stem.split(".")[0]
+
+    # Empty crops are skipped by `crop`, only written files are returned
+    outputs = []
+
+    def write(cropped_image, output):
+        write_image(cropped_image, output)
+        outputs.append(str(output))
+
+    for roi, sides in coords.items():
+        for side, roi_coords in sides.items():
+            output = output_dir / (
+                f"{stem}_{roi}_{side}_{locator.transform_type}_crop.nii.gz")
+            crop(image, roi_coords, output, log_coords=True, write=write)
+
+    return {
+        "status": 0,
+        "output": "",
+        "coords": locator.coords,
+        "outputs": outputs
+    }
+
+
+def _call(func, *args) -> dict:
+    """Run a request in a worker, turning errors into responses."""
+    try:
+        return func(*args)
+    except Exception:
+        return {"status": 1, "output": traceback.format_exc()}
+
+
+class RoiLocServer:
+    """Daemon serving requests on a Unix socket.
+
+    Args:
+        path (Optional[str], optional): Path of the socket. Defaults to
+            None, see `roiloc.client.socket_path`.
+        jobs (int, optional): Number of worker processes, i.e. of requests
+            processed concurrently. Defaults to 1.
+        threads (Optional[int], optional): ITK threads per worker.
+            Defaults to None, see `thread_budget`.
+        contrasts (list, optional): Contrasts of the templates loaded by
+            the workers at startup. Defaults to ["t1", "t2"].
+
+    Exemples:
+        >>> RoiLocServer(jobs=4).run()
+    """
+
+    def __init__(self,
+                 path: Optional[str] = None,
+                 jobs: int = 1,
+                 threads: Optional[int] = None,
+                 contrasts: list = ["t1", "t2"]):
+        self.path = path or socket_path()
+        self.jobs = jobs
+        self.threads = thread_budget(jobs, threads)
+        self.contrasts = contrasts
+        self._pool = None
+
+    async def _dispatch(self, message: dict) -> dict:
+        command = message.get("command")
+        if command == "ping":
+            return {"status": 0, "output": "pong"}
+
+        if command == "run":
+            args = (run_cli, message["argv"], message.get("cwd", os.getcwd()))
+        elif command in ["coords", "crop"]:
+            params = {
+                k: v for k, v in message.items() if k != "command"
+            }
+            args = (locate if command == "coords" else locate_and_crop,
+                    params)
+        else:
+            return {"status": 1, "output": f"Unknown command {command}.\n"}
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, _call, *args)
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter):
+        try:
+            line = await reader.readline()
+            try:
+                response = await self._dispatch(json.loads(line))
+            except Exception:
+                response = {"status": 1, "output": traceback.format_exc()}
+
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def _check_socket(self):
+        """Remove the socket of a stopped daemon, or fail if one runs."""
+        if not os.path.exists(self.path):
+            return
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            try:
+                client.connect(self.path)
+            except OSError:
+                os.remove(self.path)
+                return
+
+        raise RuntimeError(f"A daemon already listens on {self.path}.")
+
+    async def serve(self):
+        self._check_socket()
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(sig, stop.set)
+
+        # Workers are spawned, as forking a process in which ITK already
+        # started threads is unsafe
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.jobs,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_server_worker,
+            initargs=(self.threads, self.contrasts))
+
+        # Start and warm up all workers before accepting requests
+        await asyncio.gather(*[
+            loop.run_in_executor(self._pool, os.getpid)
+            for _ in range(self.jobs)
+        ])
+
+        # The socket runs commands with our privileges, it is created
+        # readable and writable by the user only
+        umask = os.umask(0o077)
+        try:
+            server = await asyncio.start_unix_server(self.handle,
+                                                     path=self.path)
+        finally:
+            os.umask(umask)
+        print(f"Listening on {self.path} with {self.jobs} worker(s)...",
+              flush=True)
+
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            self._pool.shutdown(cancel_futures=True)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def run(self):
+        asyncio.run(self.serve())
+
+
+def start(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(
+        prog="roiloc serve",
+        description=
+        "Run ROILoc as a daemon on a Unix socket, keeping templates loaded. `roiloc` commands are then sent to it."
+    )
+    parser.add_argument(
+        "--socket",
+        help=
+        "Path of the Unix socket. Default: `$ROILOC_SOCKET`, or `roiloc-<uid>.sock` in `$XDG_RUNTIME_DIR` or the temporary directory.",
+        type=str,
+        default=None)
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of requests processed concurrently. Default: 1",
+        type=int,
+        default=1)
+    parser.add_argument(
+        "--threads",
+        help=
+        "Number of ITK threads used by each worker. Default: number of CPUs divided by the number of jobs.",
+        type=int,
+        default=None)
+    parser.add_argument(
+        "-c",
+        "--contrasts",
+        nargs="+",
+        help="Contrasts of the templates to keep loaded. Default: t1 t2",
+        type=str,
+        default=["t1", "t2"])
+
+    args = parser.parse_args(argv)
+
+    RoiLocServer(path=args.socket,
+                 jobs=args.jobs,
+                 threads=args.threads,
+                 contrasts=args.contrasts).run()
@@ -1,57 +1,257 @@
+from __future__ import annotations
+
 import importlib
-import ants
-import pandas as pd
-from ants.core.ants_image import ANTsImage
+import os
+from typing import TYPE_CHECKING, Optional
+
+from ._cache import MemoryCache
+from ._lazy import ants
+from .location import get_labels_bbox
+from .registration import downsample
+from .registry import DEFAULT_TEMPLATE, get_template_entry, load_index
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from ants.core import ANTsImage
 
 SUPPORTED_CONTRASTS = ["t1", "t2"]
 
+# Templates, atlases, indices and label table are loaded once per process
+# and shared read-only between callers.
+CACHE = MemoryCache()
+
+
+def get_mni_name(contrast: str,
+                 bet: bool,
+                 template: str = DEFAULT_TEMPLATE) -> str:
+    """Get the name of the MNI ICBM152 09c template file.
+
+    It also identifies the template, e.g. in transform stores.
+
+    Args:
+        contrast (str): MRI's contrast, t1 or t2
+        bet (bool): Bool to indicate the brain extraction status
+        template (str, optional): Registry entry, see `roiloc.registry`.
+            Defaults to the MNI ICBM152 09c templates.
+
+    Returns:
+        str: File name of the template, prefixed by the entry's name for
+            other entries
+    """
+    entry = get_template_entry(template)
+    if entry.name == DEFAULT_TEMPLATE:
+        assert contrast in SUPPORTED_CONTRASTS
+
+    name = os.path.basename(entry.template(contrast, bet))
+
+    return name if entry.name == DEFAULT_TEMPLATE else f"{entry.name}/{name}"
 
-def get_mni(contrast: str, bet: bool) -> ANTsImage:
+
+def get_mni(contrast: str,
+            bet: bool,
+            orientation: str = "LPI",
+            resolution: Optional[float] = None,
+            template: str = DEFAULT_TEMPLATE) -> ANTsImage:
     """Get the correct MNI ICBM152 09c Asym template,
     given contrast and BET status.
 
+    The template is cached, and must not be modified in place.
+
     Args:
         contrast (str): MRI's contrast, t1 or t2
         bet (bool): Bool to indicate the brain extraction status
+        orientation (str, optional): Orientation of the template.
+            Defaults to "LPI".
+        resolution (float, optional): Resolution in mm to downsample the
+            template to, e.g. for a fast registration. Defaults to None.
+        template (str, optional): Registry entry, see `roiloc.registry`.
+            Defaults to the MNI ICBM152 09c templates.
 
     Returns:
         ANTsImage: Correct MNI template
     """
-    assert contrast in SUPPORTED_CONTRASTS
+    entry = get_template_entry(template)
+    if entry.name == DEFAULT_TEMPLATE:
+        assert contrast in SUPPORTED_CONTRASTS
+
+    if resolution:
+        return CACHE.get(
+            ("mni", contrast, bool(bet), orientation, float(resolution),
+             entry.name),
+            lambda: downsample(
+                get_mni(contrast, bet, orientation, template=template),
+                resolution))
+
+    def load():
+        return ants.image_read(entry.template(contrast, bet),
+                               pixeltype="float",
+                               reorient=orientation)
+
+    return CACHE.get(("mni", contrast, bool(bet), orientation, entry.name),
+                     load)
 
-    betstr = "bet" if bet else ""
 
-    template = f"mni_icbm152_{contrast}{betstr}_tal_nlin_sym_09c.nii"
-    res = importlib.resources.files("roiloc")
-    data = str(res / "MNI" / "icbm152" / template)
-    return ants.image_read(str(data), pixeltype="float", reorient="LPI")
+def get_label_table() -> pd.DataFrame:
+    """Get CerebrA's label table, indexed by label name.
 
+    The table is cached, and must not be modified in place.
 
-def get_roi_indices(roi: str) -> list:
+    Returns:
+        pd.DataFrame: CerebrA_LabelDetails.csv
+    """
+
+    def load():
+        import pandas as pd
+
+        res = importlib.resources.files("roiloc")
+        data = str(res / "MNI" / "cerebra" / "CerebrA_LabelDetails.csv")
+        return pd.read_csv(data, index_col="Label Name")
+
+    return CACHE.get(("labels",), load)
+
+
+def get_labels(template: str = DEFAULT_TEMPLATE) -> dict:
+    """Get the right and left labels of each region of an atlas.
+
+    Args:
+        template (str, optional): Registry entry, see `roiloc.registry`.
+            Defaults to CerebrA.
+
+    Returns:
+        dict: Right & left labels, by region name
+    """
+    entry = get_template_entry(template)
+    if isinstance(entry.labels, dict):
+        return entry.labels
+
+    return get_atlas_index(template=template)["labels"]
+
+
+def get_roi_indices(roi: str, template: str = DEFAULT_TEMPLATE) -> list:
     """Get right and left indices from CerebrA atlas
 
     Args:
-        roi (str): ROI name
+        roi (str): ROI name, case insensitive
+        template (str, optional): Registry entry, see `roiloc.registry`.
+            Defaults to CerebrA.
 
     Returns:
         list: List of right & left indices
     """
-    roi = roi.title()
+    labels = get_labels(template)
+    if roi.title() in labels:
+        return list(labels[roi.title()])
 
-    res = importlib.resources.files("roiloc")
-    data = str(res / "MNI" / "cerebra" / "CerebrA_LabelDetails.csv")
-    cerebra = pd.read_csv(data, index_col="Label Name")
+    matches = [v for k, v in labels.items() if k.lower() == roi.lower()]
+    if not matches:
+        raise KeyError(f"{roi} is not a region of {template}.")
 
-    return [cerebra.loc[roi, "RH Label"], cerebra.loc[roi, "LH Labels"]]
+    return list(matches[0])
 
 
-def get_atlas() -> ANTsImage:
+def get_atlas(orientation: str = "LPI",
+              template: str = DEFAULT_TEMPLATE) -> ANTsImage:
     """Get the CerebrA atlas
 
+    The atlas is cached, and must not be modified in place.
+
+    Args:
+        orientation (str, optional): Orientation of the atlas.
+            Defaults to "LPI".
+        template (str, optional): Registry entry, see `roiloc.registry`.
+            Defaults to CerebrA.
+
     Returns:
         ANTsImage: CerebrA atlas
     """
-    res = importlib.resources.files("roiloc")
-    data = str(res / "MNI" / "cerebra" /
-               "mni_icbm152_CerebrA_tal_nlin_sym_09c.nii")
-    return ants.image_read(data, pixeltype="unsigned int", reorient="LPI")
+    entry = get_template_entry(template)
+
+    def load():
+        return ants.image_read(entry.atlas,
+                               pixeltype="unsigned int",
+                               reorient=orientation)
+
+    return CACHE.get(("atlas", orientation, entry.name), load)
+
+
+def get_atlas_index(template: str = DEFAULT_TEMPLATE) -> dict:
+    """Get the precomputed index of an atlas, see `registry.load_index`.
+
+    The index is built on first use, and cached.
+
+    Args:
+        template (str, optional): Registry entry, see `roiloc.registry`.
+            Defaults to CerebrA.
+
+    Returns:
+        dict: Bounding boxes and centroids of the labels in LPI orientation,
+            and labels of the regions
+    """
+    entry = get_template_entry(template)
+
+    return CACHE.get(("atlas_index", entry.name), lambda: load_index(entry))
+
+
+def get_atlas_bboxes(orientation: str = "LPI",
+                     template: str = DEFAULT_TEMPLATE) -> dict:
+    """Get the bounding box of every label of the CerebrA atlas.
+
+    In LPI orientation, the boxes are read from the atlas' index. They are
+    computed once and cached otherwise.
+
+    Args:
+        orientation (str, optional): Orientation of the atlas.
+            Defaults to "LPI".
+        template (str, optional): Registry entry, see `roiloc.registry`.
+            Defaults to CerebrA.
+
+    Returns:
+        dict: Inclusive minimum and maximum indices of each label in
+            MNI space, None for unused labels
+    """
+    entry = get_template_entry(template)
+
+    def load():
+        if orientation == "LPI":
+            boxes = get_atlas_index(template)["bboxes"]
+            return {
+                label: boxes.get(label)
+                for label in range(1, max(boxes, default=0) + 1)
+            }
+
+        atlas = get_atlas(orientation, template).numpy()
+        return get_labels_bbox(atlas, range(1, int(atlas.max()) + 1))
+
+    return CACHE.get(("atlas_bboxes", orientation, entry.name), load)
+
+
+def get_atlas_centroids(template: str = DEFAULT_TEMPLATE) -> dict:
+    """Get the centroid of every label of an atlas, from its index.
+
+    Args:
+        template (str, optional): Registry entry, see `roiloc.registry`.
+            Defaults to CerebrA.
+
+    Returns:
+        dict: Centroid of each label in voxels of the LPI atlas
+    """
+    return get_atlas_index(template)["centroids"]
+
+
+def clear_cache(*prefix):
+    """Invalidate cached templates, atlases and label table.
+
+    Args:
+        *prefix: Only invalidate matching keys, e.g. `clear_cache("mni")`
+            or `clear_cache("mni", "t2")`. Invalidate everything if empty.
+    """
+    CACHE.invalidate(*prefix)
+
+
+def cache_info() -> dict:
+    """Get statistics and memory usage of the template cache.
+
+    Returns:
+        dict: See `MemoryCache.info`
+    """
+    return CACHE.info()
@@ -0,0 +1,235 @@
+"""
+Persistent on-disk store of registration transforms.
+
+Transforms are keyed by the content of the fixed image (voxels and header),
+the template, the transform type and the registration mask, so that
+re-processing a subject with other ROIs, margins or offsets skips the
+registration.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from ants.core import ANTsImage
+
+log = logging.getLogger(__name__)
+
+INDEX_FILE = "transforms.json"
+
+
+def image_hash(image: Optional[ANTsImage]) -> str:
+    """Hash the voxels and header of an image.
+
+    Args:
+        image (ANTsImage, optional): Image to hash.
+
+    Returns:
+        str: Hex digest, or "none" if `image` is None
+    """
+    if image is None:
+        return "none"
+
+    h = hashlib.blake2b(digest_size=20)
+    header = {
+        "pixeltype": image.pixeltype,
+        "shape": list(image.shape),
+        "spacing": [round(s, 6) for s in image.spacing],
+        "origin": [round(o, 6) for o in image.origin],
+        "direction": [round(float(d), 6) for d in image.direction.flat],
+    }
+    h.update(json.dumps(header, sort_keys=True).encode())
+    h.update(image.numpy().tobytes())
+
+    return h.hexdigest()
+
+
+class TransformStore:
+    """Bounded on-disk store of ANTs transforms.
+
+    Each entry is a directory holding the forward and inverse transforms of
+    a registration. The least recently used entries are evicted when the
+    store exceeds `max_size` bytes or `max_entries` entries.
+
+    Args:
+        root (str): Directory of the store, created if needed.
+        max_size (int, optional): Maximum size of the store in bytes.
+            Defaults to None (unbounded).
+        max_entries (int, optional): Maximum number of entries.
+            Defaults to None (unbounded).
+
+    Exemples:
+        >>> from roiloc.transformstore import TransformStore
+        >>> store = TransformStore("~/.cache/roiloc/transforms",
+        ...                        max_size=2 * 1024**3)
+        >>> key = store.key(image, "mni_icbm152_t1_09c", "AffineFast")
+        >>> transforms = store.get(key)
+    """
+
+    def __init__(self,
+                 root: str,
+                 max_size: Optional[int] = None,
+                 max_entries: Optional[int] = None):
+        self.root = Path(root).expanduser()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.max_entries = max_entries
+
+    @staticmethod
+    def key(image: ANTsImage,
+            template: str,
+            transform_type: str,
+            mask: Optional[ANTsImage] = None) -> str:
+        """Compute the key of a registration.
+
+        Args:
+            image (ANTsImage): Fixed image of the registration.
+            template (str): Identity of the moving template.
+            transform_type (str): Type of transformation.
+            mask (ANTsImage, optional): Registration mask. Defaults to None.
+
+        Returns:
+            str: Key of the registration
+        """
+        h = hashlib.blake2b(digest_size=20)
+        for part in [image_hash(image), template, transform_type,
+                     image_hash(mask)]:
+            h.update(part.encode())
+            h.update(b"\0")
+
+        return h.hexdigest()
+
+    def _entry(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def get(self, key: str) -> Optional[dict]:
+        """Get the transforms of a registration.
+
+        Args:
+            key (str): Key of the registration, see `TransformStore.key`.
+
+        Returns:
+            Optional[dict]: `fwdtransforms` and `invtransforms` lists of
+                paths, or None on a miss
+        """
+        entry = self._entry(key)
+        index = entry / INDEX_FILE
+        if not index.exists():
+            return None
+
+        with open(index) as f:
+            names = json.load(f)
+        transforms = {
+            k: [str(entry / name) for name in v] for k, v in names.items()
+        }
+        if not all(Path(t).exists() for v in transforms.values() for t in v):
+            log.warning(f"Incomplete transform store entry {key}, ignoring")
+            return None
+
+        # Mark as recently used
+        now = time.time()
+        os.utime(index, (now, now))
+        log.debug(f"Transform store hit: {key}")
+
+        return transforms
+
+    def put(self, key: str, registration: dict) -> dict:
+        """Copy the transforms of a registration into the store.
+
+        Args:
+            key (str): Key of the registration, see `TransformStore.key`.
+            registration (dict): Output of `ants.registration`.
+
+        Returns:
+            dict: `fwdtransforms` and `invtransforms` lists of stored paths
+        """
+        entry = self._entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+
+        # Files are written in a temporary directory renamed once complete,
+        # so that concurrent workers never see partial entries.
+        staging = Path(tempfile.mkdtemp(dir=entry.parent, prefix=".tmp"))
+        names, copied = {}, {}
+        for direction in ["fwdtransforms", "invtransforms"]:
+            names[direction] = []
+            for path in registration[direction]:
+                if path not in copied:
+                    copied[path] = f"{len(copied)}_{Path(path).name}"
+                    shutil.copy(path, staging / copied[path])
+                names[direction].append(copied[path])
+        with open(staging / INDEX_FILE, "w") as f:
+            json.dump(names, f)
+
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # Already stored by another worker
+            shutil.rmtree(staging, ignore_errors=True)
+
+        self.evict(keep=entry)
+
+        return self.get(key)
+
+    def entries(self) -> list:
+        """List entries, least recently used first.
+
+        Returns:
+            list: Tuples of (last access time, size in bytes, path)
+        """
+        entries = []
+        for index in self.root.glob(f"*/*/{INDEX_FILE}"):
+            entry = index.parent
+            try:
+                size = sum(f.stat().st_size for f in entry.iterdir())
+                entries.append((index.stat().st_mtime, size, entry))
+            except FileNotFoundError:
+                # Evicted concurrently
+                continue
+
+        return sorted(entries)
+
+    @property
+    def size(self) -> int:
+        """Total size of the store in bytes."""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep: Optional[Path] = None):
+        """Remove least recently used entries until the store is bounded.
+
+        Args:
+            keep (Path, optional): Entry that must not be evicted.
+                Defaults to None.
+        """
+        if self.max_size is None and self.max_entries is None:
+            return
+
+        entries = [e for e in self.entries() if e[2] != keep]
+        if keep is not None and keep.exists():
+            # The kept entry still counts towards the bounds
+            kept = sum(f.stat().st_size for f in keep.iterdir())
+            kept_entries = 1
+        else:
+            kept, kept_entries = 0, 0
+        total = kept + sum(size for _, size, _ in entries)
+        while entries and (
+            (self.max_size is not None and total > self.max_size) or
+            (self.max_entries is not None and
+             len(entries) + kept_entries > self.max_entries)):
+            _, size, entry = entries.pop(0)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            log.debug(f"Evicted {entry.name} from transform store")
+
+    def clear(self):
+        """Remove all entries."""
+        for _, _, entry in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
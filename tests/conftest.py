@@ -0,0 +1,11 @@
+import pytest
+
+from roiloc.scheduler import ITK_THREADS_ENV
+
+
+@pytest.fixture
+def deterministic_registration(monkeypatch):
+    """Seed the sampling of ANTs' metrics and run ITK on a single thread,
+    registrations being otherwise only reproducible within a voxel or so."""
+    monkeypatch.setenv("ANTS_RANDOM_SEED", "1")
+    monkeypatch.setenv(ITK_THREADS_ENV, "1")
@@ -0,0 +1,84 @@
+from roiloc.batch import ResultStore
+
+
+def test_result_store_grows_and_roundtrips():
+    store = ResultStore(["hippocampus", "amygdala"])
+
+    for i in range(40):
+        store.add(f"sub-{i:02d}", {
+            "hippocampus": {
+                "right": [i, 1, 2, 3, 4, 5],
+                "left": [i, 6, 7, 8, 9, 10]
+            },
+            "amygdala": {
+                "right": [i, 0, 0, 1, 1, 1],
+                "left": [i, 2, 2, 3, 3, 3]
+            },
+        })
+
+    assert len(store) == 40
+    assert store.array.shape == (40, 2, 2, 6)
+    assert store.coords("sub-17")["hippocampus"]["left"] == [17, 6, 7, 8, 9, 10]
+    assert store.transforms("sub-17") is None
+    assert "sub-40" not in store
+
+
+def test_crop_stack_is_memory_mapped(tmp_path):
+    import ants
+    import numpy as np
+
+    from roiloc.batch import CropStack
+
+    with CropStack(3, (4, 5, 6), tmp_path / "crops.npy") as stack:
+        for i in range(2):
+            stack.append(ants.from_numpy(np.full((4, 5, 6), i + 1.,
+                                                 dtype="float32")),
+                         subject=f"sub-{i}",
+                         roi="Hippocampus",
+                         side="left",
+                         coords=[i, 0, 0, 4, 5, 6])
+        assert len(stack) == 2
+
+    crops = np.load(tmp_path / "crops.npy", mmap_mode="r")
+    assert crops.shape == (3, 4, 5, 6)
+    assert crops[1].min() == 2 and not crops[2].any()
+    assert (tmp_path / "crops.csv").read_text().splitlines()[2] == \
+        "1,sub-1,Hippocampus,left,1,0,0,4,5,6"
+
+
+def test_fit_many_with_a_failed_subject(tmp_path, monkeypatch):
+    import ants
+    import pytest
+
+    from roiloc import registry
+    from roiloc.batch import BatchRoiLocator
+    from roiloc.location import make_grid
+    from roiloc.phantom import make_phantom
+
+    monkeypatch.setenv("ROILOC_INDEX_DIR", str(tmp_path / "index"))
+    monkeypatch.setattr(registry, "REGISTRY", dict(registry.REGISTRY))
+    # Only known to the parent, spawned workers being given its entry
+    registry.register_template(
+        **registry.get_template_entry()._replace(name="copy")._asdict())
+
+    paths = []
+    for i in range(2):
+        path = tmp_path / f"sub-{i}.nii.gz"
+        ants.image_write(make_phantom(seed=i).image, str(path))
+        paths.append(str(path))
+    missing = str(tmp_path / "missing.nii.gz")
+
+    locator = BatchRoiLocator("t1", "hippocampus", jobs=2, template="copy")
+    results = {r.subject: r for r in locator.fit_many(paths + [missing])}
+
+    assert all(results[p].ok for p in paths)
+    assert not results[missing].ok and missing in locator.errors
+    assert len(list(locator.transform_many(paths))) == 2
+
+    with pytest.raises(ValueError, match="missing"):
+        next(locator.transform_many(paths + [missing]))
+    with pytest.raises(ValueError, match="missing"):
+        locator.stack_many(paths + [missing],
+                           grid=make_grid([16, 16, 16]),
+                           path=tmp_path / "crops.npy")
+    assert not (tmp_path / "crops.npy").exists()
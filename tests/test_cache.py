@@ -0,0 +1,35 @@
+import numpy as np
+
+from roiloc._cache import MemoryCache
+
+
+def test_memory_cache_loads_once():
+    cache = MemoryCache()
+    calls = []
+
+    def load():
+        calls.append(1)
+        return np.zeros((4, 4, 4), dtype="float32")
+
+    first = cache.get(("mni", "t1", False, "LPI"), load)
+    second = cache.get(("mni", "t1", False, "LPI"), load)
+
+    assert first is second
+    assert len(calls) == 1
+    assert cache.info()["hits"] == 1
+    assert cache.nbytes == 4 * 4 * 4 * 4
+
+
+def test_memory_cache_invalidation():
+    cache = MemoryCache()
+    cache.get(("mni", "t1", False, "LPI"), lambda: 1)
+    cache.get(("mni", "t2", False, "LPI"), lambda: 2)
+    cache.get(("atlas", "LPI"), lambda: 3)
+
+    cache.invalidate("mni", "t1")
+    assert ("mni", "t1", False, "LPI") not in cache
+    assert len(cache) == 2
+
+    cache.invalidate()
+    assert len(cache) == 0
+    assert cache.nbytes == 0
@@ -0,0 +1,93 @@
+import csv
+
+import ants
+import numpy as np
+
+from roiloc.coords import (coords_row, crop_from_table, read_coords_table,
+                           write_coords_table)
+from roiloc.location import grid_crop, make_grid
+from roiloc.reader import LazyImage
+
+
+def test_crop_from_coords_table(tmp_path):
+    voxels = np.random.default_rng(0).random((20, 24, 28)) * 100 + 1
+    rows = []
+    for subject in ["sub-01", "sub-02"]:
+        (tmp_path / subject).mkdir()
+        for name in ["t1.nii.gz", "seg.nii.gz"]:
+            ants.image_write(
+                ants.from_numpy(voxels.astype("float32"),
+                                direction=np.diag([-1., -1., 1.])),
+                str(tmp_path / subject / name))
+
+        image = ants.image_read(str(tmp_path / subject / "t1.nii.gz"),
+                                reorient="LPI")
+        for side, coords in [("right", [2, 3, 4, 9, 15, 18]),
+                             ("left", [10, 3, 4, 17, 15, 18])]:
+            rows.append(
+                coords_row(tmp_path / subject / "t1.nii.gz", "Hippocampus",
+                           side, coords, image.shape, image.spacing,
+                           "mni.nii", "AffineFast"))
+
+    write_coords_table(rows, tmp_path / "coords.csv")
+    table = read_coords_table(tmp_path / "coords.csv")
+    assert table == rows
+
+    outputs = crop_from_table(table,
+                              extracrops=["seg*"],
+                              output_dir=tmp_path / "crops")
+    assert len(outputs) == 8
+
+    cropped = ants.image_read(
+        str(tmp_path / "crops" / "sub-02" /
+            "seg_Hippocampus_left_AffineFast_crop.nii.gz"))
+    expected = ants.crop_indices(image, [10, 3, 4], [17, 15, 18])
+    assert np.allclose(cropped.numpy(), expected.numpy())
+    assert np.allclose(cropped.origin, expected.origin)
+
+
+def test_crop_from_coords_table_on_grid(tmp_path):
+    voxels = np.random.default_rng(0).random((20, 24, 28)) * 100 + 1
+    ants.image_write(
+        ants.from_numpy(voxels.astype("float32"),
+                        origin=(10., -4., 2.),
+                        direction=np.diag([-1., -1., 1.])),
+        str(tmp_path / "t1.nii"))
+    image = ants.image_read(str(tmp_path / "t1.nii"), reorient="LPI")
+
+    rows = [
+        coords_row(tmp_path / "t1.nii", "Hippocampus", side, coords,
+                   image.shape, image.spacing, "mni.nii", "AffineFast")
+        for side, coords in [("right", [2, 3, 4, 9, 15, 18]),
+                             ("left", [10, 3, 4, 17, 15, 18])]
+    ]
+
+    # A grid of the shape and spacing of the crops gives the crops
+    outputs = crop_from_table(rows,
+                              grid=make_grid([7, 12, 14]),
+                              stack=tmp_path / "crops.npy")
+    assert outputs == [tmp_path / "crops.npy", tmp_path / "crops.csv"]
+
+    stack = np.load(tmp_path / "crops.npy", mmap_mode="r")
+    assert stack.shape == (2, 7, 12, 14)
+    expected = ants.crop_indices(image, [10, 3, 4], [17, 15, 18])
+    assert np.allclose(stack[1], expected.numpy(), atol=1e-4)
+
+    table = list(csv.DictReader(open(tmp_path / "crops.csv")))
+    assert [(r["index"], r["side"], r["xmin"]) for r in table] == [
+        ("0", "right", "2"), ("1", "left", "10")
+    ]
+
+    # Lazily read images give the same crops
+    cropped = grid_crop(LazyImage(tmp_path / "t1.nii"), [10, 3, 4, 17, 15, 18],
+                        shape=(16, 16, 16),
+                        spacing=(.5, .5, .5))
+    assert cropped.shape == (16, 16, 16)
+    assert np.allclose(cropped.numpy(),
+                       grid_crop(image, [10, 3, 4, 17, 15, 18],
+                                 shape=(16, 16, 16),
+                                 spacing=(.5, .5, .5)).numpy())
+    assert np.allclose(
+        cropped.origin,
+        np.asarray(expected.origin) + np.array([-1., -1., 1.]) *
+        (np.array([6., 11., 13.]) / 2 - 7.5 * .5))
@@ -0,0 +1,39 @@
+import numpy as np
+
+from roiloc.evaluation import compare_locators
+from roiloc.locator import RoiLocator
+from roiloc.phantom import make_phantom
+from roiloc.registration import downsample
+
+
+def test_downsample_spacing_and_shape():
+    image = make_phantom(spacing=(1.5, 1.5, 4.), seed=0).image
+
+    coarse = downsample(image, 3.)
+    assert coarse.spacing == (3., 3., 4.)
+    assert coarse.shape == tuple(
+        np.round(np.array(image.shape) / [2, 2, 1]).astype(int))
+    assert np.allclose(coarse.origin, image.origin)
+    assert np.allclose(coarse.direction, image.direction)
+
+    assert downsample(image, 1.) is image
+
+
+def test_downsampled_registration_against_full_resolution():
+    images = [
+        make_phantom(spacing=(1.5, 1.5, 1.5), seed=seed).image
+        for seed in [0, 2]
+    ]
+
+    report = compare_locators(
+        images, RoiLocator("t1", "hippocampus"),
+        RoiLocator("t1", "hippocampus", registration_resolution=3.))
+
+    assert len(report["overlaps"]) == 2
+    assert all(
+        set(o) == {"right", "left"}
+        for o in report["overlaps"])
+    # Within three registration voxels of the full resolution boxes, the
+    # tolerance stated in the README
+    assert report["min_iou"] >= 0.5
+    assert report["max_error"] <= 6
@@ -0,0 +1,34 @@
+import csv
+import importlib.resources
+import subprocess
+import sys
+
+from roiloc._cerebra import CEREBRA_LABELS
+
+HEAVY_MODULES = ["ants.core", "pandas", "scipy", "matplotlib", "rich.progress"]
+
+
+def test_heavy_dependencies_are_loaded_on_first_use():
+    modules = ["roiloc.roiloc", "roiloc.location", "roiloc.locator"]
+    loaded = subprocess.run([
+        sys.executable, "-c",
+        f"import sys, {', '.join(modules)}; "
+        f"print(','.join(m for m in {HEAVY_MODULES} if m in sys.modules))"
+    ],
+                            capture_output=True,
+                            text=True,
+                            check=True).stdout.strip()
+
+    assert loaded == ""
+
+
+def test_label_lookup_matches_label_table():
+    table = importlib.resources.files(
+        "roiloc") / "MNI" / "cerebra" / "CerebrA_LabelDetails.csv"
+    with open(str(table), newline="") as f:
+        labels = {
+            row["Label Name"]: (int(row["RH Label"]), int(row["LH Labels"]))
+            for row in csv.DictReader(f)
+        }
+
+    assert CEREBRA_LABELS == labels
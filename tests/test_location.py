@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from roiloc.location import (apply_margin, get_bbox, get_coords,
+                             get_labels_bbox)
+
+
+def _atlas():
+    x = np.zeros((40, 48, 36), dtype="uint32")
+    x[5:12, 10:30, 2:9] = 48
+    x[25:39, 10:30, 20:36] = 99
+    x[0:3, 0:2, 0:1] = 7
+    return x
+
+
+def test_labels_bbox_matches_get_coords():
+    x = _atlas()
+    boxes = get_labels_bbox(x, [48, 99, 7])
+
+    for label, offset in [(48, [0, 0, 0]), (99, [2, -3, 1]), (7, [0, 0, 0])]:
+        expected = get_coords((x == label).astype("uint32"),
+                              margin=[4, 8, 2],
+                              offset=offset)
+        coords = apply_margin(boxes[label],
+                              x.shape,
+                              margin=[4, 8, 2],
+                              offset=offset)
+        assert coords == expected
+
+
+def test_bbox_matches_voxel_indices():
+    rng = np.random.default_rng(0)
+    masks = (rng.random((6, 30, 20, 25)) > .9995).astype("float32")
+    masks[4] = 0
+    masks[5, 29, 0, 24] = -1
+
+    boxes = get_bbox(masks)
+    for mask, bbox in zip(masks, boxes):
+        indices = np.nonzero(mask)
+        if not len(indices[0]):
+            assert bbox is None
+            continue
+        assert bbox == ([int(i.min()) for i in indices],
+                        [int(i.max()) for i in indices])
+
+    coords = get_coords(masks, margin=[2, 2, 2], offset=[1, 0, -1])
+    assert coords[4] is None
+    assert coords[5] == get_coords(masks[5],
+                                   margin=[2, 2, 2],
+                                   offset=[1, 0, -1])
+    assert coords[5] == apply_margin(boxes[5],
+                                     masks.shape[1:],
+                                     margin=[2, 2, 2],
+                                     offset=[1, 0, -1])
+
+    with pytest.raises(ValueError):
+        get_coords(masks[4])
+
+
+def test_labels_bbox_missing_label():
+    boxes = get_labels_bbox(_atlas(), [48, 50])
+
+    assert boxes[48] == ([5, 10, 2], [11, 29, 8])
+    assert boxes[50] is None
+
+
+def test_corner_transform_matches_full_warp(tmp_path):
+    import ants
+
+    from roiloc.location import compare_bbox_modes
+
+    atlas = ants.from_numpy(_atlas().astype("float32"),
+                            spacing=(2., 2., 2.)).clone("unsigned int")
+    fixed = ants.make_image((60, 70, 50), spacing=(1.5, 1.5, 1.5))
+
+    transform = ants.create_ants_transform(
+        transform_type="AffineTransform",
+        dimension=3,
+        matrix=[[0.98, -0.17, 0.], [0.17, 0.98, 0.], [0., 0., 1.]],
+        translation=[-4., 3., -2.],
+        center=[40., 48., 36.])
+    path = str(tmp_path / "0GenericAffine.mat")
+    ants.write_transform(transform, path)
+
+    overlaps = compare_bbox_modes(atlas, fixed, [path], [48, 99])
+
+    assert set(overlaps) == {48, 99}
+    for overlap in overlaps.values():
+        assert overlap["max_error"] <= 1
+        assert overlap["iou"] > 0.8
+
+
+def test_decrop_matches_ants():
+    import ants
+
+    from roiloc.location import SparseImage, decrop
+
+    image = ants.from_numpy(np.random.rand(40, 48, 36).astype("float32"),
+                            spacing=(1., 1.5, 2.),
+                            origin=(10., -5., 3.),
+                            direction=np.diag([-1., -1., 1.]))
+    right = ants.crop_indices(image, [2, 3, 4], [12, 20, 30])
+    left = ants.crop_indices(image, [25, 3, 4], [39, 20, 30]) * 2
+
+    for decrop_is_zero in [True, False]:
+        reference = image.new_image_like(
+            np.zeros(image.shape,
+                     dtype="float32")) if decrop_is_zero else image
+        expected = ants.decrop_image(left, ants.decrop_image(right,
+                                                             reference))
+        decropped = decrop([right, left], image, decrop_is_zero)
+
+        assert np.array_equal(decropped.numpy(), expected.numpy())
+        assert decropped.origin == expected.origin
+
+    sparse = SparseImage(image, [right, left])
+    assert [coords for coords, _ in sparse.patches
+           ] == [[2, 3, 4, 12, 20, 30], [25, 3, 4, 39, 20, 30]]
+    assert np.array_equal(sparse.to_image().numpy(),
+                          decrop([right, left], image).numpy())
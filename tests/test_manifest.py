@@ -0,0 +1,53 @@
+from roiloc.manifest import RunManifest
+
+
+def test_manifest_resumes_completed_subjects(tmp_path):
+    image = tmp_path / "t1.nii.gz"
+    image.write_bytes(b"voxels")
+    output = tmp_path / "t1_crop.nii.gz"
+    output.write_bytes(b"crop")
+    params = {"roi": ["Hippocampus"], "margin": [8, 8, 8]}
+
+    manifest = RunManifest(tmp_path / "manifest.jsonl")
+    inputs = manifest.fingerprint([image])
+    key = manifest.key(inputs, params)
+    assert not manifest.is_done(image, key)
+    manifest.record(image, key, inputs, params, [output])
+
+    # Reloaded from disk, e.g. by a rerun
+    manifest = RunManifest(tmp_path / "manifest.jsonl")
+    assert manifest.has_done(image) and not manifest.has_done(output)
+    assert manifest.is_done(image, manifest.key(manifest.fingerprint([image]),
+                                                params))
+
+    # Other parameters, or a changed input, have to be recomputed
+    assert not manifest.is_done(
+        image, manifest.key(inputs, {
+            **params, "margin": [4, 4, 4]
+        }))
+    image.write_bytes(b"other voxels")
+    assert not manifest.is_done(
+        image, manifest.key(manifest.fingerprint([image]), params))
+
+    # So do subjects whose outputs were removed
+    output.unlink()
+    assert not manifest.is_done(image, key)
+
+
+def test_manifest_records_from_threads(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    manifest = RunManifest(tmp_path / "manifest.jsonl")
+
+    def record(i):
+        subject = tmp_path / f"sub-{i:03d}.nii.gz"
+        manifest.record(subject, "key", {}, {}, coords=[{"row": i}] * 100)
+        return manifest.is_done(subject, "key")
+
+    with ThreadPoolExecutor(8) as pool:
+        assert all(pool.map(record, range(200)))
+
+    manifest = RunManifest(tmp_path / "manifest.jsonl")
+    assert all(
+        manifest.has_done(tmp_path / f"sub-{i:03d}.nii.gz")
+        for i in range(200))
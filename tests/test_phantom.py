@@ -0,0 +1,34 @@
+import numpy as np
+
+from roiloc.location import apply_margin
+from roiloc.locator import RoiLocator
+from roiloc.phantom import make_phantom
+from roiloc.template import get_atlas, get_roi_indices
+
+
+def test_phantom_grid_and_ground_truth():
+    phantom = make_phantom(spacing=(4., 4., 4.), seed=1)
+    atlas = get_atlas()
+
+    assert np.allclose(phantom.image.direction, atlas.direction)
+    assert phantom.image.spacing == (4., 4., 4.)
+    assert phantom.atlas.shape == phantom.image.shape
+
+    labels = [int(i) for i in get_roi_indices("hippocampus")]
+    assert all(box is not None for box in phantom.labels_bbox(labels).values())
+
+
+def test_locator_recovers_translated_phantom(deterministic_registration):
+    phantom = make_phantom(seed=0, max_rotation=0., max_scaling=0.)
+    idx = get_roi_indices("hippocampus")
+    truth = phantom.labels_bbox([int(i) for i in idx])
+
+    locator = RoiLocator("t1", "hippocampus", margin=[0, 0, 0])
+    locator.fit(phantom.image)
+
+    for i, side in enumerate(["right", "left"]):
+        expected = apply_margin(truth[int(idx[i])],
+                                phantom.image.shape,
+                                margin=[0, 0, 0],
+                                offset=[0, 0, 0])
+        assert np.abs(np.subtract(locator.coords[side], expected)).max() <= 1
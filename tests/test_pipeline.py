@@ -0,0 +1,85 @@
+import ants
+import numpy as np
+import pytest
+
+from roiloc.pipeline import AsyncWriter, prefetch, read_archive, write_image
+
+
+def test_prefetch_keeps_order_and_raises():
+    assert list(prefetch(range(10), size=2)) == list(range(10))
+
+    def failing():
+        yield 1
+        raise ValueError("unreadable subject")
+
+    items = prefetch(failing())
+    assert next(items) == 1
+    with pytest.raises(ValueError):
+        next(items)
+
+
+def test_async_writer_writes_gzipped_images(tmp_path):
+    image = ants.from_numpy(np.random.rand(8, 9, 10).astype("float32"),
+                            spacing=(1., 2., 3.))
+
+    with AsyncWriter(maxsize=1) as writer:
+        for i in range(3):
+            writer.submit(write_image, image, str(tmp_path / f"{i}.nii.gz"))
+
+    for i in range(3):
+        written = ants.image_read(str(tmp_path / f"{i}.nii.gz"))
+        assert np.allclose(written.numpy(), image.numpy())
+        assert written.spacing == image.spacing
+    assert not list(tmp_path.glob("*.nii"))
+
+
+def test_async_writer_workers_return_futures(tmp_path):
+    image = ants.from_numpy(np.random.rand(8, 9, 10).astype("float32"))
+
+    with AsyncWriter(maxsize=2, workers=3) as writer:
+        futures = [
+            writer.submit(write_image,
+                          image,
+                          str(tmp_path / f"{i}.nii"),
+                          compresslevel=0) for i in range(6)
+        ]
+        assert writer.submit(sum, [1, 2]).result() == 3
+
+    assert all(f.done() for f in futures)
+    assert len(list(tmp_path.glob("*.nii"))) == 6
+
+
+def test_archive_round_trip(tmp_path):
+    image = ants.from_numpy(np.random.rand(20, 22, 24).astype("float32"),
+                            origin=(1., 2., 3.),
+                            spacing=(1., 1.5, 2.),
+                            direction=np.diag([-1., -1., 1.]))
+    coords = [2, 3, 4, 10, 12, 14]
+    cropped = ants.crop_indices(image, coords[:3], coords[3:])
+
+    write_image({"t1_Hippocampus_right": (cropped, coords)},
+                str(tmp_path / "crops.npz"))
+    crops = read_archive(str(tmp_path / "crops.npz"))
+
+    read, read_coords = crops["t1_Hippocampus_right"]
+    assert read_coords == coords
+    assert np.allclose(read.numpy(), cropped.numpy())
+    assert np.allclose(read.origin, cropped.origin)
+    assert np.allclose(read.direction, cropped.direction)
+    assert read.spacing == cropped.spacing
+
+
+def test_failed_write_leaves_no_file(tmp_path, monkeypatch):
+    image = ants.from_numpy(np.random.rand(8, 9, 10).astype("float32"))
+
+    def interrupted(image, path):
+        with open(path, "wb") as f:
+            f.write(b"partial")
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(ants, "image_write", interrupted)
+    for name in ["crop.nii.gz", "crop.nii"]:
+        with pytest.raises(OSError):
+            write_image(image, str(tmp_path / name))
+
+    assert not list(tmp_path.iterdir())
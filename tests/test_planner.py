@@ -0,0 +1,37 @@
+import ants
+import numpy as np
+
+from roiloc.planner import read_header, recommend, schedule
+
+
+def test_read_header_matches_ants(tmp_path):
+    image = ants.from_numpy(np.zeros((20, 24, 28), dtype="uint8"),
+                            spacing=(.8, 1., 1.2))
+    for name in ["t1.nii", "t1.nii.gz", "t1.nrrd"]:
+        ants.image_write(image, str(tmp_path / name))
+        header = read_header(tmp_path / name)
+
+        assert header["shape"] == (20, 24, 28)
+        assert np.allclose(header["spacing"], (.8, 1., 1.2))
+        assert header["filesize"] == (tmp_path / name).stat().st_size
+
+    assert read_header(tmp_path / "t1.nii")["nbytes"] == 20 * 24 * 28
+
+
+def test_recommend_fits_jobs_in_memory():
+    calibration = {
+        "cpus": 8,
+        "seconds": [10., 0.],
+        "parallel_fraction": .5,
+        "startup": 0.,
+    }
+
+    assert schedule([3., 1., 1., 1.], 2) == 3.
+    assert schedule([1.] * 4, 2, startup=2.) == 4.
+
+    # Threads hardly help, jobs do until memory runs out
+    plan = recommend([1] * 16, calibration, peak=2, cpus=8, memory=10)
+    assert (plan["jobs"], plan["threads"]) == (4, 2)
+    assert len(plan["options"]) == 8
+    assert plan["seconds"] == schedule([10 * (.5 + .5 / 2) / (.5 + .5 / 8)] *
+                                       16, 4)
@@ -0,0 +1,30 @@
+import json
+
+from roiloc.profiling import Profiler
+
+
+def test_profiler_records_and_dumps_stages(tmp_path):
+    profiler = Profiler()
+
+    for subject in ["sub-00", "sub-01"]:
+        with profiler.stage("registration", subject=subject):
+            sum(range(10000))
+    with profiler.stage("template"):
+        pass
+
+    assert [r["subject"] for r in profiler.records] == ["sub-00", "sub-01", None]
+    assert all(r["wall"] >= 0 and r["peak_rss"] > 0 for r in profiler.records)
+    assert profiler.summary()["registration"]["count"] == 2
+
+    profiler.dump(tmp_path / "profile.json")
+    report = json.loads((tmp_path / "profile.json").read_text())
+    assert report["summary"].keys() == {"registration", "template"}
+    assert len(report["records"]) == 3
+
+
+def test_disabled_profiler_records_nothing():
+    profiler = Profiler(enabled=False)
+    with profiler.stage("registration"):
+        pass
+
+    assert profiler.records == []
@@ -0,0 +1,53 @@
+import ants
+import numpy as np
+import pytest
+
+from roiloc.reader import LazyImage
+
+COS, SIN = np.cos(.2), np.sin(.2)
+
+
+@pytest.mark.parametrize("direction", [
+    np.eye(3),
+    np.diag([-1., 1., -1.]),
+    np.array([[0., 0., 1.], [1., 0., 0.], [0., -1., 0.]]),
+    np.array([[COS, -SIN, 0.], [0., 0., -1.], [SIN, COS, 0.]]),
+])
+@pytest.mark.parametrize("pixeltype", ["float", "unsigned char"])
+def test_lazy_crop_matches_lpi_crop(tmp_path, direction, pixeltype):
+    voxels = np.random.default_rng(0).random((20, 24, 28)) * 100
+    image = ants.from_numpy(voxels.astype("float32"),
+                            origin=(10.5, -20., 30.),
+                            spacing=(1., 2., 3.3),
+                            direction=direction).clone(pixeltype)
+    path = tmp_path / "image.nii"
+    ants.image_write(image, str(path))
+
+    reference = ants.image_read(str(path), reorient="LPI")
+    lazy = LazyImage(path)
+
+    assert lazy.memory_mapped
+    assert lazy.shape == reference.shape
+
+    lower, upper = [2, 3, 4], [9, 15, 18]
+    expected = ants.crop_indices(reference, lower, upper)
+    cropped = lazy.crop_indices(lower, upper)
+
+    assert cropped.shape == expected.shape
+    assert np.allclose(cropped.numpy(), expected.numpy())
+    assert np.allclose(cropped.origin, expected.origin)
+    assert np.allclose(cropped.spacing, expected.spacing)
+    assert np.allclose(cropped.direction, expected.direction)
+
+
+def test_lazy_image_reads_compressed_once(tmp_path):
+    image = ants.from_numpy(np.ones((8, 8, 8), dtype="float32"))
+    path = tmp_path / "image.nii.gz"
+    ants.image_write(image, str(path))
+
+    lazy = LazyImage(path)
+
+    assert not lazy.memory_mapped
+    first = lazy.crop_indices([0, 0, 0], [4, 4, 4])
+    assert first.shape == (4, 4, 4)
+    assert lazy._image is not None
@@ -0,0 +1,100 @@
+import ants
+import numpy as np
+import pytest
+
+from roiloc._cache import scratch_dir
+from roiloc.registration import (apply_transforms, center_of_mass_transform,
+                                 headers_match, is_linear, read_transforms,
+                                 register_with_fallback, registration_quality)
+
+
+def test_in_memory_transforms_match_files(tmp_path):
+    atlas = np.zeros((30, 34, 28), dtype="float32")
+    atlas[5:12, 10:20, 3:9] = 1
+    atlas[18:26, 8:30, 12:25] = 2
+    atlas = ants.from_numpy(atlas, spacing=(2., 2., 2.))
+
+    transform = ants.create_ants_transform(
+        transform_type="AffineTransform",
+        dimension=3,
+        matrix=[[0.98, -0.17, 0.], [0.17, 0.98, 0.], [0., 0., 1.1]],
+        translation=[-4., 3., -2.],
+        center=[30., 34., 28.])
+    path = str(tmp_path / "0GenericAffine.mat")
+    ants.write_transform(transform, path)
+    fixed = ants.make_image((40, 40, 40), spacing=(1.5, 1.5, 1.5))
+
+    expected = ants.apply_transforms(fixed,
+                                     atlas, [path],
+                                     interpolator="nearestNeighbor")
+    transforms = read_transforms([path])
+    warped = apply_transforms(fixed,
+                              atlas,
+                              transforms,
+                              interpolator="nearestNeighbor")
+
+    assert is_linear(path) and is_linear(transforms[0])
+    assert np.array_equal(warped.numpy(), expected.numpy())
+
+
+def test_scratch_dir_from_environment(monkeypatch, tmp_path):
+    monkeypatch.setenv("ROILOC_SCRATCH_DIR", str(tmp_path))
+
+    assert scratch_dir() == str(tmp_path)
+
+
+def test_headers_match():
+    image = ants.from_numpy(np.zeros((10, 12, 14), dtype="float32"),
+                            spacing=(1., 1., 1.2))
+
+    assert headers_match(image, image.clone() + 1)
+    moved = image.clone()
+    moved.set_origin((0., 2., 0.))
+    assert not headers_match(image, moved)
+    assert not headers_match(image, ants.resample_image(image, (2, 2, 2)))
+
+
+def test_center_of_mass_transform_ignores_neck(tmp_path):
+    grid = np.indices((40, 40, 60)).transpose(1, 2, 3, 0)
+    head = np.linalg.norm(grid - [20, 20, 40], axis=-1) < 12
+    template = ants.from_numpy(head.astype("float32"), spacing=(2., 2., 2.))
+
+    # Same head 10mm higher, with a neck as large as the head below it
+    voxels = np.roll(head, 5, axis=2).astype("float32")
+    voxels[14:26, 14:26, :35] = 1
+    image = ants.from_numpy(voxels, spacing=(2., 2., 2.))
+
+    path = center_of_mass_transform(image,
+                                    template,
+                                    outprefix=f"{tmp_path}/")
+    offset = ants.read_transform(path).parameters[-3:]
+    assert np.allclose(offset, [0, 0, -10], atol=2)
+
+
+def test_registration_quality_and_fallback(deterministic_registration):
+    rng = np.random.default_rng(0)
+    grid = np.indices((32, 32, 32)).transpose(1, 2, 3, 0)
+    blob = np.exp(-np.sum((grid - [16, 14, 18])**2, axis=-1) / 60.)
+    image = ants.from_numpy((blob * 100).astype("float32"),
+                            spacing=(2., 2., 2.))
+
+    assert registration_quality(image, image) == pytest.approx(1.)
+    noise = ants.from_numpy(
+        rng.random((32, 32, 32)).astype("float32") + 1, spacing=(2., 2., 2.))
+    assert registration_quality(image, noise) < .2
+
+    moving = ants.from_numpy(np.roll(blob * 100, 3, axis=0).astype("float32"),
+                             spacing=(2., 2., 2.))
+    # Unreachable quality, every transform of the ladder is tried
+    registration = register_with_fallback(image,
+                                          moving, ["Translation", "Rigid"],
+                                          min_quality=1.1)
+    assert [a["transform"] for a in registration["attempts"]
+           ] == ["Translation", "Rigid"]
+    assert registration["quality"] == pytest.approx(
+        max(a["quality"] for a in registration["attempts"]), abs=1e-3)
+
+    registration = register_with_fallback(image,
+                                          moving, ["Translation", "Rigid"],
+                                          min_quality=.5)
+    assert len(registration["attempts"]) == 1
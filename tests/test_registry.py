@@ -0,0 +1,93 @@
+import json
+
+import ants
+import numpy as np
+
+from roiloc.location import get_labels_bbox
+from roiloc.template import (get_atlas_bboxes, get_atlas_centroids,
+                             get_mni_name, get_roi_indices)
+
+
+def test_template_file_and_atlas_index(tmp_path, monkeypatch):
+    monkeypatch.setenv("ROILOC_INDEX_DIR", str(tmp_path / "index"))
+
+    x = np.zeros((40, 48, 36), dtype="float32")
+    x[5:12, 10:30, 2:9] = 3
+    x[25:39, 10:30, 20:36] = 4
+    atlas = ants.from_numpy(x, direction=np.diag([-1., -1., 1.]))
+    ants.image_write(atlas, str(tmp_path / "atlas.nii.gz"))
+    ants.image_write(atlas, str(tmp_path / "t1.nii.gz"))
+    (tmp_path / "labels.csv").write_text("name,right,left\nBlob,3,4\n")
+    (tmp_path / "template.json").write_text(
+        json.dumps({
+            "name": "blobs",
+            "templates": {
+                "t1": "t1.nii.gz"
+            },
+            "atlas": "atlas.nii.gz",
+            "labels": "labels.csv"
+        }))
+    template = str(tmp_path / "template.json")
+
+    assert get_mni_name("t1", False, template) == "blobs/t1.nii.gz"
+    assert get_roi_indices("blob", template) == [3, 4]
+    assert (tmp_path / "index" / "blobs_index.npz").exists()
+
+    boxes = get_atlas_bboxes(template=template)
+    assert boxes == {
+        1: None,
+        2: None,
+        **get_labels_bbox(x.astype("uint32"), [3, 4])
+    }
+    assert np.allclose(get_atlas_centroids("blobs")[4], [31.5, 19.5, 27.5])
+
+
+def test_failed_index_write_leaves_no_file(tmp_path, monkeypatch):
+    from roiloc import registry
+
+    def replace(src, dst):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(registry.os, "replace", replace)
+    index = registry.build_index(registry.get_template_entry(),
+                                 tmp_path / "index.npz")
+
+    assert index["bboxes"]
+    assert not list(tmp_path.iterdir())
+
+
+def test_template_file_is_loaded_once_and_index_follows_labels(
+        tmp_path, monkeypatch):
+    import os
+
+    from roiloc import registry
+
+    monkeypatch.setenv("ROILOC_INDEX_DIR", str(tmp_path / "index"))
+    monkeypatch.setattr(registry, "REGISTRY", dict(registry.REGISTRY))
+    monkeypatch.setattr(registry, "_TEMPLATE_FILES", {})
+
+    x = np.zeros((20, 20, 20), dtype="float32")
+    x[2:8, 2:8, 2:8] = 3
+    x[12:18, 2:8, 2:8] = 4
+    ants.image_write(ants.from_numpy(x), str(tmp_path / "atlas.nii.gz"))
+    labels = tmp_path / "labels.csv"
+    labels.write_text("name,right,left\nBlob,3,4\n")
+    (tmp_path / "template.json").write_text(
+        json.dumps({
+            "name": "blobs",
+            "templates": {
+                "t1": "atlas.nii.gz"
+            },
+            "atlas": "atlas.nii.gz",
+            "labels": "labels.csv"
+        }))
+
+    entry = registry.get_template_entry(str(tmp_path / "template.json"))
+    assert registry.get_template_entry(
+        str(tmp_path / ".." / tmp_path.name / "template.json")) is entry
+    assert registry.load_index(entry)["labels"] == {"Blob": (3, 4)}
+
+    labels.write_text("name,right,left\nBlob,4,3\n")
+    # Same size, the modification time may not change on coarse filesystems
+    os.utime(labels, ns=(0, 0))
+    assert registry.load_index(entry)["labels"] == {"Blob": (4, 3)}
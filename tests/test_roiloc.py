@@ -1,5 +1,209 @@
+from pathlib import Path
+
+import pytest
+
 from roiloc import __version__
 
 
 def test_version():
     assert __version__ == "0.4.0"
+
+
+def test_group_images():
+    from roiloc.roiloc import group_images
+
+    images = [
+        Path(p) for p in [
+            "data/sub-02/ses-1/anat/sub-02_T1w.nii.gz",
+            "data/sub-01/ses-2/anat/sub-01_T2w.nii.gz",
+            "data/sub-01/ses-1/anat/sub-01_T1w.nii.gz",
+            "data/other/scan.nii.gz",
+        ]
+    ]
+    groups = group_images(images, r"sub-[^/]+", reference="*T2w*")
+
+    assert list(groups) == ["data/other/scan.nii.gz", "sub-01", "sub-02"]
+    assert [i.name for i in groups["sub-01"]
+           ] == ["sub-01_T2w.nii.gz", "sub-01_T1w.nii.gz"]
+
+
+def _cohort(root, subjects=2):
+    """Phantoms written as `sub-XX/t1.nii.gz`."""
+    import ants
+
+    from roiloc.phantom import make_phantom
+
+    paths = []
+    for i in range(subjects):
+        path = root / f"sub-{i:02d}" / "t1.nii.gz"
+        path.parent.mkdir()
+        ants.image_write(make_phantom(seed=i).image, str(path))
+        paths.append(path)
+
+    return paths
+
+
+def _run(root, *argv):
+    from roiloc.roiloc import main, parse_args
+
+    main(
+        parse_args([
+            "-p",
+            str(root), "-i", "*/t1.nii.gz", "-c", "t1", "-r", "Hippocampus",
+            *argv
+        ]))
+
+
+def _manifest(root):
+    import json
+
+    with open(root / "roiloc_manifest.jsonl") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_failed_write_is_recorded(tmp_path, monkeypatch):
+    import roiloc.roiloc
+    from roiloc.pipeline import write_image
+
+    paths = _cohort(tmp_path)
+
+    def write(image, path, **kwargs):
+        if "sub-00" in str(path):
+            raise OSError("No space left on device")
+        write_image(image, path, **kwargs)
+
+    monkeypatch.setattr(roiloc.roiloc, "write_image", write)
+    _run(tmp_path, "--queuesize", "1")
+
+    status = {r["subject"]: r["status"] for r in _manifest(tmp_path)}
+    assert status[str(paths[0])] == "failed"
+    assert status[str(paths[1])] == "done"
+    assert not list(paths[0].parent.glob("*crop.nii.gz"))
+
+
+@pytest.mark.parametrize("queuesize", ["0", "1"])
+def test_failed_subjects_do_not_stop_the_run(tmp_path, monkeypatch,
+                                             queuesize):
+    import roiloc.roiloc
+    from roiloc.registration import get_mask
+
+    paths = _cohort(tmp_path, subjects=3)
+    # Fails to read
+    paths[1].write_bytes(b"Not an image")
+
+    # Fails to register
+    def mask(path, *args):
+        if path.name == "sub-00":
+            raise RuntimeError("Registration failed")
+        return get_mask(path, *args)
+
+    monkeypatch.setattr(roiloc.roiloc, "get_mask", mask)
+    _run(tmp_path, "--queuesize", queuesize, "--outputformat", "npz")
+
+    records = {r["subject"]: r for r in _manifest(tmp_path)}
+    assert [records[str(p)]["status"] for p in paths] == \
+        ["failed", "failed", "done"]
+    assert "RuntimeError: Registration failed" in \
+        records[str(paths[0])]["error"]
+    assert list(paths[2].parent.glob("*_crops.npz"))
+
+
+def test_grouped_image_matches_registering_it_alone(tmp_path, capsys):
+    import ants
+    import numpy as np
+
+    from roiloc.coords import COORDS_COLUMNS, read_coords_table
+    from roiloc.location import apply_margin
+    from roiloc.phantom import make_phantom
+    from roiloc.template import get_roi_indices
+
+    idx = [int(i) for i in get_roi_indices("hippocampus")]
+
+    # Sessions of a subject, on different grids and rigidly moved
+    truth = {}
+    for session, seed, spacing in [(1, 0, 3.), (2, 1, 2.5)]:
+        path = tmp_path / "sub-01" / f"ses-{session}" / "t1.nii.gz"
+        path.parent.mkdir(parents=True)
+        phantom = make_phantom(spacing=(spacing,) * 3,
+                               seed=seed,
+                               max_scaling=0.)
+        ants.image_write(phantom.image, str(path))
+        for i, side in zip(idx, ["right", "left"]):
+            truth[str(path), side] = apply_margin(
+                phantom.labels_bbox(idx)[i], phantom.image.shape, [0, 0, 0],
+                [0, 0, 0])
+
+    def coords(*argv):
+        _run(tmp_path, "-i", "*/*/t1.nii.gz", "-m", "0", "0", "0",
+             "--coords-only", *argv)
+        return {(row["subject"], row["side"]):
+                [row[c] for c in COORDS_COLUMNS]
+                for row in read_coords_table(tmp_path / "roiloc_coords.csv")}
+
+    grouped = coords("--group-by", "sub-[^/]+", "--group-reference",
+                     "*ses-1*")
+    assert "Registering the group's reference" in capsys.readouterr().out
+    alone = coords()
+
+    assert grouped.keys() == alone.keys() == truth.keys()
+    # Registrations are accurate to a template voxel (3mm) or so, and the
+    # rigid registration to the reference is chained to the reference's
+    for key in truth:
+        assert np.abs(np.subtract(grouped[key], alone[key])).max() <= 4
+        assert np.abs(np.subtract(grouped[key], truth[key])).max() <= 4
+
+
+def test_resume_from_another_directory(tmp_path, monkeypatch):
+    paths = _cohort(tmp_path)
+
+    monkeypatch.chdir(tmp_path)
+    _run(Path("."), "--queuesize", "0")
+    records = _manifest(tmp_path)
+    assert [r["subject"] for r in records] == [str(p) for p in paths]
+    assert all(r["status"] == "done" for r in records)
+
+    # Nothing is processed, nor recorded, again
+    monkeypatch.chdir(paths[0].parent)
+    _run(Path(".."), "--resume")
+    assert _manifest(tmp_path) == records
+
+
+def test_resume_with_groups(tmp_path):
+    import ants
+
+    from roiloc.coords import read_coords_table
+    from roiloc.phantom import make_phantom
+
+    paths = _cohort(tmp_path, subjects=3)
+    # sub-00 and sub-01 form a group, sub-02 is a group of its own
+    group_by = ["--coords-only", "--group-by", "sub-0(?=[01])"]
+    _run(tmp_path, *group_by)
+    records = _manifest(tmp_path)
+    assert len(records) == 3
+    rows = read_coords_table(tmp_path / "roiloc_coords.csv")
+
+    # A changed image makes its whole group processed again
+    ants.image_write(make_phantom(seed=3).image, str(paths[1]))
+    _run(tmp_path, *group_by, "--resume")
+    new = _manifest(tmp_path)[len(records):]
+    assert sorted(r["subject"] for r in new) == [str(p) for p in paths[:2]]
+    assert all(r["status"] == "done" for r in new)
+
+    # Rows of the skipped group are restored from the manifest
+    resumed = read_coords_table(tmp_path / "roiloc_coords.csv")
+    assert len(resumed) == 6
+    assert [r for r in resumed if r["subject"] == str(paths[2])] == \
+        [r for r in rows if r["subject"] == str(paths[2])]
+
+
+def test_transform_cache_keeps_quality(tmp_path):
+    from roiloc.coords import read_coords_table
+
+    _cohort(tmp_path, subjects=1)
+    _run(tmp_path, "--coords-only", "--transformcache",
+         str(tmp_path / "cache"))
+
+    rows = read_coords_table(tmp_path / "roiloc_coords.csv")
+    assert len(rows) == 2
+    assert all(0 < row["quality"] <= 1 for row in rows)
+    assert all(row["transform_key"] for row in rows)
@@ -0,0 +1,28 @@
+import os
+
+from roiloc.scheduler import ITK_THREADS_ENV, run_parallel
+
+
+def _square(item: int, offset: int = 0) -> tuple:
+    print(f"Subject {item}")
+    if item == 2:
+        raise ValueError(f"Subject {item} failed")
+
+    return item**2 + offset, os.environ.get(ITK_THREADS_ENV)
+
+
+def test_run_parallel_reports_failures():
+    results = {
+        r.item: r
+        for r in run_parallel(_square, range(5), jobs=2, threads=3, offset=1)
+    }
+
+    assert sorted(results) == [0, 1, 2, 3, 4]
+    assert not results[2].ok and results[2].value is None
+    assert "ValueError: Subject 2 failed" in results[2].error
+    assert results[2].log == "Subject 2\n"
+
+    for item in [0, 1, 3, 4]:
+        assert results[item].ok and not results[item].error
+        assert results[item].value == (item**2 + 1, "3")
+        assert results[item].log == f"Subject {item}\n"
@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+import time
+
+import ants
+
+from roiloc.client import request
+from roiloc.phantom import make_phantom
+
+
+def test_daemon_serves_requests(tmp_path):
+    path = str(tmp_path / "roiloc.sock")
+    daemon = subprocess.Popen([
+        sys.executable, "-c",
+        f"from roiloc.server import start; start(['--socket', '{path}', '-c', 't1'])"
+    ])
+    try:
+        for _ in range(600):
+            if os.path.exists(path):
+                break
+            time.sleep(.1)
+
+        assert request({"command": "ping"}, path) == {
+            "status": 0,
+            "output": "pong"
+        }
+        # Only accessible to the user
+        assert not os.stat(path).st_mode & 0o077
+
+        response = request({
+            "command": "run",
+            "argv": ["--bogus"],
+            "cwd": str(tmp_path)
+        }, path)
+        assert response["status"] == 2
+        assert "usage: " in response["output"]
+
+        response = request({"command": "unknown"}, path)
+        assert response["status"] == 1
+
+        image = tmp_path / "sub-01" / "t1.nii.gz"
+        image.parent.mkdir()
+        ants.image_write(make_phantom(seed=0).image, str(image))
+
+        response = request(
+            {
+                "command": "coords",
+                "path": str(image),
+                "contrast": "t1",
+                "roi": "Hippocampus"
+            }, path)
+        assert response["status"] == 0, response["output"]
+        coords = response["coords"]
+        assert set(coords) == {"right", "left"}
+
+        # Written in a directory created as needed
+        output_dir = tmp_path / "crops" / "sub-01"
+        response = request(
+            {
+                "command": "crop",
+                "path": str(image),
+                "contrast": "t1",
+                "roi": "Hippocampus",
+                "output_dir": str(output_dir)
+            }, path)
+        assert response["status"] == 0, response["output"]
+        assert set(response["coords"]) == set(coords)
+        assert sorted(response["outputs"]) == sorted(
+            str(p) for p in output_dir.glob("*_crop.nii.gz"))
+        assert len(response["outputs"]) == 2
+    finally:
+        daemon.terminate()
+        daemon.wait(timeout=30)
+
+    assert not os.path.exists(path)
@@ -0,0 +1,35 @@
+import os
+
+from roiloc.transformstore import TransformStore
+
+
+def _registration(tmp_path, name):
+    path = tmp_path / f"{name}0GenericAffine.mat"
+    path.write_bytes(b"0" * 100)
+    return {"fwdtransforms": [str(path)], "invtransforms": [str(path)]}
+
+
+def test_transform_store_roundtrip(tmp_path):
+    store = TransformStore(tmp_path / "store")
+
+    assert store.get("ab" * 20) is None
+    stored = store.put("ab" * 20, _registration(tmp_path, "a"))
+
+    assert store.get("ab" * 20) == stored
+    assert stored["fwdtransforms"] == stored["invtransforms"]
+    assert os.path.exists(stored["fwdtransforms"][0])
+
+
+def test_transform_store_lru_eviction(tmp_path):
+    store = TransformStore(tmp_path / "store", max_entries=2)
+
+    store.put("aa" * 20, _registration(tmp_path, "a"))
+    store.put("bb" * 20, _registration(tmp_path, "b"))
+    # Make "bb" the least recently used entry
+    os.utime(store._entry("bb" * 20) / "transforms.json", (0, 0))
+    store.get("aa" * 20)
+    store.put("cc" * 20, _registration(tmp_path, "c"))
+
+    assert store.get("aa" * 20) is not None
+    assert store.get("bb" * 20) is None
+    assert store.get("cc" * 20) is not None